@@ -0,0 +1,318 @@
+"""
+Run spack commands through a persistent spack worker or the shell
+"""
+
+from src.core.utilities import pcolors
+from os import getpid, environ, makedirs
+from os.path import split, abspath, join, isfile
+from functools import lru_cache
+from shlex import quote
+from shutil import rmtree
+import atexit
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+BACKENDS = ['worker', 'shell']
+
+# Commands always run through the shell: the worker only returns the output
+# once the command is done, and these print their progress as they go.
+STREAMED_COMMANDS = ['install']
+
+# Private spack user scope of a spack environment, see user_scope.
+USER_SCOPE = '.spack-user'
+
+settings = {'backend': 'worker', 'user_scope': None}
+local = threading.local()
+workers = []
+workers_lock = threading.Lock()
+
+
+class BackendException(Exception):
+    """Catch all backend exceptions"""
+    pass
+
+
+def set_backend(name):
+    """
+    Select how spack commands are run.
+
+    Parameters
+    ----------
+    name : String
+        'worker' to keep a spack interpreter running between commands,
+        or 'shell' to start spack for every command.
+
+    """
+    if name not in BACKENDS:
+        error = 'ERROR: Unknown spack backend {}. Available choices: {}.'.format(name, ', '.join(BACKENDS))
+        logger.critical(error)
+        raise BackendException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    settings['backend'] = name
+    logger.info('Running spack commands through the {} backend.'.format(name))
+
+
+@lru_cache(maxsize=None)
+def legacy_spack():
+    """
+    Check whether spack predates SPACK_USER_CONFIG_PATH and
+    SPACK_USER_CACHE_PATH (spack 0.16 and older).
+
+    """
+    init = join(environ.get('SPACK_ROOT', ''), 'lib', 'spack', 'spack', '__init__.py')
+    if not isfile(init):
+        return True
+    with open(init, 'r') as f:
+        contents = f.read()
+    version = (re.search(r'spack_version_info\s*=\s*\((\d+),\s*(\d+)', contents)
+               or re.search(r'__version__\s*=\s*"(\d+)\.(\d+)', contents))
+    if version is None:
+        return True
+    return (int(version.group(1)), int(version.group(2))) < (0, 17)
+
+
+def user_scope(env=None):
+    """
+    Get (and create) the private spack user scope used for commands run in
+    a spack environment, or for commands run outside of one. spack-cm never
+    uses the user's own ~/.spack.
+
+    Parameters
+    ----------
+    env : String, optional
+        Spack environment directory. The default is the scope of this
+        spack-cm run.
+
+    Returns
+    -------
+    path : String
+        Directory of the scope.
+
+    """
+    if env is not None:
+        path = join(env, USER_SCOPE)
+    else:
+        if settings['user_scope'] is None:
+            settings['user_scope'] = tempfile.mkdtemp(prefix='spack-cm-')
+            atexit.register(rmtree, settings['user_scope'], True)
+        path = settings['user_scope']
+    makedirs(path, exist_ok=True)
+    return path
+
+
+def user_config_dir(env=None):
+    """
+    Directory holding the user configuration of a private scope.
+
+    """
+    if legacy_spack():
+        return join(user_scope(env), '.spack')
+    return join(user_scope(env), 'config')
+
+
+def spack_environ(env=None):
+    """
+    Process environment pointing spack at a private user scope.
+
+    Parameters
+    ----------
+    env : String, optional
+        Spack environment directory. The default is the scope of this
+        spack-cm run.
+
+    Returns
+    -------
+    environment : Dictionary
+        Copy of os.environ with the scope set.
+
+    """
+    environment = dict(environ)
+    scope = user_scope(env)
+    environment['SPACK_USER_CONFIG_PATH'] = join(scope, 'config')
+    environment['SPACK_USER_CACHE_PATH'] = join(scope, 'cache')
+    if legacy_spack():
+        # Older spack always uses ~/.spack, so only HOME can move it.
+        environment['HOME'] = scope
+    return environment
+
+
+class SpackWorker:
+    """
+    A 'spack python' process running spack_worker.py in the private user
+    scope of a spack environment.
+    """
+    def __init__(self, env=None):
+        filedir, filename = split(abspath(__file__))
+        self.pid = getpid()
+        self.process = subprocess.Popen(['spack', 'python', join(filedir, 'spack_worker.py')],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True,
+                                        env=spack_environ(env))
+        ready = self.process.stdout.readline()
+        if not ready or not json.loads(ready).get('ready'):
+            self.close()
+            raise BackendException('spack worker did not start.')
+
+    def run(self, args, env=None):
+        request = {'args': args, 'env': env, 'environ': spack_environ(env)}
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        reply = self.process.stdout.readline()
+        if not reply:
+            self.close()
+            raise BackendException('spack worker exited.')
+        reply = json.loads(reply)
+        if reply.get('error'):
+            raise BackendException('spack {} raised in the worker:\n{}'.format(
+                ' '.join(args), reply['output']))
+        return reply['returncode'], reply['output']
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(json.dumps({'exit': True}) + '\n')
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except Exception:
+                self.process.kill()
+
+
+@atexit.register
+def close_workers():
+    """
+    Stop the spack workers started by this process.
+
+    """
+    with workers_lock:
+        for worker in workers:
+            if worker.pid == getpid():
+                worker.close()
+        del workers[:]
+
+
+def get_worker(env=None):
+    """
+    Get the spack worker of the current thread for a spack environment,
+    starting it if needed. A process forked from spack-cm never reuses its
+    parent's workers.
+
+    Parameters
+    ----------
+    env : String, optional
+        Spack environment directory.
+
+    Returns
+    -------
+    worker : SpackWorker
+        The worker, or None if it could not be started.
+
+    """
+    if not hasattr(local, 'workers'):
+        local.workers = {}
+    worker = local.workers.get(env)
+    if worker is not None and worker.pid == getpid() and worker.process.poll() is None:
+        return worker
+    try:
+        worker = SpackWorker(env)
+    except Exception as e:
+        warn = 'WARNING: Unable to start a spack worker ({}). Falling back to the shell.'.format(e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        settings['backend'] = 'shell'
+        return None
+    local.workers[env] = worker
+    with workers_lock:
+        workers.append(worker)
+    return worker
+
+
+def run_shell(cmd, echo=True, keep=None, environment=None):
+    """
+    Run a shell command, streaming its output.
+
+    Parameters
+    ----------
+    cmd : String
+        Shell command to run.
+    echo : Boolean, optional
+        Print the output as it arrives. The default is True.
+    keep : Callable, optional
+        Only output lines for which keep(line) is true are returned. The
+        default keeps every line.
+    environment : Dictionary, optional
+        Process environment of the command. The default is os.environ.
+
+    Returns
+    -------
+    returncode : Integer
+        Return code of the command.
+    output : String
+        Kept output lines.
+
+    """
+    kept = []
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True, errors='replace',
+                               env=environment)
+    for line in process.stdout:
+        if echo:
+            sys.stdout.write(line)
+        if keep is None or keep(line):
+            kept.append(line)
+    sys.stdout.flush()
+    return process.wait(), ''.join(kept)
+
+
+def spack_command(args, env=None, echo=True, keep=None):
+    """
+    Run a spack command, optionally inside a spack environment. Spack uses
+    the private user scope of the environment (see user_scope). Commands in
+    STREAMED_COMMANDS, and commands the worker fails to run, go through the
+    shell.
+
+    Parameters
+    ----------
+    args : List
+        Spack command and its arguments (e.g., ['install', '-v']).
+    env : String, optional
+        Spack environment directory to run the command in.
+    echo : Boolean, optional
+        Print the output of the command. The default is True.
+    keep : Callable, optional
+        Only output lines for which keep(line) is true are returned. The
+        default keeps every line.
+
+    Returns
+    -------
+    returncode : Integer
+        Return code of the command.
+    output : String
+        Kept output of the command.
+
+    """
+    args = [arg for arg in args if arg]
+    if settings['backend'] == 'worker' and args[0] not in STREAMED_COMMANDS:
+        worker = get_worker(env)
+        if worker is not None:
+            try:
+                returncode, output = worker.run(args, env)
+                if echo:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+                if keep is not None:
+                    output = ''.join(line for line in output.splitlines(True) if keep(line))
+                return returncode, output
+            except Exception as e:
+                warn = 'WARNING: spack worker failed ({}). Running "spack {}" through the shell.'.format(
+                    e, ' '.join(args))
+                logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+    cmd = 'spack ' + ' '.join(quote(arg) for arg in args)
+    if env is not None:
+        cmd = 'spack env activate {} && {} && spack env deactivate'.format(quote(env), cmd)
+    return run_shell(cmd, echo, keep, spack_environ(env))
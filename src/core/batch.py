@@ -0,0 +1,464 @@
+"""
+Install several project/machine combinations under a shared budget of
+spack processes and cores
+"""
+
+from src.core.installer import installer, STAGE_ATTEMPTS
+from src.core.context import load_context
+from src.core.backend import settings as backend_settings, set_backend
+from src.core import cleanup as cleanup_module
+from src.core.utilities import (dir_path, get_hostname, stage_attempts,
+                                stage_cleanup_policy, expand_stage_settings,
+                                pcolors)
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os import dup2, getcwd, cpu_count
+from os.path import abspath, expanduser
+import argparse
+import multiprocessing
+import sys
+import time
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+# Settings of a batch entry and their defaults, named after the options of
+# 'spack-cm install'.
+ENTRY_DEFAULTS = {'project': None,
+                  'machine': None,
+                  'root': None,
+                  'explicit_install_path': None,
+                  'explicit_modulefile_path': None,
+                  'stage': 'all',
+                  'external': False,
+                  'project_modules': True,
+                  'machine_path': False,
+                  'install_single_stacks': False,
+                  'stack_workers': 1,
+                  'concurrent_stages': 1,
+                  'attempts': [],
+                  'retry_jobs': None,
+                  'cleanup_policy': [],
+                  'expand_matrix': False,
+                  'force': False}
+
+
+class BatchException(Exception):
+    """Catch all batch exceptions"""
+    pass
+
+
+def _stage_settings(value, parse, name, entry):
+    """
+    Expand a per-stage setting of a batch entry, given like on the command
+    line either as one value (e.g., 3 or tpl=5) or as a list of them.
+
+    """
+    values = value if isinstance(value, list) else [value]
+    try:
+        return expand_stage_settings([parse(str(item)) for item in values],
+                                     list(STAGE_ATTEMPTS))
+    except argparse.ArgumentTypeError as e:
+        error = 'ERROR: Invalid {} of batch entry {}: {}'.format(name, entry, e)
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+
+
+def batch_entry(settings, defaults=None, index=0):
+    """
+    Complete and check one entry of a batch file.
+
+    Parameters
+    ----------
+    settings : Dictionary
+        Settings of the entry, see ENTRY_DEFAULTS.
+    defaults : Dictionary, optional
+        Settings shared by all entries of the file. The default is none.
+    index : Integer, optional
+        Position of the entry in the file, for error messages.
+
+    Returns
+    -------
+    entry : Dictionary
+        Every setting of ENTRY_DEFAULTS, with the machine, paths and
+        per-stage settings resolved.
+
+    """
+    entry = dict(ENTRY_DEFAULTS)
+    for source in [defaults or {}, settings]:
+        if not isinstance(source, dict):
+            error = 'ERROR: Batch entry {} must be a mapping of settings.'.format(index + 1)
+            logger.critical(error)
+            raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        unknown = sorted(set(source) - set(ENTRY_DEFAULTS))
+        if unknown:
+            error = 'ERROR: Unknown settings {} in batch entry {}. Available settings: {}.'.format(
+                ', '.join(unknown), index + 1, ', '.join(ENTRY_DEFAULTS))
+            logger.critical(error)
+            raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        entry.update(source)
+    if not entry['project']:
+        error = 'ERROR: Batch entry {} has no project.'.format(index + 1)
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    if not entry['machine']:
+        entry['machine'] = get_hostname()
+    if entry['root'] is not None:
+        try:
+            entry['root'] = dir_path(str(entry['root']))
+        except argparse.ArgumentTypeError as e:
+            error = 'ERROR: Invalid root of batch entry {}: {}'.format(index + 1, e)
+            logger.critical(error)
+            raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    elif entry['explicit_install_path'] is None or entry['explicit_modulefile_path'] is None:
+        error = 'ERROR: Batch entry {} needs a root or both an explicit_install_path and an explicit_modulefile_path.'.format(index + 1)
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    for name in ['explicit_install_path', 'explicit_modulefile_path']:
+        if entry[name] is not None:
+            entry[name] = abspath(expanduser(str(entry[name])))
+    entry['attempts'] = _stage_settings(entry['attempts'], stage_attempts,
+                                        'attempts', index + 1)
+    entry['cleanup_policy'] = _stage_settings(entry['cleanup_policy'], stage_cleanup_policy,
+                                              'cleanup_policy', index + 1)
+    entry['name'] = '{}/{}'.format(entry['project'], entry['machine'])
+    return entry
+
+
+def read_batch(file):
+    """
+    Read the project/machine combinations of a batch file. The file holds
+    either a list of entries, or a mapping with the entries under 'installs'
+    and the settings they share under 'defaults':
+
+        defaults:
+          root: /projects/sems
+          install_single_stacks: true
+        installs:
+          - project: sems
+            machine: blake
+          - project: pyomo
+            machine: blake
+            attempts: tpl=5
+
+    Parameters
+    ----------
+    file : String
+        Path to the batch YAML file.
+
+    Returns
+    -------
+    entries : List
+        Entries of the file, see batch_entry.
+
+    """
+    try:
+        with open(file, 'r') as f:
+            contents = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        error = 'ERROR: Unable to read batch file {} with error {}.'.format(file, e)
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    defaults = None
+    if isinstance(contents, dict):
+        defaults = contents.get('defaults')
+        contents = contents.get('installs')
+    if not isinstance(contents, list) or not contents:
+        error = 'ERROR: Batch file {} lists no installs.'.format(file)
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    return [batch_entry(settings, defaults, index)
+            for index, settings in enumerate(contents)]
+
+
+def spack_processes(entry):
+    """
+    Number of spack processes an entry runs at the same time: one per
+    concurrent stage, the TPL stage running its single stacks side by side
+    when they are installed one at a time.
+
+    """
+    stacks = entry['stack_workers'] if entry['install_single_stacks'] else 1
+    return max(1, entry['concurrent_stages'] - 1 + stacks)
+
+
+def ready_entries(entries, pending, running, max_spack):
+    """
+    Pick the pending entries that can start now. Entries start in order as
+    long as the spack processes of everything running fit the budget; an
+    entry too large for what is left is passed over for smaller ones.
+    Entries of the same project never run together, since they generate
+    the same project files.
+
+    Parameters
+    ----------
+    entries : List
+        All entries of the batch.
+    pending : List
+        Indices of the entries not started yet.
+    running : List
+        Indices of the entries running.
+    max_spack : Integer
+        Maximum number of spack processes running at the same time.
+
+    Returns
+    -------
+    ready : List
+        Indices of the entries to start.
+
+    """
+    used = sum(min(spack_processes(entries[index]), max_spack) for index in running)
+    projects = set(entries[index]['project'] for index in running)
+    ready = []
+    for index in pending:
+        entry = entries[index]
+        processes = min(spack_processes(entry), max_spack)
+        if entry['project'] in projects or used + processes > max_spack:
+            continue
+        ready.append(index)
+        used += processes
+        projects.add(entry['project'])
+    return ready
+
+
+def prepare_entries(entries):
+    """
+    Shared setup of a batch: parse the manifest of every entry and detect
+    the compilers of every platform once, before anything installs. Entries
+    failing this are not installed.
+
+    Returns
+    -------
+    failures : Dictionary
+        Index of each entry that failed mapped to its error.
+
+    """
+    failures = {}
+    for index, entry in enumerate(entries):
+        try:
+            load_context(entry['project'], entry['machine'], entry['root'],
+                         entry['machine_path'], entry['explicit_install_path'],
+                         entry['explicit_modulefile_path'])
+        except Exception as e:
+            logger.critical('ERROR: Unable to prepare {} with error {}'.format(entry['name'], e))
+            failures[index] = str(e)
+    return failures
+
+
+def _batch_worker_init(lock, path, backend):
+    """
+    Prepare a process of the batch pool.
+
+    Parameters
+    ----------
+    lock : multiprocessing.Lock
+        Lock shared by all installs to serialize the spack cleanup.
+    path : List
+        sys.path of the parent, which holds the spack libraries.
+    backend : String
+        Spack backend used by the parent.
+
+    """
+    cleanup_module.cleanup_lock = lock
+    sys.path[:] = path
+    set_backend(backend)
+
+
+def install_entry(entry, options, build_jobs, log):
+    """
+    Install one entry of a batch. Runs in a process of the batch pool, with
+    all output sent to the entry's own log file.
+
+    Parameters
+    ----------
+    entry : Dictionary
+        Entry to install, see batch_entry.
+    options : Dictionary
+        Settings shared by the whole batch: debug, fake, build_cache and
+        build_cache_size.
+    build_jobs : Integer
+        Build jobs of each spack install, or None for spack's own setting.
+    log : String
+        Log file of the entry.
+
+    Returns
+    -------
+    result : Dictionary
+        Status and duration of the install.
+
+    """
+    result = {'status': 'failed', 'seconds': 0.0}
+    start = time.time()
+    with open(log, 'w') as f:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        dup2(f.fileno(), 1)
+        dup2(f.fileno(), 2)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(filename)s:%(funcName)s: %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        try:
+            result['status'] = installer(entry['project'], entry['machine'], entry['root'],
+                                         entry['stage'], options['debug'], entry['external'],
+                                         options['fake'], entry['project_modules'],
+                                         entry['machine_path'], False,
+                                         entry['explicit_install_path'],
+                                         entry['explicit_modulefile_path'],
+                                         concurrent_stages=entry['concurrent_stages'],
+                                         install_stacks=entry['install_single_stacks'],
+                                         stack_workers=entry['stack_workers'],
+                                         force=entry['force'],
+                                         attempts=entry['attempts'],
+                                         retry_jobs=entry['retry_jobs'],
+                                         cleanup_policy=entry['cleanup_policy'],
+                                         build_cache=options['build_cache'],
+                                         build_cache_size=options['build_cache_size'],
+                                         expand_matrix=entry['expand_matrix'],
+                                         build_jobs=build_jobs)
+        except Exception as e:
+            logger.critical('ERROR: {} failed with error {}'.format(entry['name'], e))
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def run_batch(entries, max_spack, build_jobs, options, log_dir,
+              runner=install_entry, skip=None):
+    """
+    Install the entries of a batch, at most max_spack spack processes at
+    the same time.
+
+    Parameters
+    ----------
+    entries : List
+        Entries to install, see batch_entry.
+    max_spack : Integer
+        Maximum number of spack processes running at the same time.
+    build_jobs : Integer
+        Build jobs of each spack install, or None for spack's own setting.
+    options : Dictionary
+        Settings shared by the whole batch, see install_entry.
+    log_dir : String
+        Directory in which to write the log of each entry.
+    runner : Function, optional
+        Installs one entry, see install_entry.
+    skip : Dictionary, optional
+        Index of entries not to install mapped to the reason.
+
+    Returns
+    -------
+    results : List
+        Name, status, duration, log and error of each entry, in order.
+
+    """
+    results = []
+    for index, entry in enumerate(entries):
+        log = '{}/TPL-log-batch-{}-{}-{}.log'.format(log_dir, index + 1, entry['project'],
+                                                    entry['machine'])
+        results.append({'name': entry['name'], 'status': 'failed', 'seconds': 0.0,
+                        'log': log, 'error': (skip or {}).get(index)})
+    pending = [index for index in range(len(entries)) if index not in (skip or {})]
+    running = {}
+    sys.stdout.flush()
+    lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(max_workers=max_spack,
+                             initializer=_batch_worker_init,
+                             initargs=(lock, list(sys.path),
+                                       backend_settings['backend'])) as pool:
+        while pending or running:
+            for index in ready_entries(entries, pending, list(running.values()), max_spack):
+                pending.remove(index)
+                logger.info('Starting {}.'.format(entries[index]['name']))
+                print(f'{pcolors.OKCYAN}{entries[index]["name"]}: started.{pcolors.ENDC}')
+                running[pool.submit(runner, entries[index], options, build_jobs,
+                                    results[index]['log'])] = index
+            done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                try:
+                    results[index].update(future.result())
+                except Exception as e:
+                    results[index]['error'] = str(e)
+                if results[index]['status'] == 'installed':
+                    print(f'{pcolors.OKGREEN}{results[index]["name"]}: installed.{pcolors.ENDC}')
+                else:
+                    print(f'{pcolors.FAIL}{results[index]["name"]}: failed, see {results[index]["log"]}.{pcolors.ENDC}')
+                sys.stdout.flush()
+    return results
+
+
+def print_summary(results):
+    """
+    Print the status, duration and log of every entry of a batch.
+
+    """
+    width = max(len(result['name']) for result in results)
+    print('\n' + 50*'*')
+    print('Batch summary:')
+    for result in results:
+        color = pcolors.OKGREEN if result['status'] == 'installed' else pcolors.FAIL
+        line = '{:<{}}  {:<9}  {:>8.1f}s  {}'.format(result['name'], width, result['status'],
+                                                   result['seconds'], result['log'])
+        if result['error']:
+            line = '{:<{}}  {:<9}  {}'.format(result['name'], width, result['status'],
+                                             result['error'])
+        print(f'{color}' + line + f'{pcolors.ENDC}')
+    installed = sum(result['status'] == 'installed' for result in results)
+    print('{} installed, {} failed.'.format(installed, len(results) - installed))
+
+
+def batch(file, max_spack=1, cores=None, debug=False, fake='',
+          build_cache=None, build_cache_size=None):
+    """
+    Batch driver: install every project/machine combination of a batch file.
+
+    Parameters
+    ----------
+    file : String
+        Path to the batch YAML file, see read_batch.
+    max_spack : Integer, optional
+        Maximum number of spack processes running at the same time, over
+        all combinations. The default is 1.
+    cores : Integer, optional
+        Cores shared by all spack processes; each process builds with an
+        equal share. The default is every core of the machine.
+    debug : Boolean, optional
+        Turn on debug mode.
+    fake : String, optional
+        Use the spack install --fake flag if the user is requesting a dry-run.
+    build_cache : String, optional
+        Directory of the build caches shared between the combinations.
+    build_cache_size : Integer, optional
+        Size in bytes above which packages are evicted from the build cache.
+
+    Returns
+    -------
+    results : List
+        Result of each combination, see run_batch.
+
+    """
+    if max_spack < 1:
+        error = 'ERROR: The batch needs at least one spack process.'
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    entries = read_batch(file)
+    build_jobs = max(1, (cores or cpu_count() or 1) // max_spack)
+    logger.info('Installing {} combinations with {} spack processes of {} build jobs.'.format(
+        len(entries), max_spack, build_jobs))
+    print(f'{pcolors.OKCYAN}Installing {len(entries)} combinations with up to {max_spack} spack processes of {build_jobs} build jobs...{pcolors.ENDC}')
+    failures = prepare_entries(entries)
+    options = {'debug': debug, 'fake': fake, 'build_cache': build_cache,
+               'build_cache_size': build_cache_size}
+    results = run_batch(entries, max_spack, build_jobs, options, getcwd(), skip=failures)
+    print_summary(results)
+    failed = [result['name'] for result in results if result['status'] != 'installed']
+    if failed:
+        error = 'ERROR: {} of {} installs failed: {}.'.format(len(failed), len(results), ', '.join(failed))
+        logger.critical(error)
+        raise BatchException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    return results
@@ -0,0 +1,278 @@
+"""
+Share built packages between stages and rebuilds through a local spack
+build cache
+"""
+
+from src.core.utilities import pcolors
+from src.core.backend import spack_command
+from os import environ, walk, utime, remove, makedirs
+from os.path import join, isfile, isdir, getsize, getmtime
+from contextlib import contextmanager
+import fcntl
+import json
+import re
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+MIRROR_NAME = 'spack-cm-cache'
+
+# Build cache files are named after the spec's full hash, e.g.
+# linux-rhel7-x86_64-gcc-10.1.0-zlib-1.2.11-<hash>.spec.yaml
+ENTRY_RE = re.compile(r'-([a-z0-9]{32})\.(spack|spec\.yaml|spec\.json|spec\.json\.sig)$')
+
+cache_lock = threading.Lock()
+
+# Lock file of a build cache, next to its build_cache directory.
+LOCK_FILE = '.spack-cm.lock'
+
+
+class BuildCacheException(Exception):
+    """Catch all build cache exceptions"""
+    pass
+
+
+def set_build_cache(path, machine, size=None):
+    """
+    Enable the build cache for this run. The cache of each platform lives
+    in its own directory below path.
+
+    Parameters
+    ----------
+    path : String
+        Root of the build caches.
+    machine : String
+        Platform the cache is used for.
+    size : Integer, optional
+        Size in bytes above which the least recently used packages are
+        evicted. The default is no limit.
+
+    """
+    directory = join(path, machine)
+    try:
+        if not isdir(directory):
+            makedirs(directory)
+    except OSError as e:
+        error = 'ERROR: Unable to create build cache {} with error {}.'.format(directory, e)
+        logger.critical(error)
+        raise BuildCacheException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    environ['SPACK_CM_BUILD_CACHE'] = directory
+    environ['SPACK_CM_BUILD_CACHE_SIZE'] = str(size or 0)
+    logger.info('Using build cache {}.'.format(directory))
+
+
+def cache_dir():
+    """
+    Directory of the build cache of this run, or None if it is disabled.
+
+    """
+    return environ.get('SPACK_CM_BUILD_CACHE') or None
+
+
+@contextmanager
+def locked_cache():
+    """
+    Hold the build cache exclusively while it is pushed to, evicted from or
+    indexed: cache_lock keeps the threads of this process apart and a flock
+    on the cache the other processes (single stacks, batch entries).
+
+    """
+    with cache_lock, open(join(cache_dir(), LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def install_args():
+    """
+    Extra 'spack install' arguments needed to install from the cache.
+
+    """
+    if cache_dir() is None:
+        return []
+    # spack-cm pushes unsigned packages.
+    return ['--no-check-signature']
+
+
+def add_mirror(envdir):
+    """
+    Add the build cache as a mirror of a spack environment, so spack
+    installs from it when it holds the same spec. The mirror goes in the
+    environment's private user scope, the environment's spack.yaml is left
+    alone, and is only added when not already listed.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory.
+
+    """
+    if cache_dir() is None:
+        return
+    returncode, output = spack_command(['mirror', 'list'], env=envdir, echo=False)
+    if returncode == 0 and any(line.split()[:1] == [MIRROR_NAME] for line in output.splitlines()):
+        return
+    returncode, output = spack_command(['mirror', 'add', '--scope', 'user', MIRROR_NAME,
+                                        'file://' + cache_dir()],
+                                       env=envdir, echo=False)
+    if returncode != 0:
+        logger.info('Build cache mirror not added to {}: {}'.format(envdir, output.strip()))
+
+
+def cache_entries():
+    """
+    Group the files of the build cache by spec hash.
+
+    Returns
+    -------
+    entries : Dictionary
+        Hash mapped to the list of its files.
+
+    """
+    entries = {}
+    for root, dirs, files in walk(join(cache_dir(), 'build_cache')):
+        for name in files:
+            match = ENTRY_RE.search(name)
+            if match is not None:
+                entries.setdefault(match.group(1), []).append(join(root, name))
+    return entries
+
+
+def installed_hashes(install_path, since=0):
+    """
+    Hashes installed in a tree, optionally only those installed after a
+    given time.
+
+    Parameters
+    ----------
+    install_path : String
+        Root of the install tree.
+    since : Float, optional
+        Only hashes installed after this time are returned.
+
+    Returns
+    -------
+    hashes : List
+        Installed hashes.
+
+    """
+    index = join(install_path, '.spack-db', 'index.json')
+    if not isfile(index):
+        return []
+    with open(index, 'r') as f:
+        installs = json.load(f)['database']['installs']
+    return [key for key, record in installs.items()
+            if record.get('installed', True)
+            and record.get('installation_time', 0) >= since]
+
+
+def push(envdir, hashes):
+    """
+    Add installed specs to the build cache.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory whose install tree holds the specs.
+    hashes : List
+        Hashes of the specs to add.
+
+    """
+    if cache_dir() is None:
+        return
+    with locked_cache():
+        _push(envdir, hashes)
+
+
+def _push(envdir, hashes):
+    """
+    Add installed specs to the build cache, see push. The cache must be
+    locked.
+
+    """
+    cached = cache_entries()
+    hashes = [key for key in hashes if key not in cached]
+    if not hashes:
+        return
+    logger.info('Pushing {} specs to the build cache.'.format(len(hashes)))
+    print(f'{pcolors.OKCYAN}Pushing {len(hashes)} specs to the build cache...{pcolors.ENDC}')
+    returncode, output = spack_command(['buildcache', 'create', '-a', '-u',
+                                        '-d', cache_dir(), '--only', 'package']
+                                       + ['/' + key for key in hashes],
+                                       env=envdir, echo=False)
+    if returncode != 0:
+        warn = 'WARNING: Unable to push specs to the build cache:\n{}'.format(output)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+
+
+def evict(size):
+    """
+    Remove the least recently used specs until the build cache is no
+    larger than size.
+
+    Parameters
+    ----------
+    size : Integer
+        Maximum size of the cache in bytes.
+
+    Returns
+    -------
+    evicted : List
+        Hashes removed from the cache.
+
+    """
+    entries = cache_entries()
+    usage = {key: (max(getmtime(name) for name in files),
+                   sum(getsize(name) for name in files))
+             for key, files in entries.items()}
+    total = sum(used for mtime, used in usage.values())
+    evicted = []
+    for key in sorted(usage, key=lambda key: usage[key][0]):
+        if total <= size:
+            break
+        for name in entries[key]:
+            remove(name)
+        total -= usage[key][1]
+        evicted.append(key)
+    if evicted:
+        logger.info('Evicted {} specs from the build cache.'.format(len(evicted)))
+    return evicted
+
+
+def update_cache(envdir, install_path, since):
+    """
+    Push the specs a stage installed to the build cache, mark the specs it
+    uses as recently used, evict old ones if the cache is too large, and
+    rebuild the cache index.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory of the stage, or None to only maintain
+        the cache.
+    install_path : String
+        Root of the stage's install tree.
+    since : Float
+        Time the stage started.
+
+    """
+    if cache_dir() is None:
+        return
+    with locked_cache():
+        if envdir is not None:
+            _push(envdir, installed_hashes(install_path, since))
+        entries = cache_entries()
+        for key in installed_hashes(install_path):
+            for name in entries.get(key, []):
+                utime(name)
+        size = int(environ.get('SPACK_CM_BUILD_CACHE_SIZE', '0'))
+        if size:
+            evict(size)
+        returncode, output = spack_command(['buildcache', 'update-index',
+                                            '-d', cache_dir()],
+                                           env=envdir, echo=False)
+        if returncode != 0:
+            warn = 'WARNING: Unable to update the build cache index:\n{}'.format(output)
+            logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
@@ -3,58 +3,234 @@ Cleanup Spack files in between steps
 """
 
 from src.core.utilities import pcolors
-from os.path import isdir, expanduser, exists, join
-from os import remove, environ
+from src.core.backend import spack_command, user_config_dir
+from src.core.compilers import detect_compilers
+from src.core.externals import detect_externals
+from os.path import split, abspath, dirname, isdir, exists, join
+from os import remove, environ, listdir, makedirs
+from contextlib import contextmanager
+import fcntl
+import multiprocessing
+import multiprocessing.synchronize
+import re
 from shutil import rmtree
 import logging
+import threading
 logger = logging.getLogger(__name__)
 
+# Only one stage may clean up (and detect compilers and externals) at once.
+cleanup_lock = threading.Lock()
+
+# What each cleanup policy removes between install attempts:
+#   none:   nothing but the environment's lock and view.
+#   failed: failure markers and the build stages of the specs that failed.
+#   stage:  failure markers and every build stage.
+#   full:   build stages, downloaded sources, failure markers and misc cache.
+CLEANUP_POLICIES = {'none': None,
+                    'failed': ['-f'],
+                    'stage': ['-s', '-f'],
+                    'full': ['-s', '-d', '-f', '-m']}
+
 
 class CleanupException(Exception):
     """Catch all cleanup exceptions"""
     pass
 
 
-def spack_cleanup(projectdir):
+def share_cleanup_lock():
+    """
+    Make cleanup_lock a multiprocessing lock, so the stage threads and the
+    processes they start (the single stack pool) all wait on the same lock.
+    A lock already shared, e.g. by a batch install, is kept.
+
+    Returns
+    -------
+    lock : multiprocessing.Lock
+        The cleanup lock, to hand to the processes.
+
+    """
+    global cleanup_lock
+    if not isinstance(cleanup_lock, multiprocessing.synchronize.Lock):
+        cleanup_lock = multiprocessing.Lock()
+    return cleanup_lock
+
+
+def stage_lock_file():
+    """
+    Path of the lock guarding the build stages, downloads and caches spack
+    shares between every install started from this spack-cm checkout.
+
+    """
+    filedir, file = split(abspath(__file__))
+    envs = join(dirname(filedir), 'envs')
+    if not isdir(envs):
+        makedirs(envs, exist_ok=True)
+    return join(envs, '.stage.lock')
+
+
+@contextmanager
+def stage_lock(exclusive=False):
+    """
+    Reader/writer lock over the shared build stages. Installs hold it
+    shared, a cleanup removing stages, downloads or caches holds it
+    exclusively so it never removes those of an install still running.
+
+    The lock is a flock on its own open file, so it excludes other threads
+    as well as other processes (stage threads, stack and batch workers).
+
+    Parameters
+    ----------
+    exclusive : Boolean, optional
+        Take the exclusive (cleanup) side. The default is False.
+
+    """
+    with open(stage_lock_file(), 'a') as f:
+        if exclusive:
+            logger.info('Waiting for running installs before cleaning up.')
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def failed_stage_pattern(failed):
+    """
+    Match the build stage directories of failed specs. Stages are named
+    spack-stage-<name>-<version>-<DAG hash>.
+
+    Parameters
+    ----------
+    failed : List
+        (name, version, DAG hash) of the specs that failed, see
+        retry.failed_specs. Without a DAG hash, every stage of the same
+        name and version is matched.
+
+    Returns
+    -------
+    pattern : re.Pattern
+        Pattern matching the stage directory names.
+
+    """
+    return re.compile(r'^spack-stage-(?:{})$'.format('|'.join(
+        '{}-{}-{}'.format(re.escape(name), re.escape(version),
+                          re.escape(dag_hash) if dag_hash else '[a-z0-9]{32}')
+        for name, version, dag_hash in failed)))
+
+
+@contextmanager
+def cleanup_locks(policy='failed', failed=None):
+    """
+    Hold the locks a cleanup needs: stage_lock, exclusively when the policy
+    removes every build stage, downloads or caches, then cleanup_lock. The stage
+    lock is taken first, so a cleanup waiting for the running installs does
+    not keep the other stages from cleaning up meanwhile.
+
+    Parameters
+    ----------
+    policy : String, optional
+        Cleanup policy, see CLEANUP_POLICIES. The default is 'failed'.
+    failed : List, optional
+        (name, version, DAG hash) of the specs which failed in the previous
+        attempt, see retry.failed_specs.
+
+    """
+    # Failure markers and the stages of the specs which failed can go while
+    # other installs run, every stage and the caches only once they are done.
+    exclusive = policy in ('stage', 'full')
+    with stage_lock(exclusive):
+        with cleanup_lock:
+            yield
+
+
+def remove_failed_stages(projectdir, failed):
     """
-    Cleans up system spack files.
+    Remove the build stages of specs that failed to install, so their next
+    attempt starts from freshly expanded sources.
+
+    Parameters
+    ----------
+    projectdir : String
+        Spack environment directory.
+    failed : List
+        (name, version, DAG hash) of the specs that failed, see
+        failed_stage_pattern.
+
+    """
+    returncode, output = spack_command(['location', '-S'], env=projectdir, echo=False)
+    stage_root = output.strip()
+    if returncode != 0 or not isdir(stage_root):
+        return
+    pattern = failed_stage_pattern(failed)
+    for name in listdir(stage_root):
+        if pattern.match(name) is not None:
+            logger.info('Removing stage {} of a failed spec.'.format(name))
+            rmtree(join(stage_root, name), ignore_errors=True)
+
+
+def spack_cleanup(projectdir, policy='failed', failed=None):
+    """
+    Cleans up the spack environment in projectdir and its private user
+    configuration. The user's own ~/.spack is left alone, and what else is
+    removed depends on the cleanup policy (see CLEANUP_POLICIES). The
+    caller holds the locks of the policy, see cleanup_locks.
+
+    Parameters
+    ----------
+    projectdir : String
+        Spack environment directory.
+    policy : String, optional
+        Cleanup policy. The default is 'failed'.
+    failed : List, optional
+        (name, version, DAG hash) of the specs which failed in the previous
+        attempt, see retry.failed_specs.
 
     """
-    if isdir(expanduser('~/.spack')):
-        logger.info('Removing ~/.spack directory.')
-        rmtree(expanduser('~/.spack'))
+    config = user_config_dir(projectdir)
+    if isdir(config):
+        logger.info('Removing user configuration {}.'.format(config))
+        for name in listdir(config):
+            if name == 'cache':
+                continue
+            if isdir(join(config, name)):
+                rmtree(join(config, name))
+            else:
+                remove(join(config, name))
     if exists(join(projectdir, 'spack.lock')):
         print('Removing old spack.lock.')
         remove(join(projectdir, 'spack.lock'))
     if isdir(join(projectdir, '.spack-env')):
         print('Removing old spack environment.')
         rmtree(join(projectdir, '.spack-env'))
-    from spack.main import SpackCommand
-    clean = SpackCommand('clean')
-    print(clean())
+    if policy not in CLEANUP_POLICIES:
+        raise CleanupException('Unknown cleanup policy {}.'.format(policy))
+    if CLEANUP_POLICIES[policy] is not None:
+        returncode, output = spack_command(['clean'] + CLEANUP_POLICIES[policy],
+                                           env=projectdir)
+        if returncode != 0:
+            raise CleanupException("'spack clean' failed.")
+    if policy == 'failed' and failed:
+        remove_failed_stages(projectdir, failed)
 
 
-def spack_compiler_find():
+def spack_compiler_find(projectdir, machine=None):
     """
-    Enable spack to find compilers.
+    Enable spack to find compilers, recording them in the private user
+    configuration of projectdir. The detection is cached per platform.
 
     """
-    from spack.main import SpackCommand
-    compiler = SpackCommand('compiler')
-    print(compiler('find'))
-    logger.info("'spack compiler find' has been triggered.")
+    detect_compilers(projectdir, machine)
+    logger.info("Compilers on PATH have been registered.")
 
 
-def spack_external_find():
+def spack_external_find(projectdir, machine=None):
     """
-    Enable spack to find external packages.
+    Enable spack to find external packages, recording them in the private
+    user configuration of projectdir. The detection is cached per platform.
 
     """
-    from spack.main import SpackCommand
-    print('Finding external packages.')
-    external = SpackCommand('external')
-    print(external('find'))
-    logger.info("'spack external find' has been triggered.")
+    detect_externals(projectdir, machine)
+    logger.info("External packages have been registered.")
 
 def spack_license_cleanup():
     """
@@ -65,7 +241,7 @@ def spack_license_cleanup():
     if isdir(spacklicense):
         rmtree(spacklicense)
 
-def cleanup(projectdir, ext=False):
+def cleanup(projectdir, ext=False, policy='failed', failed=None, machine=None):
     """
     Complete Spack cleanup.
 
@@ -75,13 +251,22 @@ def cleanup(projectdir, ext=False):
         Project directory in which to clean up files.
     ext : Boolean, optional
         Turn on external package finder. The default is False.
+    policy : String, optional
+        Cleanup policy, see CLEANUP_POLICIES. The default is 'failed'.
+    failed : List, optional
+        (name, version, DAG hash) of the specs which failed in the previous
+        attempt, see retry.failed_specs.
+    machine : String, optional
+        Platform whose compiler and external detections are reused. The
+        default is $SPACK_CM_MACHINE_NAME.
 
     """
     try:
-        spack_cleanup(projectdir)
-        spack_compiler_find()
-        if ext:
-            spack_external_find()
+        with cleanup_locks(policy, failed):
+            spack_cleanup(projectdir, policy, failed)
+            spack_compiler_find(projectdir, machine)
+            if ext:
+                spack_external_find(projectdir, machine)
         logger.info('Spack cleanup completed.')
     except Exception as e:
         error = 'ERROR: Spack cleanup was unsuccessful with error: \n{}'.format(e)
@@ -0,0 +1,224 @@
+"""
+Detect system compilers (reusing the result while PATH does not change) and
+register the compilers built by spack-cm
+"""
+
+from src.core.utilities import pcolors
+from src.core.backend import spack_command, user_config_dir
+from src.core.journal import spack_commit
+from os import environ, listdir, makedirs, remove, replace, stat, walk, getpid
+from os.path import split, abspath, dirname, isdir, isfile, join, realpath
+from shutil import copyfile
+import hashlib
+import json
+import re
+import threading
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+# Executables 'spack compiler find' looks for, optionally with a version
+# suffix (e.g., gcc-10).
+COMPILER_RE = re.compile(r'^(gcc|g\+\+|gfortran|cc|c\+\+|clang|clang\+\+|flang|'
+                         r'icc|icpc|ifort|icx|icpx|ifx|pgcc|pgc\+\+|pgfortran|'
+                         r'nvc|nvc\+\+|nvfortran|xlc|xlC|xlf|xlf90|armclang|'
+                         r'armclang\+\+|armflang|fcc|FCC|frt)(-[\d.]+)?$')
+
+compilers_lock = threading.Lock()
+
+
+class CompilersException(Exception):
+    """Catch all compiler detection exceptions"""
+    pass
+
+
+def compiler_cache_dir(machine):
+    """
+    Get (and create) the compiler detection cache of a platform.
+
+    """
+    filedir, filename = split(abspath(__file__))
+    path = join(dirname(filedir), 'platform', machine, '.cache')
+    makedirs(path, exist_ok=True)
+    return path
+
+
+def path_fingerprint(path=None, pattern=COMPILER_RE):
+    """
+    Fingerprint the executables reachable through PATH by their location,
+    inode, size and modification time.
+
+    Parameters
+    ----------
+    path : String, optional
+        Search path. The default is $PATH.
+    pattern : re.Pattern, optional
+        Only executables whose name matches are considered. None considers
+        every file. The default is the compiler executables.
+
+    Returns
+    -------
+    fingerprint : String
+        SHA-256 of the executables and the spack commit.
+
+    """
+    sha = hashlib.sha256()
+    sha.update(spack_commit().encode())
+    for directory in (path if path is not None else environ.get('PATH', '')).split(':'):
+        sha.update(('dir:' + directory).encode())
+        if not isdir(directory):
+            continue
+        try:
+            names = sorted(listdir(directory))
+        except OSError:
+            continue
+        for name in names:
+            if pattern is not None and pattern.match(name) is None:
+                continue
+            try:
+                info = stat(join(directory, name))
+            except OSError:
+                continue
+            sha.update('{}:{}:{}:{}'.format(name, info.st_ino, info.st_size,
+                                            info.st_mtime).encode())
+    return sha.hexdigest()
+
+
+def detect_compilers(env=None, machine=None):
+    """
+    Register the compilers found on PATH in the private user scope of a
+    spack environment. 'spack compiler find' only runs when the compilers on
+    PATH changed since the platform's cached detection.
+
+    Parameters
+    ----------
+    env : String, optional
+        Spack environment directory. The default is the scope of this
+        spack-cm run.
+    machine : String, optional
+        Platform whose cache is used. The default is $SPACK_CM_MACHINE_NAME.
+
+    Returns
+    -------
+    compilers : Dictionary
+        Contents of the detected compilers.yaml.
+
+    """
+    machine = machine or environ['SPACK_CM_MACHINE_NAME']
+    fingerprint = path_fingerprint()
+    cachedir = compiler_cache_dir(machine)
+    cache = join(cachedir, 'compilers-{}.yaml'.format(fingerprint))
+    config = user_config_dir(env)
+    makedirs(config, exist_ok=True)
+    with compilers_lock:
+        if isfile(cache):
+            logger.info('Compiler detection cache hit: {}'.format(cache))
+            copyfile(cache, join(config, 'compilers.yaml'))
+        else:
+            logger.info('Compiler detection cache miss. Running spack compiler find.')
+            returncode, output = spack_command(['compiler', 'find', '--scope', 'user'],
+                                               env=env, echo=False)
+            if returncode != 0:
+                error = "ERROR: 'spack compiler find' failed:\n{}".format(output)
+                logger.critical(error)
+                raise CompilersException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+            compilers = []
+            for root, dirs, files in walk(config):
+                if 'compilers.yaml' in files:
+                    with open(join(root, 'compilers.yaml'), 'r') as f:
+                        compilers += (yaml.safe_load(f) or {}).get('compilers', [])
+            with open('{}.{}.tmp'.format(cache, getpid()), 'w') as f:
+                yaml.safe_dump({'compilers': compilers}, f, default_flow_style=False)
+            replace('{}.{}.tmp'.format(cache, getpid()), cache)
+            for name in listdir(cachedir):
+                if name.startswith('compilers-') and name.endswith('.yaml') \
+                        and join(cachedir, name) != cache:
+                    remove(join(cachedir, name))
+    with open(cache, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def installed_compiler_prefixes(install_path, compilers):
+    """
+    Find the install prefixes of built compilers in a spack database.
+
+    Parameters
+    ----------
+    install_path : String
+        Root of the install tree the compilers were built into.
+    compilers : List
+        Compiler specs (e.g., gcc@10.1.0).
+
+    Returns
+    -------
+    prefixes : Dictionary
+        Compiler spec mapped to its install prefix. When a compiler is
+        installed more than once, the latest install is used.
+
+    """
+    index = join(install_path, '.spack-db', 'index.json')
+    installs = {}
+    if isfile(index):
+        with open(index, 'r') as f:
+            installs = json.load(f)['database']['installs']
+    prefixes = {}
+    for compiler in compilers:
+        name, _, version = re.split(r'[+~%\s]', compiler)[0].partition('@')
+        latest = None
+        for record in installs.values():
+            node = record.get('spec', {})
+            if node and 'name' not in node:
+                name_key = list(node.keys())[0]
+                node = dict(node[name_key], name=name_key)
+            node_version = str(node.get('version', ''))
+            if node.get('name') != name or not record.get('installed', True):
+                continue
+            if version and node_version != version and not node_version.startswith(version + '.'):
+                continue
+            if latest is None or record.get('installation_time', 0) > latest.get('installation_time', 0):
+                latest = record
+        if latest is None:
+            error = 'ERROR: Compiler {} is not installed in {}.'.format(compiler, install_path)
+            logger.critical(error)
+            raise CompilersException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        prefixes[compiler] = latest['path']
+    return prefixes
+
+
+def register_compilers(env, prefixes):
+    """
+    Register the compilers installed in the given prefixes with a single
+    'spack compiler find'.
+
+    Parameters
+    ----------
+    env : String
+        Spack environment directory whose private user scope receives the
+        compilers.
+    prefixes : List
+        Install prefixes of the compilers.
+
+    Returns
+    -------
+    compilers : List
+        Entries of compilers.yaml for the compilers in those prefixes.
+
+    """
+    prefixes = list(prefixes)
+    returncode, output = spack_command(['compiler', 'find', '--scope', 'user']
+                                       + prefixes, env=env)
+    if returncode != 0:
+        error = "ERROR: 'spack compiler find' failed for {}.".format(', '.join(prefixes))
+        logger.critical(error)
+        raise CompilersException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    roots = [realpath(prefix) for prefix in prefixes]
+    compilers = []
+    for root, dirs, files in walk(user_config_dir(env)):
+        if 'compilers.yaml' not in files:
+            continue
+        with open(join(root, 'compilers.yaml'), 'r') as f:
+            for compiler in (yaml.safe_load(f) or {}).get('compilers', []):
+                paths = [realpath(path) for path in compiler['compiler'].get('paths', {}).values() if path]
+                if any(path.startswith(prefix + '/') for path in paths for prefix in roots):
+                    compilers.append(compiler)
+    return compilers
@@ -0,0 +1,256 @@
+"""
+Settings of a project/machine install, parsed once from its manifest
+"""
+
+from src.core.utilities import install_paths, pcolors
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from os import environ, stat
+from os.path import split, abspath, dirname, join
+import threading
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+# Contexts already parsed, keyed on their arguments and manifest.
+contexts = {}
+contexts_lock = threading.Lock()
+
+# Keys of the manifest defaulting to the system compiler when empty.
+SYSTEM_COMPILER_DEFAULTS = ['SPACK_CM_UTILITY_COMPILER', 'SPACK_CM_BASE_COMPILER']
+
+
+# Install tree of each stage, relative to the install path.
+STAGE_DIRECTORIES = {'compiler_install_path': 'compiler',
+                     'utility_install_path': 'utility',
+                     'tpl_install_path': 'tpl',
+                     'base_packages_install_path': 'base-packages',
+                     'lmod_install_path': 'lmod'}
+
+
+class ContextException(Exception):
+    """Catch all context exceptions"""
+    pass
+
+
+def split_setting(value):
+    """
+    Split a comma-joined setting into its values, like env_var_list.
+
+    """
+    if len(value) > 1:
+        return tuple(value.split(', '))
+    return (value,)
+
+
+@dataclass(frozen=True)
+class ProjectContext:
+    """
+    Immutable settings of one project/machine install: its names, install
+    and modulefile roots, system compiler and manifest. Generators take a
+    context instead of reading os.environ, so several projects or machines
+    can be handled in one process.
+
+    """
+    project: str
+    machine: str
+    install_path: str
+    module_path: str
+    system_compiler: str = ''
+    manifest: Tuple[Tuple[str, Tuple[str, ...]], ...] = ()
+    # Install trees of the stages, below install_path unless given.
+    compiler_install_path: str = ''
+    utility_install_path: str = ''
+    tpl_install_path: str = ''
+    base_packages_install_path: str = ''
+    lmod_install_path: str = ''
+    # Build jobs of every spack install, spack's own setting when None.
+    build_jobs: Optional[int] = None
+
+    def __post_init__(self):
+        for name, directory in STAGE_DIRECTORIES.items():
+            if not getattr(self, name):
+                object.__setattr__(self, name, join(self.install_path, directory))
+
+    def values(self, name: str, default: Optional[List[str]] = None) -> List[str]:
+        """
+        Values of a manifest entry, [''] when empty, like env_var_list.
+        Entries missing from the manifest are an error unless a default is
+        given.
+
+        """
+        for key, values in self.manifest:
+            if key == name:
+                return list(values)
+        if default is not None:
+            return list(default)
+        error = 'ERROR: {} is not set in the manifest of project {}.'.format(name, self.project)
+        logger.critical(error)
+        raise ContextException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+
+    def value(self, name: str) -> str:
+        """
+        Setting as it is exported to the environment, e.g.,
+        SPACK_CM_TPL_INSTALL_PATH or a comma-joined manifest entry.
+
+        """
+        environment = self.environment()
+        if name not in environment:
+            return ', '.join(self.values(name))
+        return environment[name]
+
+    def environment(self) -> Dict[str, str]:
+        """
+        Variables exported by export_env_vars for this context.
+
+        """
+        filedir, file = split(abspath(__file__))
+        projectdir = join(dirname(filedir), 'project/{}'.format(self.project))
+        environment = {'SPACK_CM_PROJECT_REPO': join(projectdir, '/repos.yaml'),
+                       'SPACK_CM_PROJECT_NAME': self.project,
+                       'SPACK_CM_MACHINE_NAME': self.machine,
+                       'SPACK_CM_INSTALL_PATH': self.install_path,
+                       'SPACK_CM_MODULEFILES_PATH': self.module_path,
+                       'SPACK_CM_COMPILER_INSTALL_PATH': self.compiler_install_path,
+                       'SPACK_CM_UTILITY_INSTALL_PATH': self.utility_install_path,
+                       'SPACK_CM_TPL_INSTALL_PATH': self.tpl_install_path,
+                       'SPACK_CM_BASE_PACKAGES_INSTALL_PATH': self.base_packages_install_path,
+                       'SPACK_CM_LMOD_INSTALL_PATH': self.lmod_install_path,
+                       'SYSTEM_COMPILER': self.system_compiler}
+        for key, values in self.manifest:
+            environment[key] = ', '.join(values)
+        return environment
+
+    def export(self):
+        """
+        Export the context to os.environ, for the code and tools still
+        reading it.
+
+        """
+        environ.update(self.environment())
+
+    @classmethod
+    def from_environ(cls) -> 'ProjectContext':
+        """
+        Context of the variables already exported to os.environ.
+
+        """
+        manifest = tuple((key, split_setting(value)) for key, value in sorted(environ.items())
+                         if key.startswith('SPACK_CM_') and not key.endswith('_PATH')
+                         and key not in ['SPACK_CM_PROJECT_REPO', 'SPACK_CM_PROJECT_NAME',
+                                         'SPACK_CM_MACHINE_NAME', 'SPACK_CM_BUILD_JOBS'])
+        return cls(project=environ.get('SPACK_CM_PROJECT_NAME', ''),
+                   machine=environ.get('SPACK_CM_MACHINE_NAME', ''),
+                   install_path=environ.get('SPACK_CM_INSTALL_PATH', ''),
+                   module_path=environ.get('SPACK_CM_MODULEFILES_PATH', ''),
+                   system_compiler=environ.get('SYSTEM_COMPILER', ''),
+                   manifest=manifest,
+                   build_jobs=int(environ['SPACK_CM_BUILD_JOBS'])
+                   if environ.get('SPACK_CM_BUILD_JOBS') else None,
+                   **{name: environ.get('SPACK_CM_' + name.upper(), '')
+                      for name in STAGE_DIRECTORIES})
+
+
+def current_context(context: Optional[ProjectContext] = None) -> ProjectContext:
+    """
+    The given context or, for backward compatibility, the one exported to
+    os.environ.
+
+    """
+    if context is not None:
+        return context
+    return ProjectContext.from_environ()
+
+
+def parse_manifest(contents, system_compiler):
+    """
+    Normalize the entries of a project manifest.
+
+    Parameters
+    ----------
+    contents : Dictionary
+        Contents of <project>-manifest.yaml.
+    system_compiler : String
+        Compiler used for empty compiler entries.
+
+    Returns
+    -------
+    manifest : Tuple
+        (key, values) of each entry, see ProjectContext.
+
+    """
+    manifest = {}
+    for key in contents:
+        if key in SYSTEM_COMPILER_DEFAULTS and (not contents[key] or contents[key][0] == ''):
+            manifest[key] = (system_compiler,)
+        elif contents[key] == '' or contents[key] is None:
+            manifest[key] = ('',)
+        else:
+            manifest[key] = split_setting(', '.join(contents[key]))
+    if manifest.get('SPACK_CM_COMPILERS', ('',)) == ('',) and \
+            manifest.get('SPACK_CM_EXTERNAL_COMPILERS', ('',)) == ('',):
+        manifest['SPACK_CM_EXTERNAL_COMPILERS'] = (system_compiler,)
+    return tuple(sorted(manifest.items()))
+
+
+def load_context(project, machine, root_path, machine_path,
+                 explicit_install_path, explicit_modulefiles_path,
+                 system_compiler=None):
+    """
+    Parse the manifest of a project into its context. Contexts are cached
+    until the manifest changes.
+
+    Parameters
+    ----------
+    project : String
+        Project being installed.
+    machine : String
+        Platform being installed on.
+    root_path : String
+        Install/modulefile root path.
+    machine_path: Boolean
+        Add the machine name to the install path.
+    explicit_install_path: String
+        Use exactly this path for the package installations
+    explicit_modulefiles_path: String
+        Use exactly this path for modulefile installations
+    system_compiler : String, optional
+        Spec of the system compiler. The default is detected by spack.
+
+    Returns
+    -------
+    context : ProjectContext
+        Context of the project/machine.
+
+    """
+    install_path, module_path = install_paths(project, machine, root_path,
+                                              machine_path, explicit_install_path,
+                                              explicit_modulefiles_path)
+    filedir, file = split(abspath(__file__))
+    projectmanifest = join(dirname(filedir), 'project/{}'.format(project),
+                           '{}-manifest.yaml'.format(project))
+    try:
+        info = stat(projectmanifest)
+    except OSError as e:
+        error = 'ERROR: Unable to read the manifest {}: {}'.format(projectmanifest, e)
+        logger.critical(error)
+        raise ContextException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    key = (project, machine, install_path, module_path, system_compiler,
+           info.st_mtime_ns, info.st_size)
+    with contexts_lock:
+        if key in contexts:
+            return contexts[key]
+    if system_compiler is None:
+        # Find the system compiler in the private user scope of this run,
+        # leaving the user's ~/.spack alone.
+        from src.core.compilers import detect_compilers
+        system_compiler = detect_compilers(machine=machine)['compilers'][0]['compiler']['spec']
+    with open(projectmanifest, 'r') as f:
+        contents = yaml.full_load(f)
+    context = ProjectContext(project=project, machine=machine,
+                             install_path=install_path, module_path=module_path,
+                             system_compiler=system_compiler,
+                             manifest=parse_manifest(contents, system_compiler))
+    with contexts_lock:
+        contexts[key] = context
+    return context
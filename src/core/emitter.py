@@ -0,0 +1,144 @@
+"""
+Write spack YAML files in a single pass with the quoting spack needs
+"""
+
+from src.core.utilities import pcolors
+from os import getpid, replace
+from os.path import isfile
+import hashlib
+import json
+import re
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+# Strings written without quotes. Anything else (leading '%', '{' or '*',
+# spaces, flow indicators...) is double-quoted.
+PLAIN_RE = re.compile(r'^[A-Za-z0-9_./$~][A-Za-z0-9_./$~@%^+=:-]*$')
+
+resolver = yaml.resolver.Resolver()
+
+
+class EmitterException(Exception):
+    """Catch all YAML emitter exceptions"""
+    pass
+
+
+def scalar(value):
+    """
+    Format a scalar, quoting strings which YAML would otherwise misread
+    (e.g., "{name}", "%gcc", "10" or "true").
+
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if not isinstance(value, str):
+        error = 'ERROR: Unable to write {!r} to a spack YAML file.'.format(value)
+        logger.critical(error)
+        raise EmitterException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    if value == '':
+        return "''"
+    if PLAIN_RE.match(value) and not value.endswith(':') \
+            and resolver.resolve(yaml.ScalarNode, value, (True, False)) == 'tag:yaml.org,2002:str':
+        return value
+    return json.dumps(value)
+
+
+def is_flow(value):
+    """
+    Lists of scalars nested in a list (e.g., the rows of a spack matrix) are
+    written in flow style, [a, b].
+
+    """
+    return isinstance(value, list) and all(not isinstance(item, (list, dict)) for item in value)
+
+
+def emit(value, indent=0):
+    """
+    Generate the lines of the block YAML of a value, laid out like
+    yaml.dump: two space indents and sequences not indented under their key.
+
+    Parameters
+    ----------
+    value : Dictionary, List or scalar
+        Value to write.
+    indent : Integer, optional
+        Number of spaces before each line. The default is 0.
+
+    Yields
+    ------
+    line : String
+        Next line, without its newline.
+
+    """
+    pad = ' ' * indent
+    if isinstance(value, dict):
+        if not value:
+            yield pad + '{}'
+            return
+        for key, item in value.items():
+            if isinstance(item, dict) and item:
+                yield pad + scalar(key) + ':'
+                yield from emit(item, indent + 2)
+            elif isinstance(item, list) and item:
+                yield pad + scalar(key) + ':'
+                yield from emit(item, indent)
+            else:
+                yield pad + scalar(key) + ': ' + next(emit(item))
+    elif isinstance(value, list):
+        if not value:
+            yield pad + '[]'
+            return
+        for item in value:
+            if isinstance(item, list) and item and is_flow(item):
+                yield pad + '- [' + ', '.join(scalar(element) for element in item) + ']'
+            elif isinstance(item, (list, dict)) and item:
+                lines = emit(item, indent + 2)
+                yield pad + '- ' + next(lines)[indent + 2:]
+                yield from lines
+            else:
+                yield pad + '- ' + next(emit(item))
+    else:
+        yield pad + scalar(value)
+
+
+def dumps(contents):
+    """
+    Format a spack YAML document.
+
+    """
+    return ''.join(line + '\n' for line in emit(contents))
+
+
+def write_yaml(file, contents):
+    """
+    Write a spack YAML file atomically. The file is left untouched when its
+    contents would not change, so spack's caches keyed on it stay valid.
+
+    Parameters
+    ----------
+    file : String
+        Path and name of output file.
+    contents : Dictionary
+        Contents to write.
+
+    Returns
+    -------
+    written : Boolean
+        Whether the file was written.
+
+    """
+    data = dumps(contents).encode()
+    if isfile(file):
+        with open(file, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                logger.info('{} is unchanged.'.format(file))
+                return False
+    with open('{}.{}.tmp'.format(file, getpid()), 'wb') as f:
+        f.write(data)
+    replace('{}.{}.tmp'.format(file, getpid()), file)
+    return True
@@ -0,0 +1,91 @@
+"""
+Detect external packages once per run and reuse the result while the
+system does not change
+"""
+
+from src.core.utilities import pcolors
+from src.core.backend import spack_command, user_config_dir
+from src.core.compilers import compiler_cache_dir, path_fingerprint
+from os import environ, listdir, makedirs, remove, replace, walk, getpid
+from os.path import isfile, join
+from shutil import copyfile
+import threading
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+externals_lock = threading.Lock()
+
+# Fingerprint of each PATH already probed by this run.
+fingerprints = {}
+
+
+class ExternalsException(Exception):
+    """Catch all external detection exceptions"""
+    pass
+
+
+def externals_fingerprint():
+    """
+    Fingerprint every executable on PATH, computed once per run and PATH.
+
+    """
+    path = environ.get('PATH', '')
+    if path not in fingerprints:
+        fingerprints[path] = path_fingerprint(path, pattern=None)
+    return fingerprints[path]
+
+
+def detect_externals(env=None, machine=None):
+    """
+    Write the external packages found on the system as the packages.yaml of
+    the private user scope of a spack environment. 'spack external find'
+    only runs when the executables on PATH changed since the platform's
+    cached detection.
+
+    Parameters
+    ----------
+    env : String, optional
+        Spack environment directory. The default is the scope of this
+        spack-cm run.
+    machine : String, optional
+        Platform whose cache is used. The default is $SPACK_CM_MACHINE_NAME.
+
+    Returns
+    -------
+    packages : Dictionary
+        Contents of the detected packages.yaml.
+
+    """
+    machine = machine or environ['SPACK_CM_MACHINE_NAME']
+    cachedir = compiler_cache_dir(machine)
+    cache = join(cachedir, 'packages-{}.yaml'.format(externals_fingerprint()))
+    config = user_config_dir(env)
+    makedirs(config, exist_ok=True)
+    with externals_lock:
+        if isfile(cache):
+            logger.info('External detection cache hit: {}'.format(cache))
+        else:
+            logger.info('External detection cache miss. Running spack external find.')
+            print('Finding external packages.')
+            returncode, output = spack_command(['external', 'find', '--scope', 'user'],
+                                               env=env)
+            if returncode != 0:
+                error = "ERROR: 'spack external find' failed:\n{}".format(output)
+                logger.critical(error)
+                raise ExternalsException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+            packages = {}
+            for root, dirs, files in walk(config):
+                if 'packages.yaml' in files:
+                    with open(join(root, 'packages.yaml'), 'r') as f:
+                        packages.update((yaml.safe_load(f) or {}).get('packages', {}))
+            with open('{}.{}.tmp'.format(cache, getpid()), 'w') as f:
+                yaml.safe_dump({'packages': packages}, f, default_flow_style=False)
+            replace('{}.{}.tmp'.format(cache, getpid()), cache)
+            for name in listdir(cachedir):
+                if name.startswith('packages-') and name.endswith('.yaml') \
+                        and join(cachedir, name) != cache:
+                    remove(join(cachedir, name))
+        copyfile(cache, join(config, 'packages.yaml'))
+    with open(cache, 'r') as f:
+        return yaml.safe_load(f)
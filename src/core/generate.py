@@ -2,21 +2,38 @@
 Generate necessary Spack YAML files
 """
 
-from src.core.utilities import (env_var_list, replace_single_quotes,
-                                generate_file, export_env_vars,
-                                pcolors)
-from os.path import split, abspath, dirname
-from os import environ
+from src.core.utilities import export_env_vars, pcolors
+from src.core.context import current_context
+from src.core.emitter import write_yaml
+from src.core.matrix import expand_specs
+from os.path import split, abspath, dirname, isfile, join
+from os import getpid, remove, replace
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
 logger = logging.getLogger(__name__)
 
+# Index of the single stacks generated in a project directory.
+STACKS_INDEX = 'stacks.json'
+STACKS_INDEX_VERSION = 1
+
 
 class GenerateException(Exception):
     """Catch all generation exceptions"""
     pass
 
 
-def spack_base_package_yaml(project):
+def definition(values):
+    """
+    Values of a spack definition. Empty manifest entries are written as
+    null.
+
+    """
+    return [value or None for value in values]
+
+
+def spack_base_package_yaml(project, context=None):
     """
     Generate base packages YAML file.
 
@@ -24,37 +41,39 @@ def spack_base_package_yaml(project):
     ----------
     project : String
         Project for which to generate this file.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
-    SPACK_CM_BASE_PACKAGES = env_var_list('SPACK_CM_BASE_PACKAGES')
-    SPACK_CM_BASE_COMPILER = env_var_list('SPACK_CM_BASE_COMPILER')
-    INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
+    context = current_context(context)
+    SPACK_CM_BASE_PACKAGES = context.values('SPACK_CM_BASE_PACKAGES')
+    SPACK_CM_BASE_COMPILER = context.values('SPACK_CM_BASE_COMPILER')
+    INSTALL_PATH = context.base_packages_install_path
+    MACHINE = context.machine
+    PROJECT = context.project
+    MODULE_ROOT = context.module_path
     contents = {'spack' :
                 {'include' : ['../../project/{}/repos.yaml'.format(PROJECT),
                               '../../project/{}/packages.yaml'.format(PROJECT),
                               '../../platform/{}/packages.yaml'.format(MACHINE),
                               '../../platform/{}/mirrors.yaml'.format(MACHINE),
                               '../../platform/{}/compilers.yaml'.format(MACHINE)],
-                 'definitions' : [{'core_compiler' : SPACK_CM_BASE_COMPILER},
-                                  {'base_packages' : SPACK_CM_BASE_PACKAGES}],
-                 'specs' : [{'matrix' : [ '[$base_packages]' , '[$%core_compiler]' ] }],
+                 'definitions' : [{'core_compiler' : definition(SPACK_CM_BASE_COMPILER)},
+                                  {'base_packages' : definition(SPACK_CM_BASE_PACKAGES)}],
+                 'specs' : [{'matrix' : [ ['$base_packages'] , ['$%core_compiler'] ] }],
                  'config' : {'install_tree' :
                              {'root' : INSTALL_PATH,
-                              'projections': {'all': '"{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}"'}},
+                              'projections': {'all': '{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}'}},
                                  'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
                                  'install_missing_compilers' : True },
                      'view' : False}}
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
     filename = projectdir + '/base-packages-spack.yaml'
-    generate_file(filename, contents)
-    replace_single_quotes(filename)
+    write_yaml(filename, contents)
 
 
-def spack_lmod_yaml(project):
+def spack_lmod_yaml(project, context=None):
     """
     Generate LMOD YAML file.
 
@@ -62,13 +81,16 @@ def spack_lmod_yaml(project):
     ----------
     project : String
         Project for which to generate this file.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    INSTALL_PATH = environ['SPACK_CM_LMOD_INSTALL_PATH']
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
+    context = current_context(context)
+    BP_INSTALL_PATH = context.base_packages_install_path
+    INSTALL_PATH = context.lmod_install_path
+    MACHINE = context.machine
+    PROJECT = context.project
+    MODULE_ROOT = context.module_path
     contents = {'spack' :
                 {'include' : ['{}/packages.yaml'.format(BP_INSTALL_PATH),
                               '../../project/{}/repos.yaml'.format(PROJECT),
@@ -86,10 +108,10 @@ def spack_lmod_yaml(project):
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
     filename = projectdir + '/lmod-spack.yaml'
-    generate_file(filename, contents)
+    write_yaml(filename, contents)
 
 
-def spack_compilers_yaml(project, projmod):
+def spack_compilers_yaml(project, projmod, context=None):
     """
     Generate compilers YAML file.
 
@@ -97,15 +119,18 @@ def spack_compilers_yaml(project, projmod):
     ----------
     project : String
         Project for which to generate this file.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    SPACK_CM_BASE_COMPILER = environ['SPACK_CM_BASE_COMPILER']
-    SPACK_CM_COMPILERS = env_var_list('SPACK_CM_COMPILERS')
-    INSTALL_PATH = environ['SPACK_CM_COMPILER_INSTALL_PATH']
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
+    context = current_context(context)
+    BP_INSTALL_PATH = context.base_packages_install_path
+    SPACK_CM_BASE_COMPILER = context.value('SPACK_CM_BASE_COMPILER')
+    SPACK_CM_COMPILERS = context.values('SPACK_CM_COMPILERS')
+    INSTALL_PATH = context.compiler_install_path
+    MACHINE = context.machine
+    PROJECT = context.project
+    MODULE_ROOT = context.module_path
     contents = {'spack' :
                 {'include' : ['{}/packages.yaml'.format(BP_INSTALL_PATH),
                               '../../project/{}/repos.yaml'.format(PROJECT),
@@ -113,12 +138,12 @@ def spack_compilers_yaml(project, projmod):
                               '../../platform/{}/packages.yaml'.format(MACHINE),
                               '../../platform/{}/mirrors.yaml'.format(MACHINE),
                               '../../platform/{}/compilers.yaml'.format(MACHINE)],
-                 'definitions' : [{'core_compiler' : [SPACK_CM_BASE_COMPILER]},
-                                  {'compilers_to_build' : SPACK_CM_COMPILERS}],
-                 'specs' : [{'matrix' : [ '[$compilers_to_build]' , '[$%core_compiler]' ] }],
+                 'definitions' : [{'core_compiler' : definition([SPACK_CM_BASE_COMPILER])},
+                                  {'compilers_to_build' : definition(SPACK_CM_COMPILERS)}],
+                 'specs' : [{'matrix' : [ ['$compilers_to_build'] , ['$%core_compiler'] ] }],
                  'config' : {'install_tree' :
                              {'root' : INSTALL_PATH,
-                              'projections': {'all': '"{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}"'}},
+                              'projections': {'all': '{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}'}},
                                  'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
                                  'install_missing_compilers' : False },
                   'view' : False,
@@ -132,32 +157,31 @@ def spack_compilers_yaml(project, projmod):
                                                      'lib/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'lib64/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'share/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     '?' : ['CMAKE_PREFIX_PATH']},
+                                                     '' : ['CMAKE_PREFIX_PATH']},
                              'lmod' : {'hash_length' : 0,
-                                       'core_specs' : SPACK_CM_COMPILERS + [SPACK_CM_BASE_COMPILER],
-                                       'whitelist' : '{}'.format(SPACK_CM_COMPILERS + [SPACK_CM_BASE_COMPILER]),
+                                       'core_specs' : definition(SPACK_CM_COMPILERS + [SPACK_CM_BASE_COMPILER]),
+                                       'whitelist' : [c for c in SPACK_CM_COMPILERS + [SPACK_CM_BASE_COMPILER] if c],
                                        'blacklist_implicits' : True,
-                                       'all' : {'conflict': ['"{name}"'],
-                                                'environment': {'set': {'"{name}_ROOT"' : '"{prefix}"',
-                                                                        '"{name}_VERSION"' : '"{version}"',
-                                                                        '"{name}_BIN"' : '"{prefix.bin}"',
-                                                                        '"{name}_INC"' : '"{prefix.include}"',
-                                                                        '"{name}_LIB"' : '"{prefix.lib}"'}}},
+                                       'all' : {'conflict': ['{name}'],
+                                                'environment': {'set': {'{name}_ROOT' : '{prefix}',
+                                                                        '{name}_VERSION' : '{version}',
+                                                                        '{name}_BIN' : '{prefix.bin}',
+                                                                        '{name}_INC' : '{prefix.include}',
+                                                                        '{name}_LIB' : '{prefix.lib}'}}},
                                        'projections' : {'all' : ''},
                                        'verbose' : True}}
                       }}
     if projmod:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{}-{{name}}/{{version}}"'.format(project)
+        contents['spack']['modules']['lmod']['projections']['all'] = '{}-{{name}}/{{version}}'.format(project)
     else:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{name}/{version}"'
+        contents['spack']['modules']['lmod']['projections']['all'] = '{name}/{version}'
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
     filename = projectdir + '/compilers-spack.yaml'
-    generate_file(filename, contents)
-    replace_single_quotes(filename)
+    write_yaml(filename, contents)
 
 
-def spack_utilities_yaml(project, projmod):
+def spack_utilities_yaml(project, projmod, context=None):
     """
     Generate utilities YAML file.
 
@@ -165,17 +189,20 @@ def spack_utilities_yaml(project, projmod):
     ----------
     project : String
         Project for which to generate this file.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    C_INSTALL_PATH = environ['SPACK_CM_COMPILER_INSTALL_PATH']
-    SPACK_CM_COMPILERS = env_var_list('SPACK_CM_COMPILERS')
-    SPACK_CM_UTILITIES = env_var_list('SPACK_CM_UTILITIES')
-    SPACK_CM_UTILITY_COMPILER = environ['SPACK_CM_UTILITY_COMPILER']
-    INSTALL_PATH = environ['SPACK_CM_UTILITY_INSTALL_PATH']
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
+    context = current_context(context)
+    BP_INSTALL_PATH = context.base_packages_install_path
+    C_INSTALL_PATH = context.compiler_install_path
+    SPACK_CM_COMPILERS = context.values('SPACK_CM_COMPILERS')
+    SPACK_CM_UTILITIES = context.values('SPACK_CM_UTILITIES')
+    SPACK_CM_UTILITY_COMPILER = context.value('SPACK_CM_UTILITY_COMPILER')
+    INSTALL_PATH = context.utility_install_path
+    MACHINE = context.machine
+    PROJECT = context.project
+    MODULE_ROOT = context.module_path
     contents = {'spack' :
                 {'include' : ['{}/packages.yaml'.format(BP_INSTALL_PATH),
                               '../../project/{}/repos.yaml'.format(PROJECT),
@@ -183,13 +210,13 @@ def spack_utilities_yaml(project, projmod):
                               '../../platform/{}/packages.yaml'.format(MACHINE),
                               '../../platform/{}/mirrors.yaml'.format(MACHINE),
                               '../../platform/{}/compilers.yaml'.format(MACHINE)],
-                 'definitions' : [{'core_compiler' : [SPACK_CM_UTILITY_COMPILER]},
-                                  {'utility_packages' : SPACK_CM_UTILITIES}],
-                 'specs' : [{'matrix' : [ '[$utility_packages]' , '[$%core_compiler]' ] }],
+                 'definitions' : [{'core_compiler' : definition([SPACK_CM_UTILITY_COMPILER])},
+                                  {'utility_packages' : definition(SPACK_CM_UTILITIES)}],
+                 'specs' : [{'matrix' : [ ['$utility_packages'] , ['$%core_compiler'] ] }],
                  'config' : {'install_tree' :
                              {'root' : INSTALL_PATH,
-                              'projections': {'^mpi': '"{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}"',
-                                              'all': '"{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}"'}},
+                              'projections': {'^mpi': '{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}',
+                                              'all': '{name}/{version}/{compiler.name}/{compiler.version}/{hash:7}'}},
                                  'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
                                  'install_missing_compilers' : False },
                  'view' : False,
@@ -203,35 +230,73 @@ def spack_utilities_yaml(project, projmod):
                                                      'lib/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'lib64/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'share/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     '?' : ['CMAKE_PREFIX_PATH']},
+                                                     '' : ['CMAKE_PREFIX_PATH']},
                               'lmod' : {'hash_length' : 0,
                                        'core_compilers' : [SPACK_CM_UTILITY_COMPILER],
                                        'core_specs' : SPACK_CM_UTILITIES ,
-                                       'whitelist' : '{}'.format(SPACK_CM_UTILITIES),
+                                       'whitelist' : [u for u in SPACK_CM_UTILITIES if u],
                                        'blacklist_implicits' : True,
-                                       'all' : {'conflict': ['"{name}"'],
-                                                'environment': {'set': {'"{name}_ROOT"' : '"{prefix}"',
-                                                                        '"{name}_VERSION"' : '"{version}"',
-                                                                        '"{name}_BIN"' : '"{prefix.bin}"',
-                                                                        '"{name}_INC"' : '"{prefix.include}"',
-                                                                        '"{name}_LIB"' : '"{prefix.lib}"'}}},
+                                       'all' : {'conflict': ['{name}'],
+                                                'environment': {'set': {'{name}_ROOT' : '{prefix}',
+                                                                        '{name}_VERSION' : '{version}',
+                                                                        '{name}_BIN' : '{prefix.bin}',
+                                                                        '{name}_INC' : '{prefix.include}',
+                                                                        '{name}_LIB' : '{prefix.lib}'}}},
                                        'projections' : {'all' : ''},
                                        'verbose' : True}}
                       }}
     if SPACK_CM_COMPILERS != ['']:
         contents['spack']['include'].insert(1, '{}/compilers.yaml'.format(C_INSTALL_PATH))
     if projmod:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{}-{{name}}/{{version}}"'.format(project)
+        contents['spack']['modules']['lmod']['projections']['all'] = '{}-{{name}}/{{version}}'.format(project)
     else:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{name}/{version}"'
+        contents['spack']['modules']['lmod']['projections']['all'] = '{name}/{version}'
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
     filename = projectdir + '/utilities-spack.yaml'
-    generate_file(filename, contents)
-    replace_single_quotes(filename)
+    write_yaml(filename, contents)
 
 
-def spack_tpl_yaml(project, projmod):
+def tpl_matrices(context=None):
+    """
+    Rows of the matrices of the TPL stack, in the order of its specs: the
+    cudas, the MPIs, then the TPLs, each built with every compiler and
+    against every MPI and cuda.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    matrices : List
+        Rows of each matrix, see matrix.expand_matrix.
+
+    """
+    context = current_context(context)
+    SPACK_CM_COMPILERS = context.values('SPACK_CM_COMPILERS')
+    SPACK_CM_EXTERNAL_COMPILERS = context.values('SPACK_CM_EXTERNAL_COMPILERS')
+    COMPILERS = ['%' + c for c in SPACK_CM_COMPILERS + SPACK_CM_EXTERNAL_COMPILERS if c]
+    SPACK_CM_MPIS = context.values('SPACK_CM_MPIS')
+    SPACK_CM_EXTERNAL_MPIS = context.values('SPACK_CM_EXTERNAL_MPIS')
+    MPIS = [c for c in SPACK_CM_MPIS + SPACK_CM_EXTERNAL_MPIS if c]
+    SPACK_CM_CUDAS = context.values('SPACK_CM_CUDAS')
+    SPACK_CM_EXTERNAL_CUDAS = context.values('SPACK_CM_EXTERNAL_CUDAS')
+    CUDAS = [c for c in SPACK_CM_CUDAS + SPACK_CM_EXTERNAL_CUDAS if c]
+    SPACK_CM_TPLS = [c for c in context.values('SPACK_CM_TPLS') if c]
+    matrices = [[SPACK_CM_TPLS, COMPILERS]]
+    if MPIS:
+        matrices.insert(0, [MPIS, COMPILERS])
+        matrices[-1].append(['^' + c for c in MPIS])
+    if CUDAS:
+        matrices.insert(0, [CUDAS, COMPILERS])
+        for rows in matrices[1:]:
+            rows.append(['^' + c for c in CUDAS])
+    return matrices
+
+
+def spack_tpl_yaml(project, projmod, expand_matrix=False, context=None):
     """
     Generate TPL YAML file.
 
@@ -239,27 +304,33 @@ def spack_tpl_yaml(project, projmod):
     ----------
     project : String
         Project for which to generate this file.
+    expand_matrix : Boolean, optional
+        List the specs left once SPACK_CM_EXCLUDE_COMBOS is applied instead
+        of the matrices and their exclude rules. The default is False.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
-    INSTALL_PATH = environ['SPACK_CM_TPL_INSTALL_PATH']
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    C_INSTALL_PATH = environ['SPACK_CM_COMPILER_INSTALL_PATH']
-    U_INSTALL_PATH = environ['SPACK_CM_UTILITY_INSTALL_PATH']
-    SPACK_CM_UTILITY_COMPILER = environ['SPACK_CM_UTILITY_COMPILER']
-    SPACK_CM_COMPILERS = env_var_list('SPACK_CM_COMPILERS')
-    SPACK_CM_EXTERNAL_COMPILERS = env_var_list('SPACK_CM_EXTERNAL_COMPILERS')
+    context = current_context(context)
+    INSTALL_PATH = context.tpl_install_path
+    BP_INSTALL_PATH = context.base_packages_install_path
+    C_INSTALL_PATH = context.compiler_install_path
+    U_INSTALL_PATH = context.utility_install_path
+    SPACK_CM_UTILITY_COMPILER = context.value('SPACK_CM_UTILITY_COMPILER')
+    SPACK_CM_COMPILERS = context.values('SPACK_CM_COMPILERS')
+    SPACK_CM_EXTERNAL_COMPILERS = context.values('SPACK_CM_EXTERNAL_COMPILERS')
     COMPILERS = [c for c in SPACK_CM_COMPILERS + SPACK_CM_EXTERNAL_COMPILERS if c]
-    SPACK_CM_MPIS = env_var_list('SPACK_CM_MPIS')
-    SPACK_CM_EXTERNAL_MPIS = env_var_list('SPACK_CM_EXTERNAL_MPIS')
+    SPACK_CM_MPIS = context.values('SPACK_CM_MPIS')
+    SPACK_CM_EXTERNAL_MPIS = context.values('SPACK_CM_EXTERNAL_MPIS')
     MPIS = [c for c in SPACK_CM_MPIS + SPACK_CM_EXTERNAL_MPIS if c]
-    SPACK_CM_CUDAS = env_var_list('SPACK_CM_CUDAS')
-    SPACK_CM_EXTERNAL_CUDAS = env_var_list('SPACK_CM_EXTERNAL_CUDAS')
+    SPACK_CM_CUDAS = context.values('SPACK_CM_CUDAS')
+    SPACK_CM_EXTERNAL_CUDAS = context.values('SPACK_CM_EXTERNAL_CUDAS')
     CUDAS = [c for c in SPACK_CM_CUDAS + SPACK_CM_EXTERNAL_CUDAS if c]
-    SPACK_CM_TPLS = env_var_list('SPACK_CM_TPLS')
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
-    EXCLUDE = env_var_list('SPACK_CM_EXCLUDE_COMBOS')
+    SPACK_CM_TPLS = context.values('SPACK_CM_TPLS')
+    MACHINE = context.machine
+    PROJECT = context.project
+    MODULE_ROOT = context.module_path
+    EXCLUDE = context.values('SPACK_CM_EXCLUDE_COMBOS')
     contents = {'spack' :
                 {'include' : ['{}/packages.yaml'.format(BP_INSTALL_PATH),
                               '{}/packages.yaml'.format(U_INSTALL_PATH),
@@ -269,12 +340,12 @@ def spack_tpl_yaml(project, projmod):
                               '../../platform/{}/mirrors.yaml'.format(MACHINE),
                               '../../platform/{}/compilers.yaml'.format(MACHINE)],
                  'definitions' : [{'compilers' : COMPILERS},
-                                  {'packages' : SPACK_CM_TPLS}],
-                 'specs' : [{'matrix' : [ '[$packages]' , '[$%compilers]']}],
+                                  {'packages' : definition(SPACK_CM_TPLS)}],
+                 'specs' : [{'matrix' : [ ['$packages'] , ['$%compilers']]}],
                  'config' : {'install_tree' :
                              {'root' : INSTALL_PATH,
-                              'projections': {'^mpi': '"{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}"',
-                                              'all': '"{name}/{version}/{compiler.name}/{compiler.version}/base/{hash:7}"'}},
+                              'projections': {'^mpi': '{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}',
+                                              'all': '{name}/{version}/{compiler.name}/{compiler.version}/base/{hash:7}'}},
                                  'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
                                  'install_missing_compilers' : False },
                  'view' : False,
@@ -288,7 +359,7 @@ def spack_tpl_yaml(project, projmod):
                                                      'lib/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'lib64/pkgconfig' : ['PKG_CONFIG_PATH'],
                                                      'share/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     '?' : ['CMAKE_PREFIX_PATH']},
+                                                     '' : ['CMAKE_PREFIX_PATH']},
                              'lmod' : {'core_compilers' : [SPACK_CM_UTILITY_COMPILER],
                                        'core_specs' : COMPILERS,
                                        'hierarchy' : ['mpi'],
@@ -296,12 +367,12 @@ def spack_tpl_yaml(project, projmod):
                                        'whitelist' : SPACK_CM_TPLS + COMPILERS,
                                        'blacklist' : ['lmod'],
                                        'blacklist_implicits' : True,
-                                       'all' : {'conflict': ['"{name}"'],
-                                                'environment': {'set': {'"{name}_ROOT"' : '"{prefix}"',
-                                                                        '"{name}_VERSION"' : '"{version}"',
-                                                                        '"{name}_BIN"' : '"{prefix.bin}"',
-                                                                        '"{name}_INC"' : '"{prefix.include}"',
-                                                                        '"{name}_LIB"' : '"{prefix.lib}"'}}},
+                                       'all' : {'conflict': ['{name}'],
+                                                'environment': {'set': {'{name}_ROOT' : '{prefix}',
+                                                                        '{name}_VERSION' : '{version}',
+                                                                        '{name}_BIN' : '{prefix.bin}',
+                                                                        '{name}_INC' : '{prefix.include}',
+                                                                        '{name}_LIB' : '{prefix.lib}'}}},
                                        'projections' : {'all' : ''},
                                        'verbose' : True}}}}
     if SPACK_CM_COMPILERS != ['']:
@@ -309,143 +380,353 @@ def spack_tpl_yaml(project, projmod):
     if MPIS:
         contents['spack']['definitions'].append({'mpis' : MPIS})
         contents['spack']['specs'].append(contents['spack']['specs'][0])
-        contents['spack']['specs'][0] = {'matrix' : [ '[$mpis]' , '[$%compilers]']}
-        contents['spack']['specs'][1]['matrix'].append('[$^mpis]')
+        contents['spack']['specs'][0] = {'matrix' : [ ['$mpis'] , ['$%compilers']]}
+        contents['spack']['specs'][1]['matrix'].append(['$^mpis'])
         contents['spack']['modules']['lmod']['whitelist'] += MPIS
     if CUDAS:
         contents['spack']['definitions'].append({'cudas' : CUDAS})
-        contents['spack']['specs'].insert(0, {'matrix' : [ '[$cudas]' , '[$%compilers]']})
-        contents['spack']['specs'][1]['matrix'].append('[$^cudas]')
-        contents['spack']['specs'][2]['matrix'].append('[$^cudas]')
+        contents['spack']['specs'].insert(0, {'matrix' : [ ['$cudas'] , ['$%compilers']]})
+        contents['spack']['specs'][1]['matrix'].append(['$^cudas'])
+        contents['spack']['specs'][2]['matrix'].append(['$^cudas'])
         contents['spack']['modules']['lmod']['whitelist'] += CUDAS
-    if EXCLUDE != ['']:
+    if expand_matrix:
+        contents['spack']['specs'] = expand_specs(tpl_matrices(context), EXCLUDE)[0]
+    elif EXCLUDE != ['']:
         i = 0
-        # Items cannot start with %, which may happen in the EXCLUDE section
-        # Turning them into strings with quotes to avoid this
-        EXCLUDE = ['"' + item + '"' for item in EXCLUDE]
         while i < len(contents['spack']['specs']):
             contents['spack']['specs'][i]['exclude'] = EXCLUDE
             i += 1
     if projmod:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{}-{{name}}/{{version}}"'.format(project)
+        contents['spack']['modules']['lmod']['projections']['all'] = '{}-{{name}}/{{version}}'.format(project)
     else:
-        contents['spack']['modules']['lmod']['projections']['all'] = '"{name}/{version}"'
+        contents['spack']['modules']['lmod']['projections']['all'] = '{name}/{version}'
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
     filename = projectdir + '/tpl-spack.yaml'
-    generate_file(filename, contents)
-    replace_single_quotes(filename)
+    write_yaml(filename, contents)
 
-def spack_single_stack_yaml(project, projmod, single_stack_compiler=None, single_stack_mpi=None, single_stack_cuda=None):
+def stack_manifest(context=None):
     """
-    Generate TPL YAML file.
+    Read the manifest settings shared by every single stack, once.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    manifest : Dictionary
+        Install and module paths, machine and project names, the compilers
+        built by spack-cm and the packages common to all stacks (TPLs and
+        utilities).
+
+    """
+    context = current_context(context)
+    return {'install_path': context.tpl_install_path,
+            'base_packages_install_path': context.base_packages_install_path,
+            'utility_install_path': context.utility_install_path,
+            'compiler_install_path': context.compiler_install_path,
+            'compilers': context.values('SPACK_CM_COMPILERS'),
+            'machine': context.machine,
+            'project': context.project,
+            'module_root': context.module_path,
+            'packages': context.values('SPACK_CM_TPLS') + context.values('SPACK_CM_UTILITIES')}
+
+
+def single_stack_contents(project, manifest, single_stack_compiler, single_stack_mpi=None,
+                          single_stack_cuda=None):
+    """
+    Contents of the spack.yaml of a single compiler x mpi x cuda stack.
 
     Parameters
     ----------
     project : String
         Project for which to generate this file.
+    manifest : Dictionary
+        Shared settings, see stack_manifest.
 
     """
-    INSTALL_PATH = environ['SPACK_CM_TPL_INSTALL_PATH']
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    C_INSTALL_PATH = environ['SPACK_CM_COMPILER_INSTALL_PATH']
-    U_INSTALL_PATH = environ['SPACK_CM_UTILITY_INSTALL_PATH']
-    SPACK_CM_UTILITIES = env_var_list('SPACK_CM_UTILITIES')
-    SPACK_CM_COMPILERS = env_var_list('SPACK_CM_COMPILERS')
-    SPACK_CM_EXTERNAL_COMPILERS = env_var_list('SPACK_CM_EXTERNAL_COMPILERS')
-    COMPILERS = [c for c in SPACK_CM_COMPILERS + SPACK_CM_EXTERNAL_COMPILERS if c]
-    SPACK_CM_TPLS = env_var_list('SPACK_CM_TPLS')
-    MACHINE = environ['SPACK_CM_MACHINE_NAME']
-    PROJECT = environ['SPACK_CM_PROJECT_NAME']
-    MODULE_ROOT = environ['SPACK_CM_MODULEFILES_PATH']
-    SPACK_CM_TPLS.extend(SPACK_CM_UTILITIES)
-    if single_stack_mpi:
-        SPACK_CM_TPLS.append(single_stack_mpi)
-    if single_stack_cuda:
-        SPACK_CM_TPLS.append(single_stack_cuda)
-    contents = {'spack' :
-                {'include' : ['{}/packages.yaml'.format(BP_INSTALL_PATH),
-                              '{}/packages.yaml'.format(U_INSTALL_PATH),
-                              '../../project/{}/repos.yaml'.format(PROJECT),
-                              '../../platform/{}/packages.yaml'.format(MACHINE),
-                              '../../platform/{}/mirrors.yaml'.format(MACHINE),
-                              '../../platform/{}/compilers.yaml'.format(MACHINE)],
-                 'definitions' : [{'compiler' : [single_stack_compiler]},
-                                  {'packages' : SPACK_CM_TPLS}],
-                 'concretization' : 'together',
-                 'specs' : [{'matrix' : [ '[$packages]' , '[$%compiler]']}],
-                 'config' : {'install_tree' :
-                             {'root' : INSTALL_PATH,
-                              'projections': {'^mpi': '"{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}"',
-                                              'all': '"{name}/{version}/{compiler.name}/{compiler.version}/base/{hash:7}"'}},
-                                 'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
-                                 'install_missing_compilers' : False },
-                 'view' : False,
-                 'modules': {'enable' : ['lmod'],
-                             'prefix_inspections' : {'bin' : ['PATH'],
-                                                     'man' : ['MANPATH'],
-                                                     'share/man' : ['ACLOCAL_PATH'],
-                                                     'lib' : ['LIBRARY_PATH', 'LD_LIBRARY_PATH'],
-                                                     'lib64' : ['LIBRARY_PATH', 'LD_LIBRARY_PATH'],
-                                                     'include' : ['CPATH', 'INCLUDE'],
-                                                     'lib/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     'lib64/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     'share/pkgconfig' : ['PKG_CONFIG_PATH'],
-                                                     '?' : ['CMAKE_PREFIX_PATH']},
-                             'lmod' : {'hierarchy' : ['mpi'],
-                                       'hash_length' : 0,
-                                       'whitelist' : SPACK_CM_TPLS,
-                                       'blacklist' : ['lmod'],
-                                       'blacklist_implicits' : True,
-                                       'all' : {'conflict': ['"{name}"'],
-                                                'environment': {'set': {'"{name}_ROOT"' : '"{prefix}"',
-                                                                        '"{name}_VERSION"' : '"{version}"',
-                                                                        '"{name}_BIN"' : '"{prefix.bin}"',
-                                                                        '"{name}_INC"' : '"{prefix.include}"',
-                                                                        '"{name}_LIB"' : '"{prefix.lib}"'}}},
-                                       'projections' : {'all' : '"{}-{{name}}/{{version}}"'.format(project)},
-                                       'verbose' : True}}}}
+    INSTALL_PATH = manifest['install_path']
+    BP_INSTALL_PATH = manifest['base_packages_install_path']
+    U_INSTALL_PATH = manifest['utility_install_path']
+    MACHINE = manifest['machine']
+    PROJECT = manifest['project']
+    MODULE_ROOT = manifest['module_root']
+    # An empty SPACK_CM_TPLS or SPACK_CM_UTILITIES entry adds no package.
+    SPACK_CM_TPLS = [item for item in manifest['packages'] + [single_stack_mpi, single_stack_cuda]
+                     if item]
+    INCLUDES = ['{}/packages.yaml'.format(BP_INSTALL_PATH),
+                '{}/packages.yaml'.format(U_INSTALL_PATH),
+                '../../project/{}/repos.yaml'.format(PROJECT),
+                '../../platform/{}/packages.yaml'.format(MACHINE),
+                '../../platform/{}/mirrors.yaml'.format(MACHINE),
+                '../../platform/{}/compilers.yaml'.format(MACHINE)]
+    if manifest['compilers'] != ['']:
+        INCLUDES.insert(2, '{}/compilers.yaml'.format(manifest['compiler_install_path']))
+    return {'spack' :
+            {'include' : INCLUDES,
+             'definitions' : [{'compiler' : [single_stack_compiler]},
+                              {'packages' : SPACK_CM_TPLS}],
+             'concretization' : 'together',
+             'specs' : [{'matrix' : [ ['$packages'] , ['$%compiler']]}],
+             'config' : {'install_tree' :
+                         {'root' : INSTALL_PATH,
+                          'projections': {'^mpi': '{name}/{version}/{compiler.name}/{compiler.version}/{^mpi.name}/{^mpi.version}/{hash:7}',
+                                          'all': '{name}/{version}/{compiler.name}/{compiler.version}/base/{hash:7}'}},
+                             'module_roots' : {'lmod': '{}'.format(MODULE_ROOT)},
+                             'install_missing_compilers' : False },
+             'view' : False,
+             'modules': {'enable' : ['lmod'],
+                         'prefix_inspections' : {'bin' : ['PATH'],
+                                                 'man' : ['MANPATH'],
+                                                 'share/man' : ['ACLOCAL_PATH'],
+                                                 'lib' : ['LIBRARY_PATH', 'LD_LIBRARY_PATH'],
+                                                 'lib64' : ['LIBRARY_PATH', 'LD_LIBRARY_PATH'],
+                                                 'include' : ['CPATH', 'INCLUDE'],
+                                                 'lib/pkgconfig' : ['PKG_CONFIG_PATH'],
+                                                 'lib64/pkgconfig' : ['PKG_CONFIG_PATH'],
+                                                 'share/pkgconfig' : ['PKG_CONFIG_PATH'],
+                                                 '' : ['CMAKE_PREFIX_PATH']},
+                         'lmod' : {'hierarchy' : ['mpi'],
+                                   'hash_length' : 0,
+                                   'whitelist' : SPACK_CM_TPLS,
+                                   'blacklist' : ['lmod'],
+                                   'blacklist_implicits' : True,
+                                   'all' : {'conflict': ['{name}'],
+                                            'environment': {'set': {'{name}_ROOT' : '{prefix}',
+                                                                    '{name}_VERSION' : '{version}',
+                                                                    '{name}_BIN' : '{prefix.bin}',
+                                                                    '{name}_INC' : '{prefix.include}',
+                                                                    '{name}_LIB' : '{prefix.lib}'}}},
+                                   'projections' : {'all' : '{}-{{name}}/{{version}}'.format(project)},
+                                   'verbose' : True}}}}
+
+
+def spack_single_stack_yaml(project, projmod, single_stack_compiler=None, single_stack_mpi=None, single_stack_cuda=None,
+                            context=None):
+    """
+    Generate TPL YAML file.
+
+    Parameters
+    ----------
+    project : String
+        Project for which to generate this file.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
+    """
+    context = current_context(context)
+    contents = single_stack_contents(project, stack_manifest(context), single_stack_compiler,
+                                     single_stack_mpi, single_stack_cuda)
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
-    filename = projectdir + '/' + project + '-' + single_stack_compiler + '-' + single_stack_mpi + '-' + single_stack_cuda + '-spack.yaml'
-    generate_file(filename, contents)
-    replace_single_quotes(filename)
+    filename = projectdir + '/' + single_stack_filename(project, single_stack_compiler,
+                                                        single_stack_mpi, single_stack_cuda)
+    write_yaml(filename, contents)
+
 
-def spack_all_stacks_yaml(project, projmod):
+def single_stack_name(compiler, mpi=None, cuda=None):
     """
-    Generate TPL YAML file.
+    Name of a single compiler x mpi x cuda stack.
+
+    Parameters
+    ----------
+    compiler : String
+        Compiler of the stack.
+    mpi : String, optional
+        MPI of the stack, if any.
+    cuda : String, optional
+        Cuda of the stack, if any.
+
+    """
+    return '-'.join([item for item in [compiler, mpi, cuda] if item])
+
+
+def single_stack_filename(project, compiler, mpi=None, cuda=None):
+    """
+    File name of the spack.yaml generated for a single stack.
 
     Parameters
     ----------
     project : String
-        Project for which to generate this file.
+        Project the stack belongs to.
+    compiler : String
+        Compiler of the stack.
+    mpi : String, optional
+        MPI of the stack, if any.
+    cuda : String, optional
+        Cuda of the stack, if any.
+
+    """
+    return project + '-' + single_stack_name(compiler, mpi, cuda) + '-spack.yaml'
+
+
+def single_stacks(context=None):
+    """
+    List every compiler x mpi x cuda combination of the manifest. An empty
+    MPI or Cuda list does not remove the other dimensions of the matrix.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    stacks : List
+        (compiler, mpi, cuda) tuples, with None for a missing MPI or Cuda.
 
     """
-    INSTALL_PATH = environ['SPACK_CM_TPL_INSTALL_PATH']
-    BP_INSTALL_PATH = environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH']
-    C_INSTALL_PATH = environ['SPACK_CM_COMPILER_INSTALL_PATH']
-    U_INSTALL_PATH = environ['SPACK_CM_UTILITY_INSTALL_PATH']
-    SPACK_CM_UTILITY_COMPILER = environ['SPACK_CM_UTILITY_COMPILER']
-    SPACK_CM_COMPILERS = env_var_list('SPACK_CM_COMPILERS')
-    SPACK_CM_EXTERNAL_COMPILERS = env_var_list('SPACK_CM_EXTERNAL_COMPILERS')
+    context = current_context(context)
+    SPACK_CM_COMPILERS = context.values('SPACK_CM_COMPILERS')
+    SPACK_CM_EXTERNAL_COMPILERS = context.values('SPACK_CM_EXTERNAL_COMPILERS')
     COMPILERS = [c for c in SPACK_CM_COMPILERS + SPACK_CM_EXTERNAL_COMPILERS if c]
-    SPACK_CM_MPIS = env_var_list('SPACK_CM_MPIS')
-    SPACK_CM_EXTERNAL_MPIS = env_var_list('SPACK_CM_EXTERNAL_MPIS')
+    SPACK_CM_MPIS = context.values('SPACK_CM_MPIS')
+    SPACK_CM_EXTERNAL_MPIS = context.values('SPACK_CM_EXTERNAL_MPIS')
     MPIS = [c for c in SPACK_CM_MPIS + SPACK_CM_EXTERNAL_MPIS if c]
-    SPACK_CM_CUDAS = env_var_list('SPACK_CM_CUDAS')
-    SPACK_CM_EXTERNAL_CUDAS = env_var_list('SPACK_CM_EXTERNAL_CUDAS')
+    SPACK_CM_CUDAS = context.values('SPACK_CM_CUDAS')
+    SPACK_CM_EXTERNAL_CUDAS = context.values('SPACK_CM_EXTERNAL_CUDAS')
     CUDAS = [c for c in SPACK_CM_CUDAS + SPACK_CM_EXTERNAL_CUDAS if c]
-    
-    for compiler in COMPILERS:
-        for mpi in MPIS:
-            for cuda in CUDAS:
-                spack_single_stack_yaml(project, projmod, compiler, mpi, cuda)
+    return [(compiler, mpi, cuda)
+            for compiler in COMPILERS
+            for mpi in MPIS or [None]
+            for cuda in CUDAS or [None]]
+
+
+def read_stacks_index(projectdir):
+    """
+    Read the index of the single stacks generated for a project.
+
+    Returns
+    -------
+    stacks : Dictionary
+        Stack name mapped to its entry, see spack_all_stacks_yaml. Empty if
+        the index is missing or unreadable.
+
+    """
+    index = join(projectdir, STACKS_INDEX)
+    if not isfile(index):
+        return {}
+    try:
+        with open(index, 'r') as f:
+            contents = json.load(f)
+        if contents.get('version') == STACKS_INDEX_VERSION:
+            return contents['stacks']
+    except Exception as e:
+        logger.warning('Ignoring unreadable {}: {}'.format(index, e))
+    return {}
+
+
+def spack_all_stacks_yaml(project, projmod, workers=None, context=None):
+    """
+    Generate the YAML file of every single compiler x mpi x cuda stack.
+    The manifest is read once, only the stacks whose contents changed are
+    written (in parallel), the files of stacks no longer in the manifest
+    are removed and STACKS_INDEX lists every stack with its hash.
+
+    Parameters
+    ----------
+    project : String
+        Project for which to generate this file.
+    workers : Integer, optional
+        Number of stack files written at the same time. The default is
+        chosen by concurrent.futures.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    stacks : Dictionary
+        Stack name mapped to its file, compiler, mpi, cuda, number of
+        packages and the sha256 of its contents.
+
+    """
+    context = current_context(context)
+    filedir, file = split(abspath(__file__))
+    projectdir = dirname(filedir) + '/project/{}'.format(project)
+    manifest = stack_manifest(context)
+    previous = read_stacks_index(projectdir)
+    stacks = {}
+    changed = []
+    for compiler, mpi, cuda in single_stacks(context):
+        contents = single_stack_contents(project, manifest, compiler, mpi, cuda)
+        name = single_stack_name(compiler, mpi, cuda)
+        stacks[name] = {'file': single_stack_filename(project, compiler, mpi, cuda),
+                        'compiler': compiler,
+                        'mpi': mpi,
+                        'cuda': cuda,
+                        'packages': len([p for p in contents['spack']['definitions'][1]['packages'] if p]),
+                        'sha256': hashlib.sha256(json.dumps(contents, sort_keys=True)
+                                                 .encode()).hexdigest()}
+        if previous.get(name, {}).get('sha256') != stacks[name]['sha256'] \
+                or not isfile(join(projectdir, stacks[name]['file'])):
+            changed.append((join(projectdir, stacks[name]['file']), contents))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        written = sum(executor.map(lambda job: write_yaml(*job), changed))
+    removed = 0
+    for name, entry in previous.items():
+        if name not in stacks and isfile(join(projectdir, entry['file'])):
+            remove(join(projectdir, entry['file']))
+            removed += 1
+    if stacks != previous:
+        index = join(projectdir, STACKS_INDEX)
+        with open('{}.{}.tmp'.format(index, getpid()), 'w') as f:
+            json.dump({'version': STACKS_INDEX_VERSION, 'stacks': stacks}, f,
+                      indent=2, sort_keys=True)
+        replace('{}.{}.tmp'.format(index, getpid()), index)
+    logger.info('Single stacks: {} written, {} unchanged, {} removed.'.format(
+        written, len(stacks) - written, removed))
+    return stacks
+
+
+def stack_sizes(context=None):
+    """
+    Count the specs of the TPL stack and of each single stack, once the
+    exclude rules are applied, without concretizing anything.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    sizes : List
+        (stack, specs, specs excluded) of each stack.
+
+    """
+    context = current_context(context)
+    EXCLUDE = context.values('SPACK_CM_EXCLUDE_COMBOS')
+    specs, excluded = expand_specs(tpl_matrices(context), EXCLUDE)
+    sizes = [('tpl', len(specs), excluded)]
+    packages = len([c for c in context.values('SPACK_CM_TPLS') + context.values('SPACK_CM_UTILITIES') if c])
+    for compiler, mpi, cuda in single_stacks(context):
+        sizes.append((single_stack_name(compiler, mpi, cuda),
+                      packages + len([c for c in [mpi, cuda] if c]), 0))
+    return sizes
+
+
+def print_stack_sizes(context=None):
+    """
+    Print the number of specs of each stack.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    context = current_context(context)
+    for stack, specs, excluded in stack_sizes(context):
+        message = '{} stack: {} spec(s), {} excluded.'.format(stack, specs, excluded)
+        logger.info(message)
+        print(f'{pcolors.OKCYAN}' + message + f'{pcolors.ENDC}')
 
 
 def generate_yamls(project, machine, path, projmod, machine_path,
                    generate_single_stacks, explicit_install_path,
-                   explicit_modulefiles_path):
+                   explicit_modulefiles_path, expand_matrix=False, context=None):
     """
     Generate all YAML files.
 
@@ -461,26 +742,34 @@ def generate_yamls(project, machine, path, projmod, machine_path,
         Turn on project name in module generation. The default is True.
     machine_path: Boolean
         Add the machine name to the install path.
+    expand_matrix: Boolean, optional
+        Write the TPL specs left once the exclude rules are applied instead
+        of the matrices. The default is False.
+    context : ProjectContext, optional
+        Settings of the project. The default is parsed from the manifest and
+        exported to os.environ for backward compatibility. A given context
+        is used as is and nothing is exported.
+
+    Returns
+    -------
+    context : ProjectContext
+        Settings the files were generated from.
 
     """
-    if(generate_single_stacks):
-        try:
-            export_env_vars(project, machine, path, machine_path, explicit_install_path, explicit_modulefiles_path)
-            spack_all_stacks_yaml(project, projmod)
-        except Exception as e:
-            error = 'ERROR: Unable to generate YAML files with error:\n {}'.format(e)
-            logger.critical(error)
-            raise GenerateException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-    else:
-        try:
-            export_env_vars(project, machine, path, machine_path, explicit_install_path, explicit_modulefiles_path)
-            spack_base_package_yaml(project)
-            spack_lmod_yaml(project)
-            spack_compilers_yaml(project, projmod)
-            spack_utilities_yaml(project, projmod)
-            spack_tpl_yaml(project, projmod)
-            spack_all_stacks_yaml(project, projmod)
-        except Exception as e:
-            error = 'ERROR: Unable to generate YAML files with error:\n {}'.format(e)
-            logger.critical(error)
-            raise GenerateException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    try:
+        if context is None:
+            context = export_env_vars(project, machine, path, machine_path,
+                                      explicit_install_path, explicit_modulefiles_path)
+        if not generate_single_stacks:
+            spack_base_package_yaml(project, context)
+            spack_lmod_yaml(project, context)
+            spack_compilers_yaml(project, projmod, context)
+            spack_utilities_yaml(project, projmod, context)
+            spack_tpl_yaml(project, projmod, expand_matrix, context)
+        spack_all_stacks_yaml(project, projmod, context=context)
+        print_stack_sizes(context)
+    except Exception as e:
+        error = 'ERROR: Unable to generate YAML files with error:\n {}'.format(e)
+        logger.critical(error)
+        raise GenerateException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    return context
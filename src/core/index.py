@@ -0,0 +1,219 @@
+"""
+Keep an SQLite index of the specs installed by every stage
+"""
+
+from src.core.utilities import state_dir, pcolors
+from src.core.packages import iter_installs, install_node, provenance
+from os import stat
+from os.path import isfile, join
+from contextlib import closing
+import re
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+index_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS installs (stage TEXT, hash TEXT, name TEXT,
+    version TEXT, compiler TEXT, mpi TEXT, cuda TEXT, prefix TEXT,
+    explicit INTEGER, installed REAL, PRIMARY KEY (stage, hash));
+CREATE TABLE IF NOT EXISTS sources (stage TEXT PRIMARY KEY, path TEXT,
+    size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS installs_name ON installs (name);
+CREATE INDEX IF NOT EXISTS installs_version ON installs (version);
+CREATE INDEX IF NOT EXISTS installs_compiler ON installs (compiler);
+CREATE INDEX IF NOT EXISTS installs_mpi ON installs (mpi);
+CREATE INDEX IF NOT EXISTS installs_cuda ON installs (cuda);
+CREATE INDEX IF NOT EXISTS installs_prefix ON installs (prefix);
+"""
+
+INSTALL_COLUMNS = ['stage', 'hash', 'name', 'version', 'compiler', 'mpi',
+                   'cuda', 'prefix', 'explicit', 'installed']
+
+SPEC_RE = re.compile(r'([%^])')
+
+
+def index_file(context=None):
+    """
+    Path of the install index for the current project/machine.
+
+    """
+    return join(state_dir(context), 'index.db')
+
+
+def connect(context=None):
+    """
+    Open the install index, creating its tables if needed.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the index.
+
+    """
+    connection = sqlite3.connect(index_file(context), timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def update_index(stage, install_path, context=None):
+    """
+    Bring the index of a stage up to date with its spack database. Only the
+    installs added or removed since the last update are written, and the
+    database is not read at all when it did not change.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage.
+    install_path : String
+        Root of the stage's install tree.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    changes : Tuple
+        (installs added, installs removed).
+
+    """
+    database = join(install_path, '.spack-db', 'index.json')
+    if not isfile(database):
+        return 0, 0
+    info = stat(database)
+    with index_lock, closing(connect(context)) as connection:
+        source = connection.execute('SELECT path, size, mtime FROM sources WHERE stage = ?',
+                                    (stage,)).fetchone()
+        if source == (database, info.st_size, info.st_mtime):
+            return 0, 0
+        known = {row[0] for row in connection.execute(
+            'SELECT hash FROM installs WHERE stage = ?', (stage,))}
+        nodes = {}
+        records = {}
+        for key, record in iter_installs(database):
+            nodes[key] = install_node(record)
+            if key not in known:
+                records[key] = record
+        memo = {}
+        rows = []
+        for key, record in records.items():
+            name, version, compiler, dependencies = nodes[key]
+            mpi, cuda = provenance(key, nodes, memo)
+            rows.append((stage, key, name, version, compiler, mpi, cuda,
+                         record.get('path'), int(bool(record.get('explicit'))),
+                         record.get('installation_time')))
+        removed = known - set(nodes)
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO installs VALUES '
+                                   '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.executemany('DELETE FROM installs WHERE stage = ? AND hash = ?',
+                                   [(stage, key) for key in removed])
+            connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                               (stage, database, info.st_size, info.st_mtime))
+    logger.info('Index of stage {}: {} installs added, {} removed.'.format(
+        stage, len(rows), len(removed)))
+    return len(rows), len(removed)
+
+
+def refresh_index(stage, install_path, context=None):
+    """
+    Update the index of a stage after an install. Failures are only logged,
+    the index must never break an install.
+
+    """
+    try:
+        update_index(stage, install_path, context)
+    except Exception as e:
+        warn = 'WARNING: Unable to update the install index of {}: {}'.format(stage, e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+
+
+def _like(value):
+    """
+    Escape the wildcards of a LIKE pattern.
+
+    """
+    return value.replace('\\', '\\\\').replace('_', '\\_').replace('%', '\\%')
+
+
+def _version_match(column, version):
+    """
+    SQL condition matching a version and the versions it is a prefix of
+    (e.g., 10 matches 10 and 10.1.0).
+
+    """
+    return ("({0} = ? OR {0} LIKE ? ESCAPE '\\')".format(column),
+            [version, _like(version) + '.%'])
+
+
+def _name_match(column, spec):
+    """
+    SQL condition matching a name@version value of a column.
+
+    """
+    name, _, version = spec.partition('@')
+    if not version:
+        return ("({0} = ? OR {0} LIKE ? ESCAPE '\\')".format(column),
+                [name, _like(name) + '@%'])
+    return _version_match(column, spec)
+
+
+def search(spec=None, stage=None, context=None):
+    """
+    Find the installs matching a spec of the form
+    name[@version][%compiler[@version]][^dependency[@version]]..., where
+    dependencies are matched against the MPI and CUDA of each install.
+
+    Parameters
+    ----------
+    spec : String, optional
+        Spec to match. The default matches every install.
+    stage : String, optional
+        Only return installs of this stage.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    installs : List
+        Dictionary of each matching install, see INSTALL_COLUMNS.
+
+    """
+    conditions = []
+    parameters = []
+    parts = SPEC_RE.split((spec or '').replace(' ', ''))
+    name, _, version = parts[0].partition('@')
+    if name:
+        conditions.append('name = ?')
+        parameters.append(name)
+    if version:
+        condition, values = _version_match('version', version)
+        conditions.append(condition)
+        parameters += values
+    for sigil, value in zip(parts[1::2], parts[2::2]):
+        if sigil == '%':
+            condition, values = _name_match('compiler', value)
+        else:
+            condition, values = _name_match('mpi', value)
+            cuda_condition, cuda_values = _name_match('cuda', value)
+            condition = '({} OR {})'.format(condition, cuda_condition)
+            values = values + cuda_values
+        conditions.append(condition)
+        parameters += values
+    if stage:
+        conditions.append('stage = ?')
+        parameters.append(stage)
+    statement = 'SELECT {} FROM installs'.format(', '.join(INSTALL_COLUMNS))
+    if conditions:
+        statement += ' WHERE ' + ' AND '.join(conditions)
+    statement += ' ORDER BY name, version, compiler, mpi, cuda'
+    with index_lock, closing(connect(context)) as connection:
+        return [dict(zip(INSTALL_COLUMNS, row))
+                for row in connection.execute(statement, parameters)]
@@ -2,26 +2,101 @@
 Install TPLs using Spack
 """
 
-from os.path import split, abspath, dirname, isdir
-from os import environ
-import subprocess
-from src.core.cleanup import cleanup, spack_license_cleanup
+from os.path import split, abspath, dirname, isdir, join
+from os import dup2, getcwd
+from functools import partial
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor
+import sys
+import time
+from src.core import cleanup as cleanup_module
+from src.core.cleanup import (cleanup, spack_license_cleanup, stage_lock,
+                              share_cleanup_lock)
 from src.core.packages import generate_packages_yaml
-from src.core.generate import generate_yamls
+from src.core.generate import (generate_yamls, single_stacks, stack_manifest,
+                               single_stack_name, single_stack_filename)
+from src.core.scheduler import run_graph, critical_paths, simulate
+from src.core.status import manifest_specs
+from src.core.matrix import parse_spec
+from src.core.journal import yaml_fingerprint, stage_is_current, record_stage
+from src.core.retry import failed_packages, failed_roots, failed_specs
+from src.core import timings
+from src.core.index import refresh_index
+from src.core.lockcache import (restore_lock, save_lock, discard_lock,
+                                lock_cache_summary)
+from src.core.buildcache import (set_build_cache, add_mirror, install_args,
+                                 push, installed_hashes, update_cache)
+from src.core.backend import spack_command, settings as backend_settings, set_backend
 from src.core.utilities import (copy_spack_yaml, check_project_yaml_files,
-                                generate_compiler_yaml, pcolors)
+                                generate_compiler_yaml, stage_env_dir,
+                                pcolors)
+from src.core.context import current_context
 import logging
 logger = logging.getLogger(__name__)
 
+# Stages run by each choice of the --stage option.
+STAGE_SELECTIONS = {'all': ['base', 'lmod', 'compiler', 'utility', 'tpl'],
+                    'base': ['base', 'lmod'],
+                    'compiler': ['compiler'],
+                    'utility': ['utility'],
+                    'tpl': ['tpl']}
+
+# Manifest variable which, when empty, turns a stage into a no-op.
+STAGE_PACKAGES = {'base': 'SPACK_CM_BASE_PACKAGES',
+                  'lmod': None,
+                  'compiler': 'SPACK_CM_COMPILERS',
+                  'utility': 'SPACK_CM_UTILITIES',
+                  'tpl': 'SPACK_CM_TPLS'}
+
+# Generated spack YAML file and install tree of each stage.
+STAGE_FILES = {'base': 'base-packages-spack.yaml',
+               'lmod': 'lmod-spack.yaml',
+               'compiler': 'compilers-spack.yaml',
+               'utility': 'utilities-spack.yaml',
+               'tpl': 'tpl-spack.yaml'}
+
+STAGE_INSTALL_PATHS = {'base': 'SPACK_CM_BASE_PACKAGES_INSTALL_PATH',
+                       'lmod': 'SPACK_CM_LMOD_INSTALL_PATH',
+                       'compiler': 'SPACK_CM_COMPILER_INSTALL_PATH',
+                       'utility': 'SPACK_CM_UTILITY_INSTALL_PATH',
+                       'tpl': 'SPACK_CM_TPL_INSTALL_PATH'}
+
+# Default cleanup policy of each stage (see cleanup.CLEANUP_POLICIES).
+STAGE_CLEANUP = {'base': 'failed',
+                 'lmod': 'failed',
+                 'compiler': 'failed',
+                 'utility': 'failed',
+                 'tpl': 'failed'}
+
+# Default number of install attempts of each stage.
+STAGE_ATTEMPTS = {'base': 2,
+                  'lmod': 2,
+                  'compiler': 2,
+                  'utility': 2,
+                  'tpl': 3}
+
 
 class InstallException(Exception):
     """Catch all install exceptions"""
     pass
 
 
+def build_jobs_args(jobs=None, context=None):
+    """
+    'spack install' arguments setting its build jobs: the given jobs, else
+    those of the context, else none.
+
+    """
+    jobs = jobs or current_context(context).build_jobs
+    if not jobs:
+        return []
+    return ['-j', str(jobs)]
+
+
 def do_install(project, debug, external, filename,
                total_attempts, fake, generate_modules=True,
-               load=False):
+               load=False, envdir=None, retry_jobs=None, stage=None,
+               cleanup_policy='failed', context=None):
     """
     Run the spack install in the appropriate spack environment.
 
@@ -43,46 +118,102 @@ def do_install(project, debug, external, filename,
         Generate modules for installed packages. The default is True.
     load : Boolean, optional
         Load and generate info about the compilers. The default is False.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    retry_jobs : Integer, optional
+        Build jobs (spack install -j) used when retrying failed specs. The
+        default is the build jobs of the run, see build_jobs_args.
+    stage : String, optional
+        Name under which the attempts are timed. The default is filename.
+    cleanup_policy : String, optional
+        What is cleaned before each full attempt, see
+        cleanup.CLEANUP_POLICIES. The default is 'failed'.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    attempts : Integer
+        Number of attempts the install needed.
 
     """
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
+    if envdir is None:
+        envdir = projectdir
+    context = current_context(context)
+    verbose = '-v' if debug else ''
     attempt = 0
-    copy_spack_yaml(project, filename)
+    failed = []
+    stale = []
+    inputs = yaml_fingerprint(join(projectdir, filename))
+    reuse_lock = True
+    restored = False
+    copy_spack_yaml(project, filename, envdir)
     while attempt < total_attempts:
-        cleanup(projectdir, external)
         try:
-            with open(projectdir + '/spack.yaml', 'r') as f:
-                print(50*'*')
-                print(f.read())
-                print(50*'*')
-            if debug:
-                cmd = 'spack env activate {} && spack install -v {} && spack env deactivate'.format(projectdir, fake)
+            if failed:
+                # Keep the concretized environment and everything already
+                # built; only the failing roots are installed again.
+                jobs = build_jobs_args(retry_jobs, context)
+                args = ['install', verbose] + jobs + [fake] + install_args() + failed
             else:
-                cmd = 'spack env activate {} && spack install {} && spack env deactivate'.format(projectdir, fake)
-            install = subprocess.run(cmd, shell=True)
-            if install.returncode != 0:
+                cleanup(envdir, external, cleanup_policy, stale, context.machine)
+                add_mirror(envdir)
+                # A cached lock is only trusted for the first full attempt.
+                restored = reuse_lock and restore_lock(inputs, envdir, context)
+                reuse_lock = False
+                with open(envdir + '/spack.yaml', 'r') as f:
+                    print(50*'*')
+                    print(f.read())
+                    print(50*'*')
+                args = ['install', verbose] + build_jobs_args(context=context) + [fake] + install_args()
+            start = time.time()
+            # Held shared so no cleanup removes the build stages in use.
+            with stage_lock():
+                returncode, failures = spack_command(args, env=envdir,
+                                                     keep=lambda line: 'Failed to install' in line)
+            timings.record_attempt(stage or filename, attempt + 1, start, returncode)
+            save_lock(inputs, envdir, context)
+            if returncode != 0:
                 attempt += 1
-                copy_spack_yaml(project, filename)
-                warn = 'WARNING. Packages did not successfully install. \n \
-                       Attempt: {}/{}.'.format(attempt, total_attempts)
+                packages = failed_packages(failures.splitlines())
+                failed = failed_roots(envdir, packages)
+                if failed:
+                    warn = 'WARNING. Root specs did not successfully install: {}. \n \
+                           Attempt: {}/{}. Retrying only these specs.'.format(', '.join(failed), attempt, total_attempts)
+                else:
+                    if restored:
+                        discard_lock(inputs, envdir, context)
+                    # Read before the cleanup removes spack.lock.
+                    stale = failed_specs(envdir, packages)
+                    copy_spack_yaml(project, filename, envdir)
+                    warn = 'WARNING. Packages did not successfully install. \n \
+                           Attempt: {}/{}.'.format(attempt, total_attempts)
                 logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
                 continue
+            # Single stacks (tpl:<stack>) share the TPL install tree.
+            tree = (stage or '').split(':')[0]
+            if not fake and tree in STAGE_INSTALL_PATHS:
+                refresh_index(tree, context.value(STAGE_INSTALL_PATHS[tree]), context)
             if load:
-                generate_compiler_yaml(project)
+                generate_compiler_yaml(project, envdir, context)
             if generate_modules:
-                modules = subprocess.run('spack env activate {} && spack module lmod refresh -y && spack env deactivate'.format(projectdir), shell=True)
-                if modules.returncode != 0:
-                    logger.critical('ERROR: Unable to generate modules for {}'.format(projectdir))
-                    raise InstallException('ERROR: Unable to generate modules for {}'.format(projectdir))
+                returncode, output = spack_command(['module', 'lmod', 'refresh', '-y'],
+                                                   env=envdir)
+                if returncode != 0:
+                    logger.critical('ERROR: Unable to generate modules for {}'.format(envdir))
+                    raise InstallException('ERROR: Unable to generate modules for {}'.format(envdir))
                 logger.info('Modulefiles successfully generated.')
                 print(f'{pcolors.OKGREEN}Modulefiles successfully generated.{pcolors.ENDC}')
             logger.info(f'{pcolors.OKGREEN}COMPLETE. All packages successfully installed.{pcolors.ENDC}')
             print('Install complete!\n')
-            break
+            return attempt + 1
         except Exception as e:
             attempt += 1
-            copy_spack_yaml(project, filename)
+            failed = []
+            copy_spack_yaml(project, filename, envdir)
             warn = 'WARNING. Packages did not successfully install with error \n {}. \n \
                        Attempt: {}/{}.'.format(e, attempt, total_attempts)
             logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
@@ -93,7 +224,9 @@ def do_install(project, debug, external, filename,
         raise InstallException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
 
 
-def install_base_packages(project, debug, external, fake):
+def install_base_packages(project, debug, external, fake, envdir=None,
+                          total_attempts=STAGE_ATTEMPTS['base'], retry_jobs=None,
+                          cleanup_policy=STAGE_CLEANUP['base'], context=None):
     """
     Install packages as defined by SPACK_CM_BASE_PACKAGES
 
@@ -107,6 +240,17 @@ def install_base_packages(project, debug, external, fake):
         Turn on 'spack external find'.
     fake : String
         Use the spack install --fake flag if the user is requesting a dry-run.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    total_attempts : Integer, optional
+        Number of spack install retries.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
     if fake:
@@ -114,11 +258,17 @@ def install_base_packages(project, debug, external, fake):
     logger.info('Installing base packages as defined by $SPACK_CM_BASE_PACKAGES.')
     print(f'{pcolors.OKCYAN}Installing base packages...{pcolors.ENDC}')
     do_install(project, debug, external,
-               'base-packages-spack.yaml', 2, fake, generate_modules=False)
-    generate_packages_yaml(environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH'])
+               'base-packages-spack.yaml', total_attempts, fake,
+               generate_modules=False, envdir=envdir, retry_jobs=retry_jobs,
+               stage='base', cleanup_policy=cleanup_policy,
+               context=context)
+    context = current_context(context)
+    generate_packages_yaml(context.base_packages_install_path, context=context)
 
 
-def install_lmod(project, debug, external, fake):
+def install_lmod(project, debug, external, fake, envdir=None,
+                 total_attempts=STAGE_ATTEMPTS['lmod'], retry_jobs=None,
+                 cleanup_policy=STAGE_CLEANUP['lmod'], context=None):
     """
     Install Lmod.
 
@@ -132,6 +282,17 @@ def install_lmod(project, debug, external, fake):
         Turn on 'spack external find'.
     fake : String
         Use the spack install --fake flag if the user is requesting a dry-run.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    total_attempts : Integer, optional
+        Number of spack install retries.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
     if fake:
@@ -139,10 +300,15 @@ def install_lmod(project, debug, external, fake):
     logger.info('Installing Lmod.')
     print(f'{pcolors.OKCYAN}Installing Lmod...{pcolors.ENDC}')
     do_install(project, debug, external,
-               'lmod-spack.yaml', 2, fake, generate_modules=False)
+               'lmod-spack.yaml', total_attempts, fake,
+               generate_modules=False, envdir=envdir, retry_jobs=retry_jobs,
+               stage='lmod', cleanup_policy=cleanup_policy,
+               context=context)
 
 
-def install_compilers(project, debug, external, fake):
+def install_compilers(project, debug, external, fake, envdir=None,
+                      total_attempts=STAGE_ATTEMPTS['compiler'], retry_jobs=None,
+                      cleanup_policy=STAGE_CLEANUP['compiler'], context=None):
     """
     Install compilers as defined by SPACK_CM_COMPILERS.
 
@@ -156,6 +322,17 @@ def install_compilers(project, debug, external, fake):
         Turn on 'spack external find'.
     fake : String
         Use the spack install --fake flag if the user is requesting a dry-run.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    total_attempts : Integer, optional
+        Number of spack install retries.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
     """
@@ -174,11 +351,16 @@ def install_compilers(project, debug, external, fake):
         print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
     logger.info('Installing compilers as defined by $SPACK_CM_COMPILERS.')
     print(f'{pcolors.OKCYAN}Installing compilers...{pcolors.ENDC}')
-    do_install(project, debug, external, 'compilers-spack.yaml', 2, fake,
-               load=True)
+    do_install(project, debug, external, 'compilers-spack.yaml',
+               total_attempts, fake, load=True, envdir=envdir,
+               retry_jobs=retry_jobs,
+               stage='compiler', cleanup_policy=cleanup_policy,
+               context=context)
 
 
-def install_utilities(project, debug, external, fake):
+def install_utilities(project, debug, external, fake, envdir=None,
+                      total_attempts=STAGE_ATTEMPTS['utility'], retry_jobs=None,
+                      cleanup_policy=STAGE_CLEANUP['utility'], context=None):
     """
     Install utilities as defined by SPACK_CM_UTILITIES
 
@@ -192,17 +374,34 @@ def install_utilities(project, debug, external, fake):
         Turn on 'spack external find'.
     fake : String
         Use the spack install --fake flag if the user is requesting a dry-run.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    total_attempts : Integer, optional
+        Number of spack install retries.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
     if fake:
         print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
     logger.info('Installing utilities as defined by $SPACK_CM_UTILITIES.')
     print(f'{pcolors.OKCYAN}Installing utilities...{pcolors.ENDC}')
-    do_install(project, debug, external, 'utilities-spack.yaml', 2, fake)
-    generate_packages_yaml(environ['SPACK_CM_UTILITY_INSTALL_PATH'])
+    do_install(project, debug, external, 'utilities-spack.yaml',
+               total_attempts, fake, envdir=envdir, retry_jobs=retry_jobs,
+               stage='utility', cleanup_policy=cleanup_policy,
+               context=context)
+    context = current_context(context)
+    generate_packages_yaml(context.utility_install_path, context=context)
 
 
-def install_tpls(project, debug, external, fake):
+def install_tpls(project, debug, external, fake, envdir=None,
+                 total_attempts=STAGE_ATTEMPTS['tpl'], retry_jobs=None,
+                 cleanup_policy=STAGE_CLEANUP['tpl'], context=None):
     """
     Install TPLs as defined by SPACK_CM_TPLS, SPACK_CM_MPIS, and SPACK_CM_CUDAS.
 
@@ -216,20 +415,603 @@ def install_tpls(project, debug, external, fake):
         Turn on 'spack external find'.
     fake : String
         Use the spack install --fake flag if the user is requesting a dry-run.
+    envdir : String, optional
+        Spack environment directory to install from. The default is the
+        project directory.
+    total_attempts : Integer, optional
+        Number of spack install retries.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
     if fake:
         print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
     logger.info('Installing TPLs as defined by $SPACK_CM_MPIS, $SPACK_CM_CUDAS, and $SPACK_CM_TPLS.')
     print(f'{pcolors.OKCYAN}Installing TPLs...{pcolors.ENDC}')
-    do_install(project, debug, external, 'tpl-spack.yaml', 3, fake)
-    generate_packages_yaml(environ['SPACK_CM_TPL_INSTALL_PATH'],
-                           compiler_info=True)
+    do_install(project, debug, external, 'tpl-spack.yaml',
+               total_attempts, fake, envdir=envdir, retry_jobs=retry_jobs,
+               stage='tpl', cleanup_policy=cleanup_policy,
+               context=context)
+    context = current_context(context)
+    generate_packages_yaml(context.tpl_install_path, compiler_info=True,
+                           context=context)
+
+
+def _stack_worker_init(lock, path, backend, run, state):
+    """
+    Prepare a process of the single stack pool.
+
+    Parameters
+    ----------
+    lock : multiprocessing.Lock
+        Lock shared by all stacks to serialize the spack cleanup.
+    path : List
+        sys.path of the parent, which holds the spack libraries.
+    backend : String
+        Spack backend used by the parent.
+    run : Integer
+        Run whose timings are being recorded, or None.
+    state : String
+        State directory the timings of the run are recorded in, or None.
+
+    """
+    cleanup_module.cleanup_lock = lock
+    sys.path[:] = path
+    set_backend(backend)
+    timings.current['run'] = run
+    timings.current['state'] = state
+
+
+def install_single_stack(project, machine, compiler, mpi, cuda, debug,
+                         external, fake, total_attempts, log_dir,
+                         retry_jobs=None, cleanup_policy=STAGE_CLEANUP['tpl'],
+                         context=None):
+    """
+    Install a single compiler x mpi x cuda stack in its own spack
+    environment directory. Runs in a process of the single stack pool, with
+    all output sent to the stack's own log file.
+
+    Parameters
+    ----------
+    project : String
+        The project for which to install packages.
+    machine : String
+        The machine for which to install packages.
+    compiler : String
+        Compiler of the stack.
+    mpi : String
+        MPI of the stack, or None.
+    cuda : String
+        Cuda of the stack, or None.
+    debug : Boolean
+        Turn on debug mode.
+    external : Boolean
+        Turn on 'spack external find'.
+    fake : String
+        Use the spack install --fake flag if the user is requesting a dry-run.
+    total_attempts : Integer
+        Number of spack install retries.
+    log_dir : String
+        Directory in which to write the stack's log.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    result : Dictionary
+        Name, status, number of attempts, log file and environment directory
+        of the stack.
+
+    """
+    name = single_stack_name(compiler, mpi, cuda)
+    log = '{}/TPL-log-{}.log'.format(log_dir, name)
+    result = {'stack': name, 'status': 'failed', 'attempts': total_attempts,
+              'log': log, 'envdir': stage_env_dir(project, machine, name)}
+    with open(log, 'w') as f:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        dup2(f.fileno(), 1)
+        dup2(f.fileno(), 2)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(filename)s:%(funcName)s: %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        try:
+            start = time.time()
+            envdir = result['envdir']
+            result['attempts'] = do_install(project, debug, external,
+                                            single_stack_filename(project, compiler, mpi, cuda),
+                                            total_attempts, fake, envdir=envdir,
+                                            retry_jobs=retry_jobs,
+                                            stage='tpl:' + name,
+                                            cleanup_policy=cleanup_policy,
+                                            context=context)
+            if not fake:
+                push(envdir, installed_hashes(current_context(context).tpl_install_path, start))
+            result['status'] = 'installed'
+        except Exception as e:
+            logger.critical('ERROR: Stack {} failed with error {}'.format(name, e))
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    return result
+
+
+def install_single_stacks(project, machine, debug, external, fake,
+                          stack_workers=1, force=False,
+                          total_attempts=STAGE_ATTEMPTS['tpl'], retry_jobs=None,
+                          cleanup_policy=STAGE_CLEANUP['tpl'], context=None,
+                          explain_schedule=False):
+    """
+    Install every single compiler x mpi x cuda stack into the shared TPL
+    install tree, running up to stack_workers stacks at the same time. The
+    stacks expected to take longest start first.
+
+    Parameters
+    ----------
+    project : String
+        The project for which to install packages.
+    machine : String
+        The machine for which to install packages.
+    debug : Boolean
+        Turn on debug mode.
+    external : Boolean
+        Turn on 'spack external find'.
+    fake : String
+        Use the spack install --fake flag if the user is requesting a dry-run.
+    stack_workers : Integer, optional
+        Number of stacks installed at the same time. The default is 1.
+    force : Boolean, optional
+        Install stacks even if the journal shows they are up to date. The
+        default is False.
+    total_attempts : Integer, optional
+        Number of spack install retries of each stack.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : String, optional
+        What is cleaned before each full install attempt.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+    explain_schedule : Boolean, optional
+        Print the predicted order and makespan of the stacks. The default
+        is False.
+
+    """
+    if fake:
+        print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
+    filedir, filename = split(abspath(__file__))
+    projectdir = dirname(filedir) + '/project/{}'.format(project)
+    context = current_context(context)
+    install_path = context.tpl_install_path
+    stacks = []
+    inputs = {}
+    for compiler, mpi, cuda in single_stacks(context):
+        name = single_stack_name(compiler, mpi, cuda)
+        inputs[name] = yaml_fingerprint(join(projectdir, single_stack_filename(project, compiler, mpi, cuda)))
+        if not force and stage_is_current('tpl:' + name, inputs[name], install_path, context):
+            logger.info('Stack {} is up to date. Skipping.'.format(name))
+            print(f'{pcolors.OKGREEN}{name}: up to date, skipped.{pcolors.ENDC}')
+            continue
+        stacks.append((compiler, mpi, cuda))
+    if not stacks:
+        return
+    stacks, durations = longest_first(stacks, stack_durations(stacks, context))
+    if explain_schedule:
+        print_schedule('Single stacks', durations, {}, stack_workers)
+    logger.info('Installing {} single stacks with {} workers.'.format(len(stacks), stack_workers))
+    print(f'{pcolors.OKCYAN}Installing {len(stacks)} single stacks...{pcolors.ENDC}')
+    sys.stdout.flush()
+    # The stage threads running next to the stacks (e.g., lmod) clean up
+    # under the same lock.
+    lock = share_cleanup_lock()
+    results = []
+    with ProcessPoolExecutor(max_workers=stack_workers,
+                             initializer=_stack_worker_init,
+                             initargs=(lock, list(sys.path),
+                                       backend_settings['backend'],
+                                       timings.current['run'],
+                                       timings.current['state'])) as pool:
+        futures = [pool.submit(install_single_stack, project, machine,
+                               compiler, mpi, cuda, debug, external, fake,
+                               total_attempts, getcwd(), retry_jobs,
+                               cleanup_policy, context)
+                   for compiler, mpi, cuda in stacks]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'installed':
+                if not fake:
+                    record_stage('tpl:' + result['stack'], inputs[result['stack']],
+                                 install_path, result['envdir'], context)
+                print(f"{pcolors.OKGREEN}{result['stack']}: installed after {result['attempts']} attempt(s).{pcolors.ENDC}")
+            else:
+                print(f"{pcolors.FAIL}{result['stack']}: failed after {result['attempts']} attempt(s). See {result['log']}.{pcolors.ENDC}")
+            logger.info('Stack {stack} {status} after {attempts} attempt(s). Log: {log}'.format(**result))
+    if not fake:
+        update_cache(None, install_path, 0)
+    generate_packages_yaml(install_path, compiler_info=True, context=context)
+    failed = [result['stack'] for result in results if result['status'] != 'installed']
+    if failed:
+        error = 'ERROR: {} of {} stacks failed to install: {}.'.format(
+            len(failed), len(results), ', '.join(failed))
+        logger.critical(error)
+        raise InstallException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+
+
+STAGE_INSTALLERS = {'base': install_base_packages,
+                    'lmod': install_lmod,
+                    'compiler': install_compilers,
+                    'utility': install_utilities,
+                    'tpl': install_tpls}
+
+
+def stage_dependencies(context=None):
+    """
+    Dependencies between the install stages.
+
+    Lmod and the compilers are built against the base packages. The
+    utilities include the compilers.yaml of the compilers stage whenever
+    compilers are built, so they need that stage then. The TPLs include the
+    compilers.yaml of the compilers stage and the packages.yaml files of
+    the utility and base stages.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    dependencies : Dictionary
+        Stage name mapped to the stages it needs.
+
+    """
+    dependencies = {'base': [],
+                    'lmod': ['base'],
+                    'compiler': ['base'],
+                    'utility': ['base'],
+                    'tpl': ['base', 'compiler', 'utility']}
+    context = current_context(context)
+    # Same condition as generate.spack_utilities_yaml.
+    if context.values('SPACK_CM_COMPILERS') != ['']:
+        dependencies['utility'].append('compiler')
+    return dependencies
+
+
+def specs_duration(specs, estimates):
+    """
+    Expected duration of a list of specs: the sum of the recorded install
+    times of their packages.
+
+    Returns
+    -------
+    duration : Tuple
+        (seconds, 'specs'), or (0, 'unknown') when no package has a
+        recorded time.
+
+    """
+    names = [parse_spec(spec)['name'] for spec in specs if spec]
+    known = [estimates[name] for name in names if name in estimates]
+    if not known:
+        return 0, 'unknown'
+    return sum(known), 'specs'
+
+
+def history(context=None):
+    """
+    Recorded stage and spec install times, see timings.stage_estimates and
+    timings.spec_estimates. Estimates must never break an install.
+
+    """
+    try:
+        return timings.stage_estimates(context), timings.spec_estimates(context)
+    except Exception as e:
+        warn = 'WARNING: Unable to read the recorded install times: {}'.format(e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        return {}, {}
+
+
+def stage_durations(names, context=None):
+    """
+    Expected duration of each stage: its average recorded wall time, else
+    the recorded install times of the specs of its manifest entries.
+
+    Parameters
+    ----------
+    names : List
+        Stages to estimate.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    durations : Dictionary
+        Stage name mapped to (seconds, source), source being 'history',
+        'specs' or 'unknown'.
+
+    """
+    context = current_context(context)
+    stages, estimates = history(context)
+    try:
+        specs = manifest_specs(context)
+    except Exception as e:
+        warn = 'WARNING: Unable to list the specs of the stages: {}'.format(e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        specs = {}
+    return {name: (stages[name], 'history') if name in stages
+            else specs_duration(specs.get(name, []), estimates)
+            for name in names}
+
+
+def stack_durations(stacks, context=None):
+    """
+    Expected duration of each single stack: its average recorded install
+    time, else the recorded install times of its packages.
+
+    Parameters
+    ----------
+    stacks : List
+        (compiler, mpi, cuda) of each stack.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    durations : Dictionary
+        Stack name mapped to (seconds, source), see stage_durations.
+
+    """
+    context = current_context(context)
+    stages, estimates = history(context)
+    packages = stack_manifest(context)['packages']
+    durations = {}
+    for compiler, mpi, cuda in stacks:
+        name = single_stack_name(compiler, mpi, cuda)
+        if 'tpl:' + name in stages:
+            durations[name] = (stages['tpl:' + name], 'history')
+        else:
+            durations[name] = specs_duration(packages + [mpi, cuda], estimates)
+    return durations
+
+
+def longest_first(stacks, durations):
+    """
+    Order single stacks longest processing time first, the order the pool
+    starts them in since it starts stacks in the order they are submitted.
+
+    Parameters
+    ----------
+    stacks : List
+        (compiler, mpi, cuda) of each stack.
+    durations : Dictionary
+        Stack name mapped to (seconds, source), see stack_durations.
+
+    Returns
+    -------
+    stacks : List
+        The stacks, longest first.
+    durations : Dictionary
+        The durations in the same order, so simulating them follows the
+        order the stacks really start in.
+
+    """
+    stacks = sorted(stacks, key=lambda stack: -durations[single_stack_name(*stack)][0])
+    return stacks, {single_stack_name(*stack): durations[single_stack_name(*stack)]
+                    for stack in stacks}
+
+
+def print_schedule(title, durations, dependencies, workers, priorities=None):
+    """
+    Print the order in which tasks are expected to run and the predicted
+    makespan.
+
+    Parameters
+    ----------
+    title : String
+        What is being scheduled, e.g., Stages.
+    durations : Dictionary
+        Task name mapped to (seconds, source), see stage_durations.
+    dependencies : Dictionary
+        Task name mapped to the names of the tasks it needs.
+    workers : Integer
+        Maximum number of tasks running at the same time.
+    priorities : Dictionary, optional
+        Task name mapped to its priority, see scheduler.run_graph.
+
+    """
+    schedule = simulate({name: seconds for name, (seconds, source) in durations.items()},
+                        dependencies, workers, priorities)
+    makespan = max([end for name, start, end in schedule], default=0)
+    lines = ['{}: predicted makespan {} with {} worker(s).'.format(
+        title, timings.format_seconds(makespan), workers)]
+    for name, start, end in schedule:
+        lines.append('  {:<30} {:>10} -> {:>10}  ({})'.format(
+            name, timings.format_seconds(start), timings.format_seconds(end),
+            durations[name][1]))
+    unknown = [name for name, (seconds, source) in durations.items() if source == 'unknown']
+    if unknown:
+        lines.append('  No recorded times for {}; counted as 0s.'.format(', '.join(unknown)))
+    print(f'{pcolors.OKCYAN}' + lines[0] + f'{pcolors.ENDC}')
+    for line in lines:
+        logger.info(line)
+    for line in lines[1:]:
+        print(line)
+
+
+def run_stage(name, project, machine, debug, external, fake,
+              install_stacks=False, stack_workers=1, force=False,
+              attempts=None, retry_jobs=None, cleanup_policy=None, context=None,
+              explain_schedule=False):
+    """
+    Install a single stage in its own spack environment directory.
+
+    Parameters
+    ----------
+    name : String
+        The stage to install.
+        Options: base, lmod, compiler, utility, tpl.
+    project : String
+        The project for which to install packages.
+    machine : String
+        The machine for which to install packages.
+    debug : Boolean
+        Turn on debug mode.
+    external : Boolean
+        Turn on 'spack external find'.
+    fake : String
+        Use the spack install --fake flag if the user is requesting a dry-run.
+    install_stacks : Boolean, optional
+        Install the TPLs one single stack at a time. The default is False.
+    stack_workers : Integer, optional
+        Number of single stacks installed at the same time. The default
+        is 1.
+    force : Boolean, optional
+        Install the stage even if the journal shows it is up to date. The
+        default is False.
+    attempts : Dictionary, optional
+        Stage name mapped to its number of install attempts, overriding
+        STAGE_ATTEMPTS.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : Dictionary, optional
+        Stage name mapped to its cleanup policy, overriding STAGE_CLEANUP.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+    explain_schedule : Boolean, optional
+        Print the predicted schedule of the single stacks. The default is
+        False.
+
+    """
+    total_attempts = dict(STAGE_ATTEMPTS, **(attempts or {}))[name]
+    policy = dict(STAGE_CLEANUP, **(cleanup_policy or {}))[name]
+    context = current_context(context)
+    packages = STAGE_PACKAGES[name]
+    if packages is not None and context.value(packages) == '':
+        warn = "WARNING: {} stage skipped because {} is empty.".format(name, packages)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        return
+    install_path = context.value(STAGE_INSTALL_PATHS[name])
+    start = time.time()
+    status = 'failed'
+    try:
+        if name == 'tpl' and install_stacks:
+            install_single_stacks(project, machine, debug, external, fake,
+                                  stack_workers, force, total_attempts, retry_jobs,
+                                  policy, context, explain_schedule)
+            status = 'installed'
+            return
+        filedir, filename = split(abspath(__file__))
+        projectdir = dirname(filedir) + '/project/{}'.format(project)
+        inputs = yaml_fingerprint(join(projectdir, STAGE_FILES[name]))
+        if not force and stage_is_current(name, inputs, install_path, context):
+            logger.info('Stage {} is up to date. Skipping.'.format(name))
+            print(f'{pcolors.OKGREEN}{name} stage is up to date. Skipping (use --force to reinstall).{pcolors.ENDC}')
+            status = 'skipped'
+            return
+        envdir = stage_env_dir(project, machine, name)
+        STAGE_INSTALLERS[name](project, debug, external, fake, envdir=envdir,
+                               total_attempts=total_attempts, retry_jobs=retry_jobs,
+                               cleanup_policy=policy, context=context)
+        if not fake:
+            record_stage(name, inputs, install_path, envdir, context)
+            update_cache(envdir, install_path, start)
+        status = 'installed'
+    finally:
+        timings.record_stage_time(name, start, status)
+        if status == 'installed':
+            timings.record_specs(name, install_path, start)
+
+
+def run_stages(project, machine, stage, debug, external, fake,
+               concurrent_stages=1, install_stacks=False, stack_workers=1,
+               force=False, attempts=None, retry_jobs=None, cleanup_policy=None,
+               context=None, explain_schedule=False):
+    """
+    Install the selected stages, running stages which do not depend on
+    each other at the same time. Ready stages on the longest chain of
+    expected stage durations start first.
+
+    Parameters
+    ----------
+    project : String
+        The project for which to install packages.
+    machine : String
+        The machine for which to install packages.
+    stage : String
+        The stage of installation to complete.
+        Options: all, base, compiler, utility, tpl.
+    debug : Boolean
+        Turn on debug mode.
+    external : Boolean
+        Turn on 'spack external find'.
+    fake : String
+        Use the spack install --fake flag if the user is requesting a dry-run.
+    concurrent_stages : Integer, optional
+        Maximum number of stages installing at the same time. The default
+        is 1.
+    install_stacks : Boolean, optional
+        Install the TPLs one single stack at a time. The default is False.
+    stack_workers : Integer, optional
+        Number of single stacks installed at the same time. The default
+        is 1.
+    force : Boolean, optional
+        Install stages even if the journal shows they are up to date. The
+        default is False.
+    attempts : Dictionary, optional
+        Stage name mapped to its number of install attempts, overriding
+        STAGE_ATTEMPTS.
+    retry_jobs : Integer, optional
+        Build jobs used when retrying failed specs.
+    cleanup_policy : Dictionary, optional
+        Stage name mapped to its cleanup policy, overriding STAGE_CLEANUP.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+    explain_schedule : Boolean, optional
+        Print the predicted order and makespan of the stages and stacks.
+        The default is False.
+
+    """
+    if stage not in STAGE_SELECTIONS:
+        error = 'ERROR: Unknown stage {}. Available choices: {}.'.format(
+            stage, ', '.join(STAGE_SELECTIONS))
+        logger.critical(error)
+        raise InstallException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    tasks = {}
+    for name in STAGE_SELECTIONS[stage]:
+        tasks[name] = partial(run_stage, name, project, machine, debug,
+                              external, fake, install_stacks, stack_workers,
+                              force, attempts, retry_jobs, cleanup_policy, context,
+                              explain_schedule)
+    dependencies = stage_dependencies(context)
+    durations = stage_durations(list(tasks), context)
+    priorities = critical_paths({name: seconds for name, (seconds, source) in durations.items()},
+                                dependencies)
+    if explain_schedule:
+        print_schedule('Stages', durations, dependencies, concurrent_stages, priorities)
+    # Created before any stage starts, so every stage thread and the single
+    # stack processes serialize their cleanups on the same lock.
+    share_cleanup_lock()
+    run_graph(tasks, dependencies, concurrent_stages, priorities)
 
 
 def installer(project, machine, path, stage, debug, external, fake, projmod,
               machine_path, generate_single_stacks,
-              explicit_install_path, explicit_modulefiles_path):
+              explicit_install_path, explicit_modulefiles_path,
+              concurrent_stages=1, install_stacks=False, stack_workers=1,
+              force=False, attempts=None, retry_jobs=None, cleanup_policy=None,
+              build_cache=None, build_cache_size=None, expand_matrix=False,
+              context=None, build_jobs=None, explain_schedule=False):
     """
     Installer driver for all phases of TPL installation.
 
@@ -261,6 +1043,45 @@ def installer(project, machine, path, stage, debug, external, fake, projmod,
         Exact installation root path to use. Default: None
     explicit_modulefiles_path: String
         Exact module files root path to use. Default: None
+    concurrent_stages: Integer
+        Maximum number of independent stages installing at the same time.
+        Default: 1
+    install_stacks: Boolean
+        Install the TPLs from the single compiler x mpi x cuda spack.yaml
+        files instead of the combined TPL environment. Default: False
+    stack_workers: Integer
+        Number of single stacks installed at the same time. Default: 1
+    force: Boolean
+        Reinstall stages the journal shows are up to date. Default: False
+    attempts: Dictionary
+        Stage name mapped to its number of install attempts. Default: None
+    retry_jobs: Integer
+        Build jobs used when retrying failed specs. Default: None
+    cleanup_policy: Dictionary
+        Stage name mapped to its cleanup policy. Default: None ('failed')
+    build_cache: String
+        Directory of the build caches shared between stages and rebuilds.
+        Default: None (no build cache)
+    build_cache_size: Integer
+        Size in bytes above which packages are evicted from the build
+        cache. Default: None (no limit)
+    expand_matrix: Boolean
+        Write the TPL specs left once the exclude rules are applied instead
+        of the matrices. Default: False
+    context: ProjectContext
+        Settings of the project. Default: None (parsed from the manifest
+        and exported to os.environ)
+    build_jobs: Integer
+        Build jobs of every spack install. Default: None (spack's own
+        setting)
+    explain_schedule: Boolean
+        Print the predicted order and makespan of the stages and stacks,
+        from the recorded install times. Default: False
+
+    Returns
+    -------
+    status : String
+        'installed' or 'failed'.
 
     """
     filedir, filename = split(abspath(__file__))
@@ -276,43 +1097,26 @@ def installer(project, machine, path, stage, debug, external, fake, projmod,
                         Please run "spack-cm setup" first.'.format(machinedir)
         logger.critical(error)
         raise InstallException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-    generate_yamls(project, machine, path, projmod, machine_path,
-                   generate_single_stacks, explicit_install_path,
-                   explicit_modulefiles_path)
+    context = generate_yamls(project, machine, path, projmod, machine_path,
+                             generate_single_stacks, explicit_install_path,
+                             explicit_modulefiles_path, expand_matrix, context)
     if generate_single_stacks:
         warn = "WARNING: Skipping install phase because generate_single_stacks is enabled."
         logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
         exit(0)
-    all_stages = False
-    if stage == 'all':
-        all_stages = True
+    if build_cache is not None:
+        set_build_cache(build_cache, machine, build_cache_size)
+    if build_jobs is not None:
+        context = replace(context, build_jobs=build_jobs)
+    if not fake:
+        timings.start_run(project, machine, stage, context)
+    status = 'failed'
     try:
-        check_project_yaml_files()
-        if stage == 'base' or all_stages:
-            if environ['SPACK_CM_BASE_PACKAGES'] != '':
-                install_base_packages(project, debug, external, fake)
-            else:
-                warn = "WARNING: base stage skipped because SPACK_CM_BASE_PACKAGES is empty."
-                logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
-            install_lmod(project, debug, external, fake)
-        if stage == 'compiler' or all_stages:
-            if environ['SPACK_CM_COMPILERS'] != '':
-                install_compilers(project, debug, external, fake)
-            else:
-                warn = "WARNING: compiler stage skipped because SPACK_CM_COMPILERS is empty."
-                logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
-        if stage == 'utility' or all_stages:
-            if environ['SPACK_CM_UTILITIES'] != '':
-                install_utilities(project, debug, external, fake)
-            else:
-                warn = "WARNING: utility stage skipped because SPACK_CM_UTILITIES is empty."
-                logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
-        if stage == 'tpl' or all_stages:
-            if environ['SPACK_CM_TPLS'] != '':
-                install_tpls(project, debug, external, fake)
-            else:
-                warn = "WARNING: tpl stage skipped because SPACK_CM_TPLS is empty."
-                logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        check_project_yaml_files(context)
+        run_stages(project, machine, stage, debug, external, fake,
+                   concurrent_stages, install_stacks, stack_workers, force,
+                   attempts, retry_jobs, cleanup_policy, context, explain_schedule)
+        status = 'installed'
         logger.info('COMPLETE: All stages of installation have successfully completed.')
         print('\n' + 50*'*')
         print(f'{pcolors.OKBLUE}COMPLETE: All stages of installation have successfully completed.{pcolors.ENDC}')
@@ -321,4 +1125,9 @@ def installer(project, machine, path, stage, debug, external, fake, projmod,
         logger.critical(error)
         print(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
     finally:
+        timings.finish_run(status)
+        timings.print_report()
+        logger.info(lock_cache_summary())
+        print(lock_cache_summary())
         spack_license_cleanup()
+    return status
@@ -0,0 +1,234 @@
+"""
+Journal of installed stages, used to skip stages whose inputs did not change
+"""
+
+from src.core.utilities import state_dir, pcolors
+from src.core.lockfile import (read_lock, lock_nodes, database_nodes,
+                               resolve_dag_hashes, root_closure)
+from os import environ, replace
+from os.path import isfile, isdir, join, dirname
+from functools import lru_cache
+import hashlib
+import json
+import subprocess
+import threading
+import time
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+journal_lock = threading.Lock()
+
+
+class JournalException(Exception):
+    """Catch all journal exceptions"""
+    pass
+
+
+@lru_cache(maxsize=None)
+def spack_commit():
+    """
+    Get the commit of the spack checkout in use.
+
+    Returns
+    -------
+    commit : String
+        Commit hash, or 'unknown' if it cannot be determined.
+
+    """
+    spack_root = environ.get('SPACK_ROOT')
+    if spack_root is None:
+        return 'unknown'
+    commit = subprocess.run(['git', '-C', spack_root, 'rev-parse', 'HEAD'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if commit.returncode != 0:
+        return 'unknown'
+    return commit.stdout.strip()
+
+
+def yaml_fingerprint(filename):
+    """
+    Fingerprint a generated spack YAML file together with the files it
+    includes and the spack commit.
+
+    Parameters
+    ----------
+    filename : String
+        Path to the generated spack YAML file.
+
+    Returns
+    -------
+    fingerprint : String
+        SHA-256 of the inputs.
+
+    """
+    sha = hashlib.sha256()
+    sha.update(spack_commit().encode())
+    with open(filename, 'rb') as f:
+        data = f.read()
+    sha.update(data)
+    contents = yaml.safe_load(data) or {}
+    for include in contents.get('spack', {}).get('include', []):
+        path = join(dirname(filename), include)
+        sha.update(include.encode())
+        if isfile(path):
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+    return sha.hexdigest()
+
+
+def stage_hashes(envdir, install_path):
+    """
+    DAG hashes of the roots a stage environment installed and of the specs
+    they link with or run, from its spack.lock.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory of the stage.
+    install_path : String
+        Root of the stage's install tree.
+
+    Returns
+    -------
+    hashes : List
+        Sorted DAG hashes, or None if the spack.lock is missing or one of
+        its specs is not found in the install tree.
+
+    """
+    lockfile = join(envdir, 'spack.lock')
+    if not isfile(lockfile):
+        return None
+    lock = read_lock(lockfile)
+    nodes = lock_nodes(lock)
+    hashes = resolve_dag_hashes(nodes, database_nodes(install_path))
+    hashes = set(hashes[key] for key in root_closure(lock, nodes))
+    if None in hashes:
+        return None
+    return sorted(hashes)
+
+
+def installs_present(hashes, install_path):
+    """
+    Check that specs are still installed in a tree and their prefixes still
+    exist.
+
+    Parameters
+    ----------
+    hashes : List
+        DAG hashes of the specs.
+    install_path : String
+        Root of the install tree.
+
+    """
+    installs = database_nodes(install_path)
+    return all(key in installs and (installs[key]['path'] is None or
+                                    isdir(installs[key]['path']))
+               for key in hashes)
+
+
+def journal_file(context=None):
+    """
+    Path of the journal for the current project/machine.
+
+    """
+    return join(state_dir(context), 'journal.json')
+
+
+def load_journal(context=None):
+    """
+    Load the journal for the current project/machine.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    journal : Dictionary
+        Stage name mapped to its last recorded install.
+
+    """
+    filename = journal_file(context)
+    if not isfile(filename):
+        return {}
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        warn = 'WARNING: Ignoring unreadable journal {}.'.format(filename)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        return {}
+
+
+def stage_is_current(stage, inputs, install_path, context=None):
+    """
+    Check whether a stage was already installed from the same inputs and
+    the specs it installed are still in place. Only the stage's own specs
+    are looked at, so installs of other stages or projects sharing the
+    tree do not make it stale.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage.
+    inputs : String
+        Fingerprint of the stage's inputs.
+    install_path : String
+        Root of the stage's install tree.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    entry = load_journal(context).get(stage)
+    if entry is None:
+        return False
+    if entry['inputs'] != inputs or entry['spack'] != spack_commit():
+        return False
+    if not entry.get('hashes'):
+        return False
+    return installs_present(entry['hashes'], install_path)
+
+
+def record_stage(stage, inputs, install_path, envdir, context=None):
+    """
+    Record a successful install of a stage, with the specs its spack.lock
+    installed.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage.
+    inputs : String
+        Fingerprint of the stage's inputs.
+    install_path : String
+        Root of the stage's install tree.
+    envdir : String
+        Spack environment directory the stage was installed from.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    hashes = stage_hashes(envdir, install_path)
+    if hashes is None:
+        warn = 'WARNING: Unable to find the installs of {} from {}, it will be reinstalled ' \
+               'next time.'.format(stage, join(envdir, 'spack.lock'))
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+    filename = journal_file(context)
+    with journal_lock:
+        journal = load_journal(context)
+        journal[stage] = {'inputs': inputs,
+                          'spack': spack_commit(),
+                          'hashes': hashes,
+                          'time': time.time()}
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(journal, f, indent=1)
+            replace(filename + '.tmp', filename)
+        except Exception as e:
+            error = 'ERROR: Unable to write journal {} with error {}.'.format(filename, e)
+            logger.critical(error)
+            raise JournalException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    logger.info('Recorded {} in journal {}.'.format(stage, filename))
@@ -0,0 +1,167 @@
+"""
+Cache concretized spack.lock files so unchanged environments are not
+concretized again
+"""
+
+from src.core.utilities import state_dir, pcolors
+from src.core.backend import user_config_dir
+from os import listdir, remove, replace, makedirs, utime, walk
+from os.path import isdir, isfile, join, getmtime
+from shutil import copyfile
+import hashlib
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of lockfiles kept in the cache.
+MAX_LOCKS = 100
+
+lock_cache_lock = threading.Lock()
+stats = {'hits': 0, 'misses': 0}
+
+
+def lock_cache_dir(context=None):
+    """
+    Get (and create) the directory holding the cached lockfiles.
+
+    """
+    path = join(state_dir(context), 'concretize-cache')
+    if not isdir(path):
+        makedirs(path, exist_ok=True)
+    return path
+
+
+def lock_key(inputs, envdir):
+    """
+    Key of the cached lockfile of a spack environment: the fingerprint of
+    its inputs together with the compilers and externals detected in its
+    private user scope (see compilers.detect_compilers and
+    externals.detect_externals), which spack concretizes against as well.
+
+    Parameters
+    ----------
+    inputs : String
+        Fingerprint of the generated spack YAML file, its includes and the
+        spack commit.
+    envdir : String
+        Spack environment directory.
+
+    Returns
+    -------
+    key : String
+        SHA-256 of the inputs and detected configuration.
+
+    """
+    sha = hashlib.sha256(inputs.encode())
+    config = user_config_dir(envdir)
+    for root, dirs, files in sorted(walk(config)):
+        for name in sorted(files):
+            if name in ('compilers.yaml', 'packages.yaml'):
+                sha.update(join(root, name)[len(config):].encode())
+                with open(join(root, name), 'rb') as f:
+                    sha.update(f.read())
+    return sha.hexdigest()
+
+
+def restore_lock(inputs, envdir, context=None):
+    """
+    Copy the cached lockfile of a fingerprint, see lock_key, into a spack
+    environment.
+
+    Parameters
+    ----------
+    inputs : String
+        Fingerprint of the generated spack YAML file, its includes and the
+        spack commit.
+    envdir : String
+        Spack environment directory.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    hit : Boolean
+        Whether a cached lockfile was restored.
+
+    """
+    cached = join(lock_cache_dir(context), lock_key(inputs, envdir) + '.lock')
+    with lock_cache_lock:
+        if not isfile(cached):
+            stats['misses'] += 1
+            logger.info('Concretization cache miss for {}.'.format(envdir))
+            print(f'{pcolors.OKCYAN}Concretization cache miss. Concretizing...{pcolors.ENDC}')
+            return False
+        stats['hits'] += 1
+        copyfile(cached, join(envdir, 'spack.lock'))
+        utime(cached)
+    logger.info('Concretization cache hit for {}: {}'.format(envdir, cached))
+    print(f'{pcolors.OKGREEN}Concretization cache hit. Reusing {cached}.{pcolors.ENDC}')
+    return True
+
+
+def save_lock(inputs, envdir, context=None):
+    """
+    Add the lockfile of a concretized spack environment to the cache, and
+    drop the least recently used lockfiles beyond MAX_LOCKS.
+
+    Parameters
+    ----------
+    inputs : String
+        Fingerprint of the generated spack YAML file, its includes and the
+        spack commit.
+    envdir : String
+        Spack environment directory.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    lockfile = join(envdir, 'spack.lock')
+    cached = join(lock_cache_dir(context), lock_key(inputs, envdir) + '.lock')
+    if not isfile(lockfile) or isfile(cached):
+        return
+    with lock_cache_lock:
+        try:
+            copyfile(lockfile, cached + '.tmp')
+            replace(cached + '.tmp', cached)
+        except OSError as e:
+            warn = 'WARNING: Unable to cache {}: {}'.format(lockfile, e)
+            logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+            return
+        cache = lock_cache_dir(context)
+        locks = sorted((join(cache, name) for name in listdir(cache)
+                        if name.endswith('.lock')), key=getmtime)
+        for name in locks[:-MAX_LOCKS]:
+            remove(name)
+    logger.info('Cached concretized {} as {}.'.format(lockfile, cached))
+
+
+def discard_lock(inputs, envdir, context=None):
+    """
+    Remove the cached lockfile of a fingerprint, e.g., after an install
+    from it failed for an unknown reason.
+
+    Parameters
+    ----------
+    inputs : String
+        Fingerprint of the generated spack YAML file, its includes and the
+        spack commit.
+    envdir : String
+        Spack environment directory.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    cached = join(lock_cache_dir(context), lock_key(inputs, envdir) + '.lock')
+    with lock_cache_lock:
+        if isfile(cached):
+            remove(cached)
+            logger.info('Discarded cached lockfile {}.'.format(cached))
+
+
+def lock_cache_summary():
+    """
+    Summary of the concretization cache hits and misses of this process.
+
+    """
+    return 'Concretization cache: {} hit(s), {} miss(es).'.format(stats['hits'],
+                                                               stats['misses'])
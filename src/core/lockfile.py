@@ -0,0 +1,211 @@
+"""
+Read the concrete specs of a spack.lock and find their DAG hashes
+"""
+
+from src.core.utilities import pcolors
+from src.core.packages import iter_installs, install_node
+from os.path import isfile, join
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+# Dependency types the DAG hash of spack 0.16 and older covers, and so the
+# ones its database records.
+LINK_TYPES = ('link', 'run')
+
+
+class LockfileException(Exception):
+    """Catch all lockfile exceptions"""
+    pass
+
+
+def read_lock(lockfile):
+    """
+    Load a spack.lock.
+
+    """
+    try:
+        with open(lockfile, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        error = 'ERROR: Unable to read {} with error {}.'.format(lockfile, e)
+        logger.critical(error)
+        raise LockfileException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+
+
+def lock_nodes(lock):
+    """
+    Read the concrete specs of a spack.lock, for every lockfile version.
+
+    Lockfiles v1 and v2 (spack 0.16 and older) key the specs by their build
+    hash and do not hold their DAG hash. Lockfile v3 keeps the DAG hash next
+    to the package, and from v4 on the specs are keyed by their DAG hash.
+
+    Parameters
+    ----------
+    lock : Dictionary
+        Contents of the spack.lock.
+
+    Returns
+    -------
+    nodes : Dictionary
+        Lock key mapped to the 'name', 'version', 'compiler' (name@version
+        or ''), 'parameters', 'external', the lock keys of its
+        'dependencies' and of its 'link_dependencies' (link or run only)
+        and its 'dag_hash' (None when the lockfile does not hold it).
+
+    """
+    version = lock.get('_meta', {}).get('lockfile-version', 1)
+    nodes = {}
+    for key, entry in lock.get('concrete_specs', {}).items():
+        if 'name' in entry:
+            node = entry
+            dependencies = entry.get('dependencies', [])
+            dag_hash = entry.get('hash', key)
+        else:
+            name = [name for name in entry if name != 'hash'][0]
+            node = dict(entry[name], name=name)
+            dependencies = list(node.get('dependencies', {}).values())
+            dag_hash = entry.get('hash') if version >= 3 else None
+        compiler = node.get('compiler') or {}
+        nodes[key] = {'name': node['name'],
+                      'version': str(node.get('version', '')),
+                      'compiler': '{}@{}'.format(compiler.get('name'), compiler.get('version'))
+                                  if compiler else '',
+                      'parameters': node.get('parameters') or {},
+                      'external': bool(node.get('external')),
+                      'dependencies': [dep['hash'] for dep in dependencies],
+                      'link_dependencies': [dep['hash'] for dep in dependencies
+                                            if set(dep.get('type', LINK_TYPES)) & set(LINK_TYPES)],
+                      'dag_hash': dag_hash}
+    return nodes
+
+
+def database_nodes(install_path):
+    """
+    Installed specs of a spack install tree, keyed by DAG hash.
+
+    Returns
+    -------
+    nodes : Dictionary
+        DAG hash mapped to the 'name', 'version', 'compiler', 'parameters',
+        the DAG hashes of its 'dependencies' and its 'path'.
+
+    """
+    index = join(install_path, '.spack-db', 'index.json')
+    if not isfile(index):
+        return {}
+    nodes = {}
+    for key, record in iter_installs(index):
+        if not record.get('installed', True):
+            continue
+        name, version, compiler, dependencies = install_node(record)
+        spec = record['spec']
+        node = spec if 'name' in spec else spec[name]
+        nodes[key] = {'name': name, 'version': version, 'compiler': compiler,
+                      'parameters': node.get('parameters') or {},
+                      'dependencies': dependencies,
+                      'path': record.get('path')}
+    return nodes
+
+
+def resolve_dag_hashes(nodes, installs):
+    """
+    Find the DAG hash of every spec of a spack.lock. Specs whose lockfile
+    does not hold it are matched with the installs on name, version,
+    compiler and parameters, and on their link and run dependencies
+    matching the same installs, so only specs which are installed get a
+    hash this way.
+
+    Parameters
+    ----------
+    nodes : Dictionary
+        Concrete specs of the lockfile, see lock_nodes.
+    installs : Dictionary
+        Installed specs, see database_nodes.
+
+    Returns
+    -------
+    hashes : Dictionary
+        Lock key mapped to the DAG hash of the spec, or None when it is not
+        known.
+
+    """
+    candidates = {}
+    for key, install in installs.items():
+        candidates.setdefault((install['name'], install['version'], install['compiler']),
+                              []).append(key)
+    hashes = {}
+
+    def resolve(key):
+        if key in hashes:
+            return hashes[key]
+        hashes[key] = None
+        node = nodes[key]
+        if node['dag_hash'] is not None:
+            hashes[key] = node['dag_hash']
+            return hashes[key]
+        dependencies = set(resolve(dep) for dep in node['link_dependencies'] if dep in nodes)
+        if None in dependencies:
+            return None
+        matches = [install for install in
+                   candidates.get((node['name'], node['version'], node['compiler']), [])
+                   if (not node['parameters'] or not installs[install]['parameters'] or
+                       node['parameters'] == installs[install]['parameters'])
+                   and set(installs[install]['dependencies']) == dependencies]
+        if len(matches) == 1:
+            hashes[key] = matches[0]
+        return hashes[key]
+
+    for key in nodes:
+        resolve(key)
+    return hashes
+
+
+def lock_dag_hashes(lockfile, install_path):
+    """
+    DAG hash of every spec of a spack.lock, see resolve_dag_hashes.
+
+    Parameters
+    ----------
+    lockfile : String
+        Path to the spack.lock.
+    install_path : String
+        Root of the install tree the environment installs into.
+
+    Returns
+    -------
+    hashes : Dictionary
+        Lock key mapped to the DAG hash of the spec, or None.
+
+    """
+    return resolve_dag_hashes(lock_nodes(read_lock(lockfile)), database_nodes(install_path))
+
+
+def root_closure(lock, nodes):
+    """
+    Lock keys of the roots of a spack.lock and of every spec they link
+    with or run.
+
+    Parameters
+    ----------
+    lock : Dictionary
+        Contents of the spack.lock.
+    nodes : Dictionary
+        Concrete specs of the lockfile, see lock_nodes.
+
+    Returns
+    -------
+    keys : Set
+        Lock keys of the specs.
+
+    """
+    keys = set()
+    pending = [root['hash'] for root in lock.get('roots', [])]
+    while pending:
+        key = pending.pop()
+        if key in keys or key not in nodes:
+            continue
+        keys.add(key)
+        pending.extend(nodes[key]['link_dependencies'])
+    return keys
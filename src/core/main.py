@@ -6,8 +6,15 @@ Parser and driver for spack-cm
 
 from src.core.check import check, check_spack
 from src.core.setup import setup_spaces
-from src.core.installer import installer
-from src.core.utilities import dir_path, get_hostname, pcolors
+from src.core.installer import installer, STAGE_ATTEMPTS
+from src.core.plan import plan
+from src.core.query import query
+from src.core.status import status
+from src.core.batch import batch
+from src.core.backend import BACKENDS, set_backend
+from src.core.utilities import (dir_path, get_hostname, stage_attempts,
+                                stage_cleanup_policy, expand_stage_settings,
+                                cache_size, pcolors)
 import logging
 import argparse
 logger = logging.getLogger(__name__)
@@ -30,6 +37,14 @@ def buildParser():
                                          description='Run set up routine for a new project/machine combination.')
     parser_installer = subparsers.add_parser('install',
                                            description='Run install routine for a project/machine combination.')
+    parser_plan = subparsers.add_parser('plan',
+                                        description='Concretize a project/machine combination and list the specs an install would build or reuse.')
+    parser_query = subparsers.add_parser('query',
+                                         description='List the installed specs of a project/machine combination matching a spec, without starting spack.')
+    parser_status = subparsers.add_parser('status',
+                                          description='Report which specs of the manifest of a project/machine combination are installed, without starting spack.')
+    parser_batch = subparsers.add_parser('batch',
+                                         description='Run install routine for every project/machine combination of a batch file.')
     parser_setup.add_argument('-p', '--project',
                         action='store',
                         dest='project',
@@ -70,6 +85,13 @@ def buildParser():
                             run.\
                             Available choices: \
                             [base, compiler, utility, tpl]')
+    parser_installer.add_argument('--concurrent-stages',
+                        action='store',
+                        type=int,
+                        dest='concurrent_stages',
+                        default=1,
+                        help='OPTIONAL: Maximum number of independent stages \
+                            to install at the same time. Default: 1')
     parser_installer.add_argument('--spack',
                         action='store',
                         dest='spackbranch',
@@ -99,6 +121,69 @@ def buildParser():
                         action='store_true',
                         dest='generate_single_stacks',
                         help='OPTIONAL: Generate generic single compiler x mpi x cuda spack.yaml files. Skip the install step')
+    parser_installer.add_argument('--install-single-stacks',
+                        action='store_true',
+                        dest='install_stacks',
+                        help='OPTIONAL: Install the TPLs one compiler x mpi x cuda \
+                            stack at a time, each in its own spack environment.')
+    parser_installer.add_argument('--stack-workers',
+                        action='store',
+                        type=int,
+                        dest='stack_workers',
+                        default=1,
+                        help='OPTIONAL: Number of single stacks to install at \
+                            the same time. Default: 1')
+    parser_installer.add_argument('--force',
+                        action='store_true',
+                        dest='force',
+                        help='OPTIONAL: Install every selected stage, even those \
+                            whose inputs have not changed since the last install.')
+    parser_installer.add_argument('--attempts',
+                        action='append',
+                        type=stage_attempts,
+                        dest='attempts',
+                        help='OPTIONAL: Number of install attempts, either for \
+                            all stages (e.g., 3) or for one stage (e.g., tpl=5). \
+                            May be repeated. Default: 2, and 3 for tpl')
+    parser_installer.add_argument('--retry-jobs',
+                        action='store',
+                        type=int,
+                        dest='retry_jobs',
+                        default=None,
+                        help='OPTIONAL: Number of build jobs used when retrying \
+                            the specs that failed to install.')
+    parser_installer.add_argument('--cleanup-policy',
+                        action='append',
+                        type=stage_cleanup_policy,
+                        dest='cleanup_policy',
+                        help='OPTIONAL: What is cleaned before an install attempt, \
+                            either for all stages (e.g., stage) or for one stage \
+                            (e.g., tpl=full): none, failed (build stages of failed \
+                            specs), stage (all build stages) or full (also the \
+                            download and misc caches). May be repeated. Default: failed')
+    parser_installer.add_argument('--build-cache',
+                        action='store',
+                        dest='build_cache',
+                        default=None,
+                        help='OPTIONAL: Directory of a local spack build cache. \
+                            Installed packages are pushed to it and installed \
+                            from it on later stages and rebuilds.')
+    parser_installer.add_argument('--build-cache-size',
+                        action='store',
+                        type=cache_size,
+                        dest='build_cache_size',
+                        default=None,
+                        help='OPTIONAL: Evict the least recently used packages \
+                            once the build cache of a platform is larger than \
+                            this size (e.g., 50G). Default: no limit')
+    parser_installer.add_argument('--spack-backend',
+                        action='store',
+                        choices=BACKENDS,
+                        dest='spack_backend',
+                        default='worker',
+                        help='OPTIONAL: Run spack commands in a long-lived spack \
+                            process (worker) or start spack for every command \
+                            (shell). Default: worker')
     parser_installer.add_argument('--explicit-install-path',
                         action='store',
                         dest='user_specified_install_path',
@@ -107,6 +192,18 @@ def buildParser():
                         action='store',
                         dest='user_specified_modulefile_path',
                         help='OPTIONAL: Exactly specify the install path for module installations')
+    parser_installer.add_argument('--expand-matrix',
+                        action='store_true',
+                        dest='expand_matrix',
+                        help='OPTIONAL: List the TPL specs left once \
+                            SPACK_CM_EXCLUDE_COMBOS is applied in tpl-spack.yaml \
+                            instead of letting spack expand the matrices.')
+    parser_installer.add_argument('--explain-schedule',
+                        action='store_true',
+                        dest='explain_schedule',
+                        help='OPTIONAL: Print the order in which the stages and \
+                            single stacks are expected to install and the \
+                            predicted makespan, from the recorded install times.')
     parser_installer.add_argument('--dry-run',
                         action='store_const',
                         dest='fake',
@@ -114,16 +211,234 @@ def buildParser():
                         const='--fake',
                         help='OPTIONAL: Only do a dry-run of an install for trial or debug purposes without installing anything.')
 
+    parser_plan.add_argument('-p', '--project',
+                        action='store',
+                        dest='project',
+                        help='REQUIRED: Project for which to plan TPLs (e.g., sems, pyomo, etc.).')
+    parser_plan.add_argument('-m', '--machine',
+                        action='store',
+                        dest='althostname',
+                        default=None,
+                        help='OPTIONAL: Designate an alternate platform name \
+                            (i.e., not the hostname of the machine).')
+    parser_plan.add_argument('-r', '--root',
+                        action='store',
+                        type=dir_path,
+                        dest='root_path',
+                        help='REQUIRED: Root path in which TPLs are installed (e.g. /project/sems, /project/pyomo, etc.).')
+    parser_plan.add_argument('-s', '--stage',
+                        action='store',
+                        dest='stage',
+                        default='all',
+                        help='OPTIONAL: Select a single stage of the \
+                            install to plan. By default, all stages are \
+                            planned. \
+                            Available choices: \
+                            [base, compiler, utility, tpl]')
+    parser_plan.add_argument('--spack',
+                        action='store',
+                        dest='spackbranch',
+                        default='v0.16.2',
+                        help='OPTIONAL: Branch of spack. Default: v0.16.2')
+    parser_plan.add_argument('-e', '--external',
+                        action='store_true',
+                        dest='external',
+                        help='OPTIONAL: Allow spack to find and use system packages.')
+    parser_plan.add_argument('--no-project-modules',
+                        action='store_false',
+                        dest='projmod',
+                        help='OPTIONAL: Turn off use of project name in modulefile generation.')
+    parser_plan.add_argument('--add-machine-to-install-path',
+                        action='store_true',
+                        dest='machine_path',
+                        help='OPTIONAL: Add the machine name to the install path.')
+    parser_plan.add_argument('--explicit-install-path',
+                        action='store',
+                        dest='user_specified_install_path',
+                        help='OPTIONAL: Exactly specify the install path for the package installations.')
+    parser_plan.add_argument('--explicit-modulefile-path',
+                        action='store',
+                        dest='user_specified_modulefile_path',
+                        help='OPTIONAL: Exactly specify the install path for module installations')
+    parser_plan.add_argument('--expand-matrix',
+                        action='store_true',
+                        dest='expand_matrix',
+                        help='OPTIONAL: List the TPL specs left once \
+                            SPACK_CM_EXCLUDE_COMBOS is applied in tpl-spack.yaml \
+                            instead of letting spack expand the matrices.')
+    parser_plan.add_argument('--spack-backend',
+                        action='store',
+                        choices=BACKENDS,
+                        dest='spack_backend',
+                        default='worker',
+                        help='OPTIONAL: Run spack commands in a long-lived spack \
+                            process (worker) or start spack for every command \
+                            (shell). Default: worker')
+
+    parser_query.add_argument('spec',
+                        action='store',
+                        nargs='?',
+                        default=None,
+                        help='OPTIONAL: Spec to match, e.g., \
+                            "hdf5@1.12%%gcc@10^openmpi". Versions match as \
+                            prefixes and dependencies match the MPI or CUDA \
+                            of an install. By default, every install is listed.')
+    parser_query.add_argument('-p', '--project',
+                        action='store',
+                        dest='project',
+                        help='REQUIRED: Project whose installs are queried (e.g., sems, pyomo, etc.).')
+    parser_query.add_argument('-m', '--machine',
+                        action='store',
+                        dest='althostname',
+                        default=None,
+                        help='OPTIONAL: Designate an alternate platform name \
+                            (i.e., not the hostname of the machine).')
+    parser_query.add_argument('-r', '--root',
+                        action='store',
+                        type=dir_path,
+                        dest='root_path',
+                        help='REQUIRED: Root path in which TPLs are installed (e.g. /project/sems, /project/pyomo, etc.).')
+    parser_query.add_argument('-s', '--stage',
+                        action='store',
+                        dest='stage',
+                        default=None,
+                        help='OPTIONAL: Only list the installs of one stage. \
+                            Available choices: \
+                            [base, lmod, compiler, utility, tpl]')
+    parser_query.add_argument('--prefix',
+                        action='store_true',
+                        dest='show_prefix',
+                        help='OPTIONAL: Print the install prefix of each spec.')
+    parser_query.add_argument('--add-machine-to-install-path',
+                        action='store_true',
+                        dest='machine_path',
+                        help='OPTIONAL: Add the machine name to the install path.')
+    parser_query.add_argument('--explicit-install-path',
+                        action='store',
+                        dest='user_specified_install_path',
+                        help='OPTIONAL: Exactly specify the install path for the package installations.')
+
+    parser_status.add_argument('-p', '--project',
+                        action='store',
+                        dest='project',
+                        help='REQUIRED: Project whose manifest is checked (e.g., sems, pyomo, etc.).')
+    parser_status.add_argument('-m', '--machine',
+                        action='store',
+                        dest='althostname',
+                        default=None,
+                        help='OPTIONAL: Designate an alternate platform name \
+                            (i.e., not the hostname of the machine).')
+    parser_status.add_argument('-r', '--root',
+                        action='store',
+                        type=dir_path,
+                        dest='root_path',
+                        help='REQUIRED: Root path in which TPLs are installed (e.g. /project/sems, /project/pyomo, etc.).')
+    parser_status.add_argument('-s', '--stage',
+                        action='store',
+                        dest='stage',
+                        default=None,
+                        help='OPTIONAL: Only report one stage. \
+                            Available choices: \
+                            [base, lmod, compiler, utility, tpl]')
+    parser_status.add_argument('--missing',
+                        action='store_true',
+                        dest='missing_only',
+                        help='OPTIONAL: Only print the specs that are not installed.')
+    parser_status.add_argument('--prefix',
+                        action='store_true',
+                        dest='show_prefix',
+                        help='OPTIONAL: Print the install prefix of each installed spec.')
+    parser_status.add_argument('--add-machine-to-install-path',
+                        action='store_true',
+                        dest='machine_path',
+                        help='OPTIONAL: Add the machine name to the install path.')
+    parser_status.add_argument('--explicit-install-path',
+                        action='store',
+                        dest='user_specified_install_path',
+                        help='OPTIONAL: Exactly specify the install path for the package installations.')
+
+    parser_batch.add_argument('file',
+                        action='store',
+                        help='REQUIRED: YAML file listing the project/machine \
+                            combinations to install and their install options.')
+    parser_batch.add_argument('--max-spack-processes',
+                        action='store',
+                        type=int,
+                        dest='max_spack',
+                        default=1,
+                        help='OPTIONAL: Maximum number of spack processes running \
+                            at the same time, over all combinations. Default: 1')
+    parser_batch.add_argument('--cores',
+                        action='store',
+                        type=int,
+                        dest='cores',
+                        default=None,
+                        help='OPTIONAL: Cores shared by all spack processes; each \
+                            builds with an equal share. Default: all cores')
+    parser_batch.add_argument('--spack',
+                        action='store',
+                        dest='spackbranch',
+                        default='v0.16.2',
+                        help='OPTIONAL: Branch of spack. Default: v0.16.2')
+    parser_batch.add_argument('--install-spack-deps',
+                        action='store_true',
+                        dest='spackdeps',
+                        help='OPTIONAL: Install spack system dependencies.')
+    parser_batch.add_argument('-d', '--debug',
+                        action='store_true',
+                        dest='debug',
+                        help='OPTIONAL: Enable "spack --debug" install mode.')
+    parser_batch.add_argument('--build-cache',
+                        action='store',
+                        dest='build_cache',
+                        default=None,
+                        help='OPTIONAL: Directory of a local spack build cache \
+                            shared by all combinations.')
+    parser_batch.add_argument('--build-cache-size',
+                        action='store',
+                        type=cache_size,
+                        dest='build_cache_size',
+                        default=None,
+                        help='OPTIONAL: Evict the least recently used packages \
+                            once the build cache of a platform is larger than \
+                            this size (e.g., 50G). Default: no limit')
+    parser_batch.add_argument('--spack-backend',
+                        action='store',
+                        choices=BACKENDS,
+                        dest='spack_backend',
+                        default='worker',
+                        help='OPTIONAL: Run spack commands in a long-lived spack \
+                            process (worker) or start spack for every command \
+                            (shell). Default: worker')
+    parser_batch.add_argument('--dry-run',
+                        action='store_const',
+                        dest='fake',
+                        default='',
+                        const='--fake',
+                        help='OPTIONAL: Only do a dry-run of the installs for trial or debug purposes without installing anything.')
+
     return parser
 
 
 def main(arguments):
-    project = arguments.project
+    # A batch names its projects and machines in its file, and does the
+    # shared spack setup once for all of them.
+    if arguments.command == 'batch':
+        if arguments.fake:
+            print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
+        set_backend(arguments.spack_backend)
+        check(arguments.spackbranch, arguments.spackdeps)
+        batch(arguments.file, arguments.max_spack, arguments.cores,
+              arguments.debug, arguments.fake, arguments.build_cache,
+              arguments.build_cache_size)
+        return
+    project = getattr(arguments, 'project', None)
     if project is None:
         error = "ERROR: Project is required. Please provide a project using the -p flag."
         logger.critical(error)
         raise MainException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-    spackbranch = arguments.spackbranch
+    # The query and status commands never run spack.
+    spackbranch = getattr(arguments, 'spackbranch', None)
     if arguments.althostname is not None:
         machine = arguments.althostname
     else:
@@ -157,16 +472,72 @@ def main(arguments):
         machine_path = arguments.machine_path
         generate_single_stacks = arguments.generate_single_stacks
         fake = arguments.fake
+        concurrent_stages = arguments.concurrent_stages
+        install_stacks = arguments.install_stacks
+        stack_workers = arguments.stack_workers
+        force = arguments.force
+        attempts = expand_stage_settings(arguments.attempts, list(STAGE_ATTEMPTS))
+        retry_jobs = arguments.retry_jobs
+        cleanup_policy = expand_stage_settings(arguments.cleanup_policy,
+                                               list(STAGE_ATTEMPTS))
+        build_cache = arguments.build_cache
+        build_cache_size = arguments.build_cache_size
         if fake:
             print(f'{pcolors.WARN}****** DRY RUN ******{pcolors.ENDC}')
+        set_backend(arguments.spack_backend)
         check(spackbranch, spackdeps)
         installer(project, machine, root_path, stage,
                   debug, external, fake, projmod, machine_path,
                   generate_single_stacks, user_specified_install_path,
-                  user_specified_modulefile_path)
+                  user_specified_modulefile_path,
+                  concurrent_stages=concurrent_stages,
+                  install_stacks=install_stacks,
+                  stack_workers=stack_workers,
+                  force=force,
+                  attempts=attempts,
+                  retry_jobs=retry_jobs,
+                  cleanup_policy=cleanup_policy,
+                  build_cache=build_cache,
+                  build_cache_size=build_cache_size,
+                  expand_matrix=arguments.expand_matrix,
+                  explain_schedule=arguments.explain_schedule)
+    # Run plan
+    elif arguments.command == 'plan':
+        root_path = arguments.root_path
+        user_specified_install_path = arguments.user_specified_install_path
+        user_specified_modulefile_path = arguments.user_specified_modulefile_path
+        if root_path is None:
+            if user_specified_install_path is None and user_specified_modulefile_path is None:
+                error = 'ERROR: Root path is required. Please provide a root path using the -r flag or specify exact paths with --explicit-install-path and --explicit-modulefile-path'
+                logger.critical(error)
+                raise MainException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        set_backend(arguments.spack_backend)
+        check(spackbranch, False)
+        plan(project, machine, root_path, arguments.stage,
+             arguments.external, arguments.projmod, arguments.machine_path,
+             user_specified_install_path, user_specified_modulefile_path,
+             arguments.expand_matrix)
+    # Run query
+    elif arguments.command == 'query':
+        if arguments.root_path is None and arguments.user_specified_install_path is None:
+            error = 'ERROR: Root path is required. Please provide a root path using the -r flag or specify the exact path with --explicit-install-path'
+            logger.critical(error)
+            raise MainException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        query(project, machine, arguments.root_path, arguments.spec,
+              arguments.stage, arguments.machine_path,
+              arguments.user_specified_install_path, arguments.show_prefix)
+    # Run status
+    elif arguments.command == 'status':
+        if arguments.root_path is None and arguments.user_specified_install_path is None:
+            error = 'ERROR: Root path is required. Please provide a root path using the -r flag or specify the exact path with --explicit-install-path'
+            logger.critical(error)
+            raise MainException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        status(project, machine, arguments.root_path, arguments.stage,
+               arguments.machine_path, arguments.user_specified_install_path,
+               arguments.show_prefix, arguments.missing_only)
     else:
-        error = 'ERROR: Must select either setup or install. \
-                        Please select one or the other.'
+        error = 'ERROR: Must select one of setup, install, plan, query, status or batch. \
+                        Please select one of them.'
         logger.critical(error)
         raise MainException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
 
@@ -0,0 +1,239 @@
+"""
+Expand spack spec matrices and apply their exclude rules before concretization
+"""
+
+from src.core.utilities import pcolors
+from src.core.packages import MPI_PACKAGES, version_key
+from functools import lru_cache
+import itertools
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+SPEC_SPLIT_RE = re.compile(r'\s*([%^])\s*')
+NODE_RE = re.compile(r'\s*(?:(?P<key>[\w-]+)=(?P<value>\S+)'
+                     r'|@(?P<version>[^\s+~@=]+)'
+                     r'|(?P<sign>[+~])\s*(?P<variant>[\w-]+)'
+                     r'|(?P<name>\w[\w.-]*))')
+
+
+class MatrixException(Exception):
+    """Catch all matrix exceptions"""
+    pass
+
+
+def parse_node(text, spec):
+    """
+    Parse one node of a spec: name@version followed by +variant, ~variant
+    or key=value settings.
+
+    Parameters
+    ----------
+    text : String
+        Text of the node.
+    spec : String
+        Whole spec, for error messages.
+
+    Returns
+    -------
+    node : Dictionary
+        'name' and 'version' (None when not given) and 'variants', mapping
+        each variant to True, False or its value.
+
+    """
+    node = {'name': None, 'version': None, 'variants': {}}
+    text = text.strip()
+    position = 0
+    while position < len(text):
+        match = NODE_RE.match(text, position)
+        if match is None or (match.group('name') and
+                             (node['name'] or node['version'] or node['variants'])):
+            error = 'ERROR: Unable to parse the spec "{}".'.format(spec)
+            logger.critical(error)
+            raise MatrixException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        if match.group('key'):
+            node['variants'][match.group('key')] = match.group('value')
+        elif match.group('version'):
+            node['version'] = match.group('version')
+        elif match.group('variant'):
+            node['variants'][match.group('variant')] = match.group('sign') == '+'
+        else:
+            node['name'] = match.group('name')
+        position = match.end()
+    return node
+
+
+def parse_spec(spec):
+    """
+    Parse a spec of the form
+    name[@version][variants][%compiler[@version]][^dependency[@version][variants]]...
+
+    Returns
+    -------
+    spec : Dictionary
+        Root node (see parse_node) with its 'compiler' node (None when not
+        given) and its 'dependencies' nodes keyed by name.
+
+    """
+    parts = SPEC_SPLIT_RE.split(spec.strip())
+    parsed = parse_node(parts[0], spec)
+    parsed['compiler'] = None
+    parsed['dependencies'] = {}
+    for sigil, text in zip(parts[1::2], parts[2::2]):
+        node = parse_node(text, spec)
+        if sigil == '%':
+            # Variants after the compiler belong to the root.
+            parsed['variants'].update(node['variants'])
+            node['variants'] = {}
+            parsed['compiler'] = node
+        elif node['name'] is None:
+            error = 'ERROR: Dependency without a name in the spec "{}".'.format(spec)
+            logger.critical(error)
+            raise MatrixException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        else:
+            parsed['dependencies'][node['name']] = node
+    return parsed
+
+
+def _version_range(version):
+    """
+    Lower and upper bounds of a version or version range (None when open).
+
+    """
+    low, colon, high = version.partition(':')
+    if not colon:
+        return version, version
+    return low or None, high or None
+
+
+def _at_most(low, high):
+    """
+    Whether a lower bound is below an upper bound, the upper bound including
+    the versions it is a prefix of (e.g., 10.1.0 is at most 10).
+
+    """
+    if low is None or high is None:
+        return True
+    low, high = version_key(low), version_key(high)
+    return low <= high or low[:len(high)] == high
+
+
+@lru_cache(maxsize=None)
+def versions_overlap(version, constraint):
+    """
+    Whether two versions, ranges or lists of ranges (e.g., 1.10, 1.8:1.10 or
+    1.8,1.10:) have a version in common. A missing version matches any.
+    Answers are cached, since the same few versions are compared over and
+    over.
+
+    """
+    if not version or not constraint:
+        return True
+    for first in version.split(','):
+        first_low, first_high = _version_range(first)
+        for second in constraint.split(','):
+            second_low, second_high = _version_range(second)
+            if _at_most(first_low, second_high) and _at_most(second_low, first_high):
+                return True
+    return False
+
+
+def nodes_overlap(node, constraint):
+    """
+    Whether a node could satisfy a constraint node. The virtual 'mpi' matches
+    any MPI, regardless of the version.
+
+    """
+    if constraint['name'] == 'mpi' and node['name'] in MPI_PACKAGES:
+        return True
+    if constraint['name'] and node['name'] and constraint['name'] != node['name']:
+        return False
+    if not versions_overlap(node['version'], constraint['version']):
+        return False
+    return all(node['variants'][name] == value
+               for name, value in constraint['variants'].items()
+               if name in node['variants'])
+
+
+def satisfies(spec, constraint):
+    """
+    Whether a matrix spec matches an exclude rule. Like spack's exclusion of
+    matrix combinations, only what both specs set is compared: a spec
+    without a compiler, a version or an MPI could still satisfy a rule
+    constraining them. A spec built with (or being) another MPI than the
+    one a rule names does not match it.
+
+    Parameters
+    ----------
+    spec : Dictionary
+        Parsed spec, see parse_spec.
+    constraint : Dictionary
+        Parsed exclude rule.
+
+    """
+    if not nodes_overlap(spec, constraint):
+        return False
+    if spec['compiler'] and constraint['compiler'] and \
+            not nodes_overlap(spec['compiler'], constraint['compiler']):
+        return False
+    # The MPI of a spec is the one it depends on, or itself for an MPI.
+    mpis = [node for node in [spec] + list(spec['dependencies'].values())
+            if node['name'] in MPI_PACKAGES]
+    for name, dependency in constraint['dependencies'].items():
+        if name in MPI_PACKAGES and mpis and name not in [node['name'] for node in mpis]:
+            return False
+        for node in spec['dependencies'].values():
+            if (node['name'] == name or (name == 'mpi' and node['name'] in MPI_PACKAGES)) \
+                    and not nodes_overlap(node, dependency):
+                return False
+    return True
+
+
+def expand_matrix(rows):
+    """
+    Specs of a spack matrix: every combination of one item of each row.
+
+    Parameters
+    ----------
+    rows : List
+        Rows of the matrix, e.g., [['hdf5', 'zlib'], ['%gcc@10.1.0']].
+
+    Returns
+    -------
+    specs : List
+        Specs of the matrix, e.g., ['hdf5 %gcc@10.1.0', 'zlib %gcc@10.1.0'].
+
+    """
+    return [' '.join(combination) for combination in itertools.product(*rows)]
+
+
+def expand_specs(matrices, excludes):
+    """
+    Expand the matrices of a stack and drop the specs matching its exclude
+    rules.
+
+    Parameters
+    ----------
+    matrices : List
+        Rows of each matrix of the stack, see expand_matrix.
+    excludes : List
+        Exclude rules, e.g., ['%gcc@10.1.0 ^openmpi@1.10.7'].
+
+    Returns
+    -------
+    expansion : Tuple
+        (specs kept, number of specs excluded).
+
+    """
+    rules = [parse_spec(rule) for rule in excludes if rule]
+    specs = []
+    excluded = 0
+    for rows in matrices:
+        for spec in expand_matrix(rows):
+            parsed = parse_spec(spec)
+            if any(satisfies(parsed, rule) for rule in rules):
+                logger.debug('Excluding {}.'.format(spec))
+                excluded += 1
+            else:
+                specs.append(spec)
+    return specs, excluded
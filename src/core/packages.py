@@ -3,23 +3,317 @@ Create packages.yaml file
 """
 
 from src.core.utilities import pcolors
-from os import makedirs
-from os.path import isdir, isfile
+from src.core.context import current_context
+from src.core.emitter import write_yaml
+from os import listdir, makedirs, remove, replace, stat, getpid
+from os.path import isdir, isfile, join
 import json
-import yaml
+import re
 import logging
 logger = logging.getLogger(__name__)
 
+# Records of a packages.yaml already reflected in it, kept next to the file.
+PACKAGES_STATE = '.packages.yaml.json'
+
+# Bytes of index.json read at a time while streaming it.
+CHUNK_SIZE = 1 << 20
+
+INSTALLS_RE = re.compile(r'"installs"\s*:\s*\{')
+WHITESPACE_RE = re.compile(r'[\s,]*')
+
+# Format of PACKAGES_STATE. Older states are regenerated from scratch.
+STATE_VERSION = 3
+
+# Values of SPACK_CM_EXTERNALS_MODE:
+#   latest:   keep the latest version of each package per compiler, MPI and
+#             CUDA (or the versions listed in SPACK_CM_EXTERNALS_VERSIONS).
+#   explicit: leave out the installs which are only dependencies.
+#   split:    also write each package to packages.d/<package>.yaml.
+EXTERNALS_MODES = ['latest', 'explicit', 'split']
+
+VERSION_SPLIT_RE = re.compile(r'[.\-_]')
+
+# Packages providing MPI.
+MPI_PACKAGES = {'openmpi', 'mpich', 'mvapich2', 'intel-mpi', 'intel-oneapi-mpi',
+                'intel-parallel-studio', 'spectrum-mpi', 'mpt', 'cray-mpich',
+                'hpcx-mpi', 'mpilander', 'msmpi', 'fujitsu-mpi'}
+
 
 class PackagesException(Exception):
     """Catch all packages exceptions"""
     pass
 
 
-def generate_packages_yaml(path, compiler_info=True):
+def iter_installs(index):
+    """
+    Stream the install records of a spack database one at a time, without
+    loading the whole index.json in memory.
+
+    Parameters
+    ----------
+    index : String
+        Path to .spack-db/index.json.
+
+    Yields
+    ------
+    record : Tuple
+        (hash, record) of each install.
+
+    """
+    decoder = json.JSONDecoder()
+    with open(index, 'r') as f:
+        buffer = ''
+        match = None
+        while match is None:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            buffer += chunk
+            match = INSTALLS_RE.search(buffer)
+        position = match.end()
+        eof = False
+        while True:
+            position = WHITESPACE_RE.match(buffer, position).end()
+            try:
+                if position < len(buffer) and buffer[position] == '}':
+                    return
+                key, end = decoder.raw_decode(buffer, position)
+                end = buffer.index(':', end) + 1
+                end = WHITESPACE_RE.match(buffer, end).end()
+                record, end = decoder.raw_decode(buffer, end)
+            except ValueError:
+                # The record runs past the buffer, read some more.
+                if eof:
+                    raise
+                chunk = f.read(CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield key, record
+            position = end
+
+
+def install_node(record):
+    """
+    Read the name, version, compiler and dependencies of an install record,
+    for both the dictionary and list node formats.
+
+    Returns
+    -------
+    node : Tuple
+        (name, version, compiler, dependency hashes).
+
+    """
+    spec = record['spec']
+    if 'name' in spec:
+        node = spec
+        dependencies = [dep['hash'] for dep in spec.get('dependencies', [])]
+    else:
+        name = list(spec.keys())[0]
+        node = dict(spec[name], name=name)
+        dependencies = [dep['hash'] for dep in node.get('dependencies', {}).values()]
+    compiler = node.get('compiler', {})
+    compiler = '{}@{}'.format(compiler['name'], compiler['version']) if compiler else ''
+    return node['name'], str(node.get('version', '')), compiler, dependencies
+
+
+def provenance(key, nodes, memo):
+    """
+    Find the MPI and CUDA an install was built with anywhere in its
+    dependency graph. Results are memoized, so resolving every install of a
+    database visits each install only once.
+
+    Parameters
+    ----------
+    key : String
+        Hash of the install.
+    nodes : Dictionary
+        Hash of every install mapped to its install_node.
+    memo : Dictionary
+        Provenance already resolved, updated in place.
+
+    Returns
+    -------
+    provenance : Tuple
+        (mpi, cuda) as name@version, or None when not used.
+
+    """
+    if key in memo:
+        return memo[key]
+    memo[key] = (None, None)
+    mpi = cuda = None
+    for dep in nodes[key][3]:
+        if dep not in nodes:
+            continue
+        name, version = nodes[dep][:2]
+        if name in MPI_PACKAGES:
+            dep_mpi, dep_cuda = '{}@{}'.format(name, version), provenance(dep, nodes, memo)[1]
+        elif name == 'cuda':
+            dep_mpi, dep_cuda = None, '{}@{}'.format(name, version)
+        else:
+            dep_mpi, dep_cuda = provenance(dep, nodes, memo)
+        mpi = mpi or dep_mpi
+        cuda = cuda or dep_cuda
+    memo[key] = (mpi, cuda)
+    return memo[key]
+
+
+def package_external(key, nodes, prefix, memo, compiler_info=True, explicit=True):
+    """
+    Turn an install into an external of packages.yaml whose spec pins the
+    compiler, MPI and CUDA the install was built with.
+
+    Parameters
+    ----------
+    key : String
+        Hash of the install.
+    nodes : Dictionary
+        Hash of every install mapped to its install_node.
+    prefix : String
+        Install prefix.
+    memo : Dictionary
+        Provenance already resolved, see provenance.
+    compiler_info: Boolean
+        Add compiler info to the spec. The default is True.
+    explicit : Boolean, optional
+        Whether the install is an explicit one. The default is True.
+
+    Returns
+    -------
+    external : List
+        [package, spec, prefix, version, explicit], or None if the package
+        is left out.
+
+    """
+    package, version, compiler, dependencies = nodes[key]
+    if package == 'py-setuptools':
+        return None
+    spec = package + '@' + version
+    if compiler_info:
+        spec += '%' + compiler
+        for dependency in provenance(key, nodes, memo):
+            if dependency:
+                spec += '^' + dependency
+    return [package, spec, prefix, version, explicit]
+
+
+def externals_options(context=None):
+    """
+    Read how externals are emitted from the project manifest.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    options : Dictionary
+        Modes of SPACK_CM_EXTERNALS_MODE mapped to whether they are on,
+        'versions' to SPACK_CM_EXTERNALS_VERSIONS and 'non_buildable' to
+        SPACK_CM_NON_BUILDABLE.
+
+    """
+    context = current_context(context)
+
+    def setting(name):
+        return [value for value in context.values(name, ['']) if value]
+    modes = setting('SPACK_CM_EXTERNALS_MODE')
+    unknown = [mode for mode in modes if mode not in EXTERNALS_MODES]
+    if unknown:
+        error = 'ERROR: Unknown SPACK_CM_EXTERNALS_MODE {}. Available choices: {}.'.format(
+            ', '.join(unknown), ', '.join(EXTERNALS_MODES))
+        logger.critical(error)
+        raise PackagesException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    options = {mode: mode in modes for mode in EXTERNALS_MODES}
+    options['versions'] = setting('SPACK_CM_EXTERNALS_VERSIONS')
+    options['non_buildable'] = setting('SPACK_CM_NON_BUILDABLE')
+    return options
+
+
+def version_key(version):
+    """
+    Sort key of a version, comparing its numeric parts as numbers.
+
+    """
+    return [(1, int(part)) if part.isdigit() else (0, part)
+            for part in VERSION_SPLIT_RE.split(version)]
+
+
+def compact_externals(externals, options):
+    """
+    Select and group the externals emitted in packages.yaml.
+
+    Parameters
+    ----------
+    externals : List
+        Externals, see package_external.
+    options : Dictionary
+        Emission options, see externals_options.
+
+    Returns
+    -------
+    packages : Dictionary
+        Contents of packages.yaml.
+
+    """
+    versions = {}
+    for spec in options['versions']:
+        package, _, version = spec.partition('@')
+        versions.setdefault(package, []).append(version)
+    latest = {}
+    selected = []
+    for external in externals:
+        if external is None or (options['explicit'] and not external[4]):
+            continue
+        package, spec, prefix, version = external[:4]
+        if package in versions:
+            if not any(not wanted or version == wanted or version.startswith(wanted + '.')
+                       for wanted in versions[package]):
+                continue
+        elif options['latest']:
+            # Everything but the version identifies the build configuration.
+            configuration = (package, spec[len(package) + 1 + len(version):])
+            if configuration in latest and \
+                    version_key(latest[configuration][3]) >= version_key(version):
+                continue
+            latest[configuration] = external
+            continue
+        selected.append(external)
+    selected += list(latest.values())
+    packages = {'packages': {}}
+    for package, spec, prefix, version, explicit in selected:
+        if package not in packages['packages']:
+            packages['packages'][package] = {'buildable': package not in options['non_buildable'],
+                                             'externals': []}
+        packages['packages'][package]['externals'].append({'spec': spec,
+                                                           'prefix': prefix})
+    return packages
+
+
+def split_packages_yaml(path, packages):
+    """
+    Write each package of a packages.yaml to its own
+    packages.d/<package>.yaml, removing the files of packages no longer
+    listed.
+
+    """
+    directory = join(path, 'packages.d')
+    makedirs(directory, exist_ok=True)
+    for package, entry in packages['packages'].items():
+        write_yaml(join(directory, package + '.yaml'), {'packages': {package: entry}})
+    for name in listdir(directory):
+        if name.endswith('.yaml') and name[:-len('.yaml')] not in packages['packages']:
+            remove(join(directory, name))
+
+
+def generate_packages_yaml(path, compiler_info=True, options=None, context=None):
     """
     Generate a packages.yaml based on the Spack-generated
-    .spack-db/index.json file.
+    .spack-db/index.json file. Only the installs added or removed since the
+    last generation are processed, and the file is left alone when neither
+    the index nor the options changed.
 
     Parameters
     ----------
@@ -27,8 +321,16 @@ def generate_packages_yaml(path, compiler_info=True):
         Full path to an installation location.
     compiler_info: Boolean
         Add compiler info to the spec in packages.yaml. The default is True.
+    options : Dictionary, optional
+        Emission options, see externals_options. The default is read from
+        the project manifest.
+    context : ProjectContext, optional
+        Settings of the project, used when no options are given. The
+        default is read from os.environ.
 
     """
+    if options is None:
+        options = externals_options(context)
     if not isdir(path):
         try:
             makedirs(path)
@@ -36,51 +338,57 @@ def generate_packages_yaml(path, compiler_info=True):
             error = 'ERROR: Creation of {} failed with error {}.'.format(path, e)
             logger.critical(error)
             raise PackagesException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-    packages_file = path + '/packages.yaml'
-    if not isfile(packages_file):
+    packages_file = join(path, 'packages.yaml')
+    state_file = join(path, PACKAGES_STATE)
+    index = join(path, '.spack-db', 'index.json')
+    info = stat(index)
+    signature = [info.st_size, info.st_mtime, compiler_info, options]
+    state = {'signature': None, 'externals': {}}
+    if isfile(packages_file) and isfile(state_file):
         try:
-            open(packages_file, 'w').close()
+            with open(state_file, 'r') as f:
+                state = json.load(f)
         except Exception as e:
-            error = 'ERROR: Creation of {} failed with error {}.'.format(packages_file, e)
-            logger.critical(error)
-            raise PackagesException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-    install_path = path
-    path = install_path + '/.spack-db/index.json'
-    logger.info('Creating new packages.yaml file in {}.'.format(packages_file))
-    print('Creating new packages.yaml file in {}.'.format(packages_file))
-    with open(path, 'r') as f:
-        contents = json.load(f)
-    installs = contents['database']['installs']
-    packages = {'packages' : {}}
+            logger.warning('Ignoring unreadable {}: {}'.format(state_file, e))
+        if state.get('compiler_info') != compiler_info \
+                or state.get('version') != STATE_VERSION:
+            state = {'signature': None, 'externals': {}}
+    if state['signature'] == signature:
+        logger.info('{} is up to date.'.format(packages_file))
+        return
+    logger.info('Updating packages.yaml file in {}.'.format(packages_file))
+    print('Updating packages.yaml file in {}.'.format(packages_file))
     try:
-        for sha in installs.keys():
-            package = list(installs[sha]['spec'].keys())[0]
-            if package == 'py-setuptools':
-                continue
-            version = installs[sha]['spec'][package]['version']
-            path = installs[sha]['path']
-            if compiler_info:
-                compiler = installs[sha]['spec'][package]['compiler']
-                compiler = compiler['name'] + '@' + compiler['version']
-                spec = package + '@' + version + '%' + compiler
-                if 'dependencies' in installs[sha]['spec'][package]:
-                    for key in installs[sha]['spec'][package]['dependencies'].keys():
-                        if 'mpi' in key:
-                            mpi = path.split('/')[-2:]
-                            spec += '^' + mpi[0] + '@' + mpi[1]
-            else:
-                spec = package + '@' + version
-            if package in packages['packages']:
-                packages['packages'][package]['externals'].append({'spec' : spec,
-                                                            'prefix' : path})
+        known = state['externals']
+        nodes = {}
+        prefixes = {}
+        for sha, record in iter_installs(index):
+            nodes[sha] = install_node(record)
+            if sha not in known:
+                prefixes[sha] = (record['path'], bool(record.get('explicit', True)))
+        memo = {}
+        externals = {}
+        for sha in nodes:
+            if sha in known:
+                externals[sha] = known[sha]
             else:
-               packages['packages'][package] = {'buildable' : True,
-                                                'externals' : []}
-               packages['packages'][package]['externals'].append({'spec' : spec,
-                                                            'prefix' : path})
-        with open(packages_file, 'w') as f:
-            yaml.dump(packages, f, sort_keys=False)
+                prefix, explicit = prefixes[sha]
+                externals[sha] = package_external(sha, nodes, prefix, memo,
+                                                  compiler_info, explicit)
+        added = len(prefixes)
+        removed = len(known) - (len(externals) - added)
+        logger.info('{} installs added and {} removed.'.format(added, removed))
+        if added or removed or state.get('options') != options:
+            packages = compact_externals(externals.values(), options)
+            write_yaml(packages_file, packages)
+            if options['split']:
+                split_packages_yaml(path, packages)
+        with open('{}.{}.tmp'.format(state_file, getpid()), 'w') as f:
+            json.dump({'version': STATE_VERSION, 'signature': signature,
+                       'compiler_info': compiler_info, 'options': options,
+                       'externals': externals}, f)
+        replace('{}.{}.tmp'.format(state_file, getpid()), state_file)
     except Exception as e:
-        error = 'ERROR: Packages.yaml creation in {} failed with error {}.'.format(install_path, e)
+        error = 'ERROR: Packages.yaml creation in {} failed with error {}.'.format(path, e)
         logger.critical(error)
         raise PackagesException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
@@ -0,0 +1,238 @@
+"""
+Preview which specs an install would build and which it would reuse
+"""
+
+from os.path import split, abspath, dirname, isdir, join
+from src.core.cleanup import cleanup
+from src.core.context import current_context
+from src.core.generate import generate_yamls
+from src.core.installer import (STAGE_SELECTIONS, STAGE_PACKAGES, STAGE_FILES,
+                                STAGE_INSTALL_PATHS)
+from src.core.journal import yaml_fingerprint
+from src.core.lockcache import restore_lock, save_lock
+from src.core.lockfile import read_lock, lock_nodes, database_nodes, resolve_dag_hashes
+from src.core.backend import spack_command
+from src.core.timings import spec_estimates, format_seconds
+from src.core.utilities import (copy_spack_yaml, check_project_yaml_files,
+                                stage_env_dir, pcolors)
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PlanException(Exception):
+    """Catch all plan exceptions"""
+    pass
+
+
+def lock_specs(lockfile, install_path):
+    """
+    Read the concrete specs of a spack.lock with their DAG hash, see
+    lockfile.lock_nodes and lockfile.resolve_dag_hashes.
+
+    Parameters
+    ----------
+    lockfile : String
+        Path to the spack.lock.
+    install_path : String
+        Install tree of the stage, the DAG hashes a spack 0.16 lockfile
+        does not hold are looked up in it.
+
+    Returns
+    -------
+    specs : List
+        Dictionaries with the lock key, DAG hash (None if unknown), name,
+        version, compiler and whether the spec is external.
+
+    """
+    nodes = lock_nodes(read_lock(lockfile))
+    hashes = resolve_dag_hashes(nodes, database_nodes(install_path))
+    return [{'key': key,
+             'hash': hashes[key],
+             'name': node['name'],
+             'version': node['version'],
+             'compiler': node['compiler'],
+             'external': node['external']} for key, node in nodes.items()]
+
+
+def concretize_stage(project, machine, name, external, context=None):
+    """
+    Concretize the environment of a stage without installing it.
+
+    Parameters
+    ----------
+    project : String
+        The project to plan.
+    machine : String
+        The machine to plan for.
+    name : String
+        The stage to concretize.
+    external : Boolean
+        Turn on 'spack external find'.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    lockfile : String
+        Path to the resulting spack.lock.
+
+    """
+    filedir, filename = split(abspath(__file__))
+    projectdir = dirname(filedir) + '/project/{}'.format(project)
+    envdir = stage_env_dir(project, machine, 'plan-' + name)
+    copy_spack_yaml(project, STAGE_FILES[name], envdir)
+    cleanup(envdir, external, policy='none', machine=machine)
+    inputs = yaml_fingerprint(join(projectdir, STAGE_FILES[name]))
+    if not restore_lock(inputs, envdir, context):
+        returncode, output = spack_command(['concretize'], env=envdir)
+        if returncode != 0:
+            error = 'ERROR: Unable to concretize the {} stage.'.format(name)
+            logger.critical(error)
+            raise PlanException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        save_lock(inputs, envdir, context)
+    return join(envdir, 'spack.lock')
+
+
+def stage_plan(name, lockfile, estimates, install_path=None, context=None):
+    """
+    Split the specs of a concretized stage into those to build, to reuse and
+    provided externally.
+
+    Parameters
+    ----------
+    name : String
+        The stage.
+    lockfile : String
+        Path to the stage's spack.lock.
+    estimates : Dictionary
+        Recorded install times, see timings.spec_estimates.
+    install_path : String, optional
+        Install tree of the stage. The default is that of the context.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    plan : Dictionary
+        Lists of specs under 'build', 'reuse' and 'external', and the
+        estimated build time and number of specs without an estimate.
+
+    """
+    install_path = install_path or current_context(context).value(STAGE_INSTALL_PATHS[name])
+    installed = database_nodes(install_path)
+    plan = {'build': [], 'reuse': [], 'external': [], 'seconds': 0.0,
+            'unknown': 0}
+    for spec in sorted(lock_specs(lockfile, install_path), key=lambda spec: spec['name']):
+        if spec['external']:
+            plan['external'].append(spec)
+        elif spec['hash'] in installed:
+            plan['reuse'].append(spec)
+        else:
+            estimate = estimates.get((spec['name'], spec['version'], spec['compiler']),
+                                     estimates.get(spec['name']))
+            spec['estimate'] = estimate
+            if estimate is None:
+                plan['unknown'] += 1
+            else:
+                plan['seconds'] += estimate
+            plan['build'].append(spec)
+    return plan
+
+
+def print_plan(name, plan):
+    """
+    Print the plan of a stage.
+
+    """
+    estimate = format_seconds(plan['seconds'])
+    if plan['unknown']:
+        estimate += ' + {} spec(s) without history'.format(plan['unknown'])
+    print(f"{pcolors.OKCYAN}{name}: build {len(plan['build'])}, reuse {len(plan['reuse'])}, "
+          f"external {len(plan['external'])}. Estimated build time: {estimate}.{pcolors.ENDC}")
+    for spec in plan['build']:
+        time = format_seconds(spec['estimate']) if spec['estimate'] is not None else '?'
+        print('  build  {:>10}  {}@{}{} /{}'.format(
+            time, spec['name'], spec['version'],
+            ' %' + spec['compiler'] if spec['compiler'] else '',
+            (spec['hash'] or spec['key'])[:7]))
+
+
+def plan(project, machine, path, stage, external, projmod, machine_path,
+         explicit_install_path, explicit_modulefiles_path, expand_matrix=False):
+    """
+    Concretize the selected stages and report which specs would be built
+    and which are already installed, without installing anything.
+
+    Parameters
+    ----------
+    project : String
+        The project to plan.
+    machine : String
+        The machine to plan for.
+    path : String
+        The root path for installation and module file generation.
+    stage : String
+        The stage of installation to plan.
+        Options: all, base, compiler, utility, tpl.
+    external : Boolean
+        Turn on 'spack external find'.
+    projmod : Boolean
+        Turn on replacement of $PROJECT_NAME in modules.yaml file.
+    machine_path: Boolean
+        Add the machine name to the install path.
+    explicit_install_path: String
+        Exact installation root path to use. Default: None
+    explicit_modulefiles_path: String
+        Exact module files root path to use. Default: None
+    expand_matrix: Boolean
+        Write the TPL specs left once the exclude rules are applied instead
+        of the matrices. Default: False
+
+    Returns
+    -------
+    plans : Dictionary
+        Stage name mapped to its plan, see stage_plan.
+
+    """
+    filedir, filename = split(abspath(__file__))
+    for kind, name in [('Project', 'project/{}'.format(project)),
+                       ('Platform', 'platform/{}'.format(machine))]:
+        if not isdir(join(dirname(filedir), name)):
+            error = 'ERROR: {} directory {} does not exist.\n\
+                        Please run "spack-cm setup" first.'.format(kind, join(dirname(filedir), name))
+            logger.critical(error)
+            raise PlanException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    if stage not in STAGE_SELECTIONS:
+        error = 'ERROR: Unknown stage {}. Available choices: {}.'.format(
+            stage, ', '.join(STAGE_SELECTIONS))
+        logger.critical(error)
+        raise PlanException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    context = generate_yamls(project, machine, path, projmod, machine_path, False,
+                             explicit_install_path, explicit_modulefiles_path, expand_matrix)
+    check_project_yaml_files(context)
+    estimates = spec_estimates(context)
+    plans = {}
+    failed = []
+    for name in STAGE_SELECTIONS[stage]:
+        packages = STAGE_PACKAGES[name]
+        if packages is not None and context.value(packages) == '':
+            continue
+        try:
+            lockfile = concretize_stage(project, machine, name, external, context)
+        except Exception as e:
+            logger.critical('ERROR: Unable to plan the {} stage: {}'.format(name, e))
+            failed.append(name)
+            continue
+        plans[name] = stage_plan(name, lockfile, estimates,
+                                 context.value(STAGE_INSTALL_PATHS[name]))
+    print('\n' + 50*'*')
+    for name, stage_result in plans.items():
+        print_plan(name, stage_result)
+    total = sum(len(result['build']) for result in plans.values())
+    seconds = sum(result['seconds'] for result in plans.values())
+    print(f'{pcolors.OKBLUE}TOTAL: {total} spec(s) to build. Estimated build time: {format_seconds(seconds)}.{pcolors.ENDC}')
+    if failed:
+        error = 'ERROR: Unable to plan stages {}. Stages whose dependencies are not installed yet cannot be concretized.'.format(', '.join(failed))
+        logger.critical(error)
+        raise PlanException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    return plans
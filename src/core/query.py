@@ -0,0 +1,89 @@
+"""
+Answer questions about the installed specs from the install index
+"""
+
+from src.core.utilities import install_paths, pcolors
+from src.core.context import ProjectContext
+from src.core.installer import STAGE_INSTALL_PATHS
+from src.core.index import update_index, search, index_file
+from os.path import isdir
+import logging
+logger = logging.getLogger(__name__)
+
+
+class QueryException(Exception):
+    """Catch all query exceptions"""
+    pass
+
+
+def format_install(install):
+    """
+    Format an install as name@version %compiler ^mpi ^cuda.
+
+    """
+    line = '{}@{}'.format(install['name'], install['version'])
+    if install['compiler']:
+        line += ' %' + install['compiler']
+    for dependency in [install['mpi'], install['cuda']]:
+        if dependency:
+            line += ' ^' + dependency
+    return line
+
+
+def query(project, machine, path, spec=None, stage=None, machine_path=False,
+          explicit_install_path=None, show_prefix=False):
+    """
+    List the installed specs matching a spec, without starting spack. The
+    index is first brought up to date with any spack database that changed.
+
+    Parameters
+    ----------
+    project : String
+        The project to query.
+    machine : String
+        The machine to query.
+    path : String
+        The root path for installation.
+    spec : String, optional
+        Spec to match, e.g., hdf5@1.12%gcc@10^openmpi. The default lists
+        every install.
+    stage : String, optional
+        Only list the installs of this stage.
+    machine_path: Boolean, optional
+        Add the machine name to the install path. The default is False.
+    explicit_install_path: String, optional
+        Exact installation root path to use. Default: None
+    show_prefix : Boolean, optional
+        Print the install prefix of each spec. The default is False.
+
+    Returns
+    -------
+    installs : List
+        The matching installs, see index.search.
+
+    """
+    # Modulefiles are never looked at, any path will do without a root.
+    install_path, module_path = install_paths(project, machine, path, machine_path,
+                                              explicit_install_path,
+                                              explicit_install_path if path is None else None)
+    if not isdir(install_path):
+        error = 'ERROR: Install path {} does not exist.'.format(install_path)
+        logger.critical(error)
+        raise QueryException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    if stage is not None and stage not in STAGE_INSTALL_PATHS:
+        error = 'ERROR: Unknown stage {}. Available choices: {}.'.format(
+            stage, ', '.join(STAGE_INSTALL_PATHS))
+        logger.critical(error)
+        raise QueryException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    context = ProjectContext(project, machine, install_path, module_path)
+    for name, variable in STAGE_INSTALL_PATHS.items():
+        update_index(name, context.value(variable), context)
+    installs = search(spec, stage, context)
+    logger.info('{} installs match {} in {}.'.format(len(installs), spec, index_file(context)))
+    for install in installs:
+        line = '{:<9} {}'.format(install['stage'], format_install(install))
+        if show_prefix:
+            line += '\n          ' + install['prefix']
+        print(line)
+    print(f'{pcolors.OKBLUE}{len(installs)} install(s) found.{pcolors.ENDC}')
+    return installs
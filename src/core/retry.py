@@ -0,0 +1,116 @@
+"""
+Find the specs that failed in a spack install so only they are retried
+"""
+
+from src.core.lockfile import read_lock, lock_nodes
+from os.path import isfile, join
+import re
+import logging
+logger = logging.getLogger(__name__)
+
+# Spack reports a failed build as "Failed to install <pkg> due to ...".
+# Newer versions use "<name>-<version>-<hash>" as <pkg>.
+FAILED_RE = re.compile(r'Failed to install (\S+?)(?: due to|:|$)')
+PKG_ID_RE = re.compile(r'^(.+)-[^-]+-([a-z0-9]{32})$')
+
+
+def failed_packages(lines):
+    """
+    Extract the names of the packages spack failed to install.
+
+    Parameters
+    ----------
+    lines : List
+        Output lines of a spack install.
+
+    Returns
+    -------
+    packages : Set
+        Names of the failed packages.
+
+    """
+    packages = set()
+    for line in lines:
+        match = FAILED_RE.search(line)
+        if match is None:
+            continue
+        package = match.group(1)
+        pkg_id = PKG_ID_RE.match(package)
+        if pkg_id is not None:
+            package = pkg_id.group(1)
+        packages.add(package)
+    return packages
+
+
+def failed_roots(envdir, packages):
+    """
+    Find the root specs of a concretized environment that depend on (or
+    are) one of the failed packages.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory holding spack.lock.
+    packages : Set
+        Names of the failed packages.
+
+    Returns
+    -------
+    roots : List
+        Abstract root specs to retry. Empty if the environment was not
+        concretized or no root could be matched.
+
+    """
+    lockfile = join(envdir, 'spack.lock')
+    if not packages or not isfile(lockfile):
+        return []
+    try:
+        lock = read_lock(lockfile)
+        nodes = lock_nodes(lock)
+        broken = {}
+
+        def is_broken(key):
+            if key not in broken:
+                broken[key] = False
+                node = nodes.get(key, {'name': None, 'dependencies': []})
+                broken[key] = node['name'] in packages or \
+                    any(is_broken(dep) for dep in node['dependencies'])
+            return broken[key]
+
+        return [root['spec'] for root in lock.get('roots', [])
+                if is_broken(root['hash'])]
+    except Exception as e:
+        logger.warning('Unable to read failed roots from {}: {}'.format(lockfile, e))
+        return []
+
+
+def failed_specs(envdir, packages):
+    """
+    Find the failed packages in a concretized environment, to match them
+    with their build stages.
+
+    Parameters
+    ----------
+    envdir : String
+        Spack environment directory holding spack.lock.
+    packages : Set
+        Names of the failed packages.
+
+    Returns
+    -------
+    specs : List
+        (name, version, DAG hash) of the failed specs. The DAG hash is None
+        when the lockfile does not hold it (spack 0.16 and older), failed
+        specs are not installed so it cannot be looked up either.
+
+    """
+    lockfile = join(envdir, 'spack.lock')
+    if not packages or not isfile(lockfile):
+        return []
+    try:
+        return [(node['name'], node['version'], node['dag_hash'])
+                for node in lock_nodes(read_lock(lockfile)).values()
+                if node['name'] in packages]
+    except Exception as e:
+        logger.warning('Unable to read failed specs from {}: {}'.format(lockfile, e))
+        return []
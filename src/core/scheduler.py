@@ -0,0 +1,212 @@
+"""
+Run dependent tasks concurrently
+"""
+
+from src.core.utilities import pcolors
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SchedulerException(Exception):
+    """Catch all scheduler exceptions"""
+    pass
+
+
+def check_graph(tasks, dependencies):
+    """
+    Make sure the dependencies between tasks do not form a cycle.
+
+    Parameters
+    ----------
+    tasks : List
+        Names of the tasks to run.
+    dependencies : Dictionary
+        Task name mapped to the names of the tasks it needs. Names which
+        are not in tasks are ignored.
+
+    """
+    remaining = {name: set(dependencies.get(name, [])) & set(tasks)
+                 for name in tasks}
+    while remaining:
+        ready = [name for name in remaining if not remaining[name]]
+        if not ready:
+            error = 'ERROR: Tasks {} depend on each other in a cycle.'.format(sorted(remaining))
+            logger.critical(error)
+            raise SchedulerException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+        for name in ready:
+            del remaining[name]
+        for needs in remaining.values():
+            needs.difference_update(ready)
+
+
+def critical_paths(durations, dependencies):
+    """
+    Length of the longest chain of tasks starting at each task: its own
+    duration plus the longest chain among the tasks needing it. Starting
+    the tasks with the longest chains first keeps the critical path busy.
+
+    Parameters
+    ----------
+    durations : Dictionary
+        Task name mapped to its expected duration.
+    dependencies : Dictionary
+        Task name mapped to the names of the tasks it needs. Names which
+        are not in durations are ignored.
+
+    Returns
+    -------
+    paths : Dictionary
+        Task name mapped to the length of its longest chain.
+
+    """
+    check_graph(list(durations), dependencies)
+    needed_by = {name: [] for name in durations}
+    for name in durations:
+        for need in set(dependencies.get(name, [])) & set(durations):
+            needed_by[need].append(name)
+    paths = {}
+
+    def path(name):
+        if name not in paths:
+            paths[name] = durations[name] + max([path(user) for user in needed_by[name]],
+                                                default=0)
+        return paths[name]
+
+    for name in durations:
+        path(name)
+    return paths
+
+
+def simulate(durations, dependencies, max_workers=1, priorities=None):
+    """
+    Predict when each task starts and ends when run by run_graph.
+
+    Parameters
+    ----------
+    durations : Dictionary
+        Task name mapped to its expected duration, in the order of the
+        tasks given to run_graph.
+    dependencies : Dictionary
+        Task name mapped to the names of the tasks it needs.
+    max_workers : Integer, optional
+        Maximum number of tasks running at the same time. The default is 1.
+    priorities : Dictionary, optional
+        Task name mapped to its priority, see run_graph.
+
+    Returns
+    -------
+    schedule : List
+        (name, start, end) of each task, by start time. The makespan is the
+        largest end.
+
+    """
+    check_graph(list(durations), dependencies)
+    needs = {name: set(dependencies.get(name, [])) & set(durations)
+             for name in durations}
+    pending = ready_order(list(durations), priorities)
+    finished = set()
+    running = []
+    schedule = []
+    now = 0
+    while pending or running:
+        for name in list(pending):
+            if len(running) >= max_workers:
+                break
+            if needs[name] <= finished:
+                pending.remove(name)
+                running.append((now + durations[name], name))
+                schedule.append((name, now, now + durations[name]))
+        running.sort()
+        now, name = running.pop(0)
+        finished.add(name)
+        # Tasks ending at the same time free their workers together.
+        while running and running[0][0] == now:
+            finished.add(running.pop(0)[1])
+    return schedule
+
+
+def ready_order(names, priorities=None):
+    """
+    Order in which ready tasks are started: highest priority first, then
+    in the order given.
+
+    """
+    if not priorities:
+        return list(names)
+    return sorted(names, key=lambda name: -priorities.get(name, 0))
+
+
+def run_graph(tasks, dependencies, max_workers=1, priorities=None):
+    """
+    Run tasks as soon as the tasks they depend on have finished, with at
+    most max_workers of them running at once.
+
+    If a task fails, the tasks depending on it are skipped while the
+    independent ones run to completion.
+
+    Parameters
+    ----------
+    tasks : Dictionary
+        Task name mapped to a callable taking no arguments. Ready tasks are
+        started in insertion order.
+    dependencies : Dictionary
+        Task name mapped to the names of the tasks it needs. Names which
+        are not in tasks are ignored.
+    max_workers : Integer, optional
+        Maximum number of tasks running at the same time. The default is 1.
+    priorities : Dictionary, optional
+        Task name mapped to its priority (e.g., its critical path, see
+        critical_paths). Ready tasks with a higher priority start first.
+        The default starts them in insertion order.
+
+    Returns
+    -------
+    results : Dictionary
+        Task name mapped to the return value of its callable.
+
+    """
+    if max_workers < 1:
+        error = 'ERROR: At least one task must be allowed to run at a time.'
+        logger.critical(error)
+        raise SchedulerException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    check_graph(list(tasks), dependencies)
+    needs = {name: set(dependencies.get(name, [])) & set(tasks)
+             for name in tasks}
+    pending = ready_order(list(tasks), priorities)
+    results = {}
+    failed = []
+    skipped = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if needs[name] & set(failed + skipped):
+                    pending.remove(name)
+                    skipped.append(name)
+                    warn = 'WARNING: {} skipped because a task it depends on failed.'.format(name)
+                    logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+                    continue
+                if needs[name] <= set(results):
+                    pending.remove(name)
+                    logger.info('Starting {}.'.format(name))
+                    running[pool.submit(tasks[name])] = name
+            if not running:
+                continue
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    logger.info('Finished {}.'.format(name))
+                except Exception as e:
+                    failed.append(name)
+                    logger.critical('ERROR: {} failed with error {}'.format(name, e))
+    if failed:
+        error = 'ERROR: {} failed. Skipped: {}.'.format(', '.join(failed),
+                                                       ', '.join(skipped) or 'none')
+        logger.critical(error)
+        raise SchedulerException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    return results
@@ -0,0 +1,138 @@
+"""
+Long-lived spack worker for spack-cm.
+
+Run with 'spack python spack_worker.py'. The worker reads one JSON request
+per line on stdin and answers each with one JSON line on stdout:
+
+    {"args": ["find", "--json"], "env": "/path/to/env", "environ": {...}}
+    -> {"returncode": 0, "output": "...", "error": false}
+
+"environ" is spack-cm's whole process environment, which every command
+runs with. "error" is true when the command raised instead of returning,
+so spack-cm runs it again through the shell.
+
+The requested environment stays active across commands and is only
+re-activated when a different environment is requested or its spack.yaml
+or spack.lock changed. This file is executed by spack's interpreter, so it
+must not import anything from spack-cm.
+"""
+
+import json
+import os
+import sys
+import traceback
+
+import spack.config
+import spack.environment as ev
+from spack.main import SpackCommand
+
+active = {'key': None}
+
+# Environment the worker started with.
+startup_environ = dict(os.environ)
+
+
+def environment_key(path):
+    """
+    Identify an environment directory and the state of its files.
+
+    """
+    if path is None:
+        return None
+    key = [path]
+    for name in ['spack.yaml', 'spack.lock']:
+        filename = os.path.join(path, name)
+        key.append(os.path.getmtime(filename) if os.path.exists(filename) else None)
+    return tuple(key)
+
+
+def activate(path):
+    """
+    Make the environment at path (or none) the active environment.
+
+    """
+    key = environment_key(path)
+    if key == active['key']:
+        return
+    if active['key'] is not None:
+        ev.deactivate()
+    active['key'] = None
+    if path is not None:
+        ev.activate(ev.Environment(path))
+        active['key'] = key
+
+
+def clear_caches():
+    """
+    Drop cached configuration, which spack-cm may change between commands.
+
+    """
+    # spack.config.config was renamed spack.config.CONFIG in spack 0.21.
+    config = getattr(spack.config, 'CONFIG', None) or getattr(spack.config, 'config', None)
+    clear = getattr(config, 'clear_caches', None)
+    if clear is not None:
+        clear()
+    try:
+        import spack.compilers
+        spack.compilers._cache_config_file = []
+        spack.compilers._compiler_cache = {}
+    except (ImportError, AttributeError):
+        pass
+
+
+def set_environ(environ):
+    """
+    Run the next command with spack-cm's environment. Variables set since
+    the worker started are kept only if spack-cm still sets them.
+
+    """
+    os.environ.clear()
+    os.environ.update(startup_environ)
+    os.environ.update(environ)
+
+
+def run(request):
+    """
+    Run a single spack command.
+
+    """
+    error = False
+    try:
+        set_environ(request.get('environ', {}))
+        clear_caches()
+        activate(request.get('env'))
+        args = request['args']
+        command = SpackCommand(args[0])
+        output = command(*args[1:], fail_on_error=False)
+        returncode = command.returncode
+        # The command may have rewritten the environment's files.
+        active['key'] = environment_key(request.get('env'))
+    except Exception:
+        output = traceback.format_exc()
+        returncode = 1
+        error = True
+        try:
+            ev.deactivate()
+        except Exception:
+            pass
+        active['key'] = None
+    return {'returncode': returncode, 'output': output, 'error': error}
+
+
+def main():
+    replies = os.fdopen(os.dup(1), 'w')
+    # Anything spack prints outside of a command goes to stderr, so it
+    # cannot be mistaken for a reply.
+    os.dup2(2, 1)
+    replies.write(json.dumps({'ready': True}) + '\n')
+    replies.flush()
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request.get('exit'):
+            break
+        replies.write(json.dumps(run(request)) + '\n')
+        replies.flush()
+
+
+if __name__ == '__main__':
+    main()
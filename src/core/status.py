@@ -0,0 +1,324 @@
+"""
+Report which specs of a project manifest are installed, from the spack
+databases alone
+"""
+
+from src.core.utilities import install_paths, pcolors
+from src.core.context import load_context, ContextException
+from src.core.generate import tpl_matrices
+from src.core.matrix import expand_matrix, expand_specs, parse_spec, nodes_overlap
+from src.core.packages import iter_installs, MPI_PACKAGES
+from os import listdir, stat
+from os.path import split, abspath, dirname, isdir, isfile, join
+import yaml
+import logging
+logger = logging.getLogger(__name__)
+
+# Install tree of each stage, as attributes of ProjectContext, in install
+# order.
+STAGE_TREES = {'base': 'base_packages_install_path',
+               'lmod': 'lmod_install_path',
+               'compiler': 'compiler_install_path',
+               'utility': 'utility_install_path',
+               'tpl': 'tpl_install_path'}
+
+
+class StatusException(Exception):
+    """Catch all status exceptions"""
+    pass
+
+
+def cached_system_compiler(machine):
+    """
+    System compiler of a platform from its latest compiler detection, so
+    the status never runs 'spack compiler find'.
+
+    Returns
+    -------
+    compiler : String
+        Spec of the system compiler, or '' when the platform's compilers
+        were never detected.
+
+    """
+    filedir, file = split(abspath(__file__))
+    cachedir = join(dirname(filedir), 'platform', machine, '.cache')
+    if not isdir(cachedir):
+        return ''
+    caches = [join(cachedir, name) for name in listdir(cachedir)
+              if name.startswith('compilers-') and name.endswith('.yaml')]
+    if not caches:
+        return ''
+    with open(max(caches, key=lambda cache: stat(cache).st_mtime), 'r') as f:
+        contents = yaml.safe_load(f) or {}
+    try:
+        return contents['compilers'][0]['compiler']['spec']
+    except (KeyError, IndexError, TypeError):
+        return ''
+
+
+def manifest_specs(context):
+    """
+    Specs each stage installs, as the generated spack.yaml files list them.
+
+    Parameters
+    ----------
+    context : ProjectContext
+        Settings of the project.
+
+    Returns
+    -------
+    specs : Dictionary
+        Stage name mapped to its specs.
+
+    """
+    def built_with(packages, compiler):
+        packages = [p for p in packages if p]
+        return expand_matrix([packages, ['%' + compiler]] if compiler else [packages])
+
+    base_compiler = context.value('SPACK_CM_BASE_COMPILER')
+    utility_compiler = context.value('SPACK_CM_UTILITY_COMPILER')
+    specs = {'base': built_with(context.values('SPACK_CM_BASE_PACKAGES'), base_compiler),
+             'lmod': ['lmod'],
+             'compiler': built_with(context.values('SPACK_CM_COMPILERS'), base_compiler),
+             'utility': built_with(context.values('SPACK_CM_UTILITIES'), utility_compiler)}
+    specs['tpl'], excluded = expand_specs(tpl_matrices(context),
+                                          context.values('SPACK_CM_EXCLUDE_COMBOS', ['']))
+    return specs
+
+
+def _variant(value):
+    """
+    Value of an installed variant as a parsed spec holds it.
+
+    """
+    if isinstance(value, list):
+        return ','.join(str(item) for item in value)
+    return value
+
+
+def install_spec(record):
+    """
+    Parse an install record of a spack database, for both the dictionary
+    and list node formats.
+
+    Returns
+    -------
+    install : Dictionary
+        'name', 'version', 'variants', 'compiler' node and the hashes of
+        its direct 'dependencies', like matrix.parse_spec, with its 'prefix'.
+
+    """
+    spec = record['spec']
+    if 'name' in spec:
+        node = spec
+        dependencies = [dep['hash'] for dep in spec.get('dependencies', [])]
+    else:
+        name = list(spec.keys())[0]
+        node = dict(spec[name], name=name)
+        dependencies = [dep['hash'] for dep in node.get('dependencies', {}).values()]
+    compiler = node.get('compiler') or {}
+    return {'name': node['name'],
+            'version': str(node.get('version', '')),
+            'variants': {name: _variant(value)
+                         for name, value in (node.get('parameters') or {}).items()},
+            'compiler': {'name': compiler.get('name'),
+                         'version': str(compiler.get('version', '')) or None,
+                         'variants': {}} if compiler else None,
+            'dependencies': dependencies,
+            'prefix': record.get('path')}
+
+
+def read_installs(install_path, names=None):
+    """
+    Read the installs of a stage from its spack database.
+
+    Parameters
+    ----------
+    install_path : String
+        Root of the stage's install tree.
+    names : Set, optional
+        Only keep the installs of these packages; their dependencies are
+        read all the same. The default keeps every install.
+
+    Returns
+    -------
+    installs : Dictionary
+        Package name mapped to its installs, see install_spec, with
+        'dependencies' resolved to every node below the install.
+
+    """
+    database = join(install_path, '.spack-db', 'index.json')
+    if not isfile(database):
+        return {}
+    nodes = {}
+    for key, record in iter_installs(database):
+        if record.get('installed', True):
+            nodes[key] = install_spec(record)
+    memo = {}
+
+    def below(key):
+        # Every hash reachable from an install, resolved once per install.
+        if key not in memo:
+            memo[key] = set()
+            reached = set()
+            for dep in nodes[key]['dependencies']:
+                if dep in nodes:
+                    reached.add(dep)
+                    reached |= below(dep)
+            memo[key] = reached
+        return memo[key]
+
+    installs = {}
+    for key, node in nodes.items():
+        if names is not None and node['name'] not in names:
+            continue
+        install = dict(node, dependencies=[nodes[dep] for dep in below(key)])
+        installs.setdefault(node['name'], []).append(install)
+    return installs
+
+
+def node_installed(node, constraint):
+    """
+    Whether an installed node satisfies a node of a requested spec: unlike
+    matrix.nodes_overlap, every variant requested must be set.
+
+    """
+    return all(name in node['variants'] for name in constraint['variants']) and \
+        nodes_overlap(node, constraint)
+
+
+def spec_installed(installs, spec):
+    """
+    Find an install satisfying a spec of the manifest.
+
+    Parameters
+    ----------
+    installs : Dictionary
+        Installs of the stage, see read_installs.
+    spec : String
+        Requested spec, e.g., hdf5@1.10.6 %gcc@10.1.0 ^openmpi@4.0.5, or
+        the spec already parsed.
+
+    Returns
+    -------
+    install : Dictionary
+        The first install satisfying the spec, or None.
+
+    """
+    requested = parse_spec(spec) if isinstance(spec, str) else spec
+    for install in installs.get(requested['name'], []):
+        if not node_installed(install, requested):
+            continue
+        if requested['compiler'] and (install['compiler'] is None or
+                                      not nodes_overlap(install['compiler'], requested['compiler'])):
+            continue
+        if all(any((node['name'] == name or (name == 'mpi' and node['name'] in MPI_PACKAGES))
+                   and node_installed(node, dependency)
+                   for node in install['dependencies'])
+               for name, dependency in requested['dependencies'].items()):
+            return install
+    return None
+
+
+def stage_status(context, stage=None):
+    """
+    Match every spec of the manifest with the installs of its stage.
+
+    Parameters
+    ----------
+    context : ProjectContext
+        Settings of the project.
+    stage : String, optional
+        Only report this stage. The default reports them all.
+
+    Returns
+    -------
+    status : List
+        (stage, spec, install or None) of each spec, in install order.
+
+    """
+    if stage is not None and stage not in STAGE_TREES:
+        error = 'ERROR: Unknown stage {}. Available choices: {}.'.format(
+            stage, ', '.join(STAGE_TREES))
+        logger.critical(error)
+        raise StatusException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    specs = manifest_specs(context)
+    status = []
+    for name, tree in STAGE_TREES.items():
+        if stage is not None and name != stage:
+            continue
+        requested = [parse_spec(spec) for spec in specs[name]]
+        installs = read_installs(getattr(context, tree),
+                                 {parsed['name'] for parsed in requested})
+        status.extend((name, spec, spec_installed(installs, parsed))
+                      for spec, parsed in zip(specs[name], requested))
+    return status
+
+
+def status(project, machine, path, stage=None, machine_path=False,
+           explicit_install_path=None, show_prefix=False, missing_only=False):
+    """
+    Report, for every spec of a project's manifest, whether a matching
+    install exists. Only the manifest and the spack databases are read:
+    nothing is concretized and spack is never started.
+
+    Parameters
+    ----------
+    project : String
+        The project to report on.
+    machine : String
+        The machine to report on.
+    path : String
+        The root path for installation.
+    stage : String, optional
+        Only report this stage. The default reports them all.
+    machine_path: Boolean, optional
+        Add the machine name to the install path. The default is False.
+    explicit_install_path: String, optional
+        Exact installation root path to use. Default: None
+    show_prefix : Boolean, optional
+        Print the install prefix of each installed spec. The default is False.
+    missing_only : Boolean, optional
+        Only print the specs that are not installed. The default is False.
+
+    Returns
+    -------
+    status : List
+        (stage, spec, install or None) of each spec, see stage_status.
+
+    """
+    # Modulefiles are never looked at, any path will do without a root.
+    install_path, module_path = install_paths(project, machine, path, machine_path,
+                                              explicit_install_path,
+                                              explicit_install_path if path is None else None)
+    if not isdir(install_path):
+        error = 'ERROR: Install path {} does not exist.'.format(install_path)
+        logger.critical(error)
+        raise StatusException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
+    try:
+        context = load_context(project, machine, path, machine_path,
+                               explicit_install_path,
+                               explicit_install_path if path is None else None,
+                               system_compiler=cached_system_compiler(machine))
+    except ContextException as e:
+        raise StatusException(str(e))
+    report = stage_status(context, stage)
+    current = None
+    for name, spec, install in report:
+        if name != current:
+            current = name
+            installed = sum(1 for entry in report if entry[0] == name and entry[2])
+            total = sum(1 for entry in report if entry[0] == name)
+            color = pcolors.OKGREEN if installed == total else pcolors.WARN
+            print(f'{color}{name}: {installed}/{total} installed{pcolors.ENDC}')
+        if install is None:
+            print(f'{pcolors.FAIL}  missing    {spec}{pcolors.ENDC}')
+        elif not missing_only:
+            line = '  installed  {}'.format(spec)
+            if show_prefix:
+                line += '  ' + (install['prefix'] or '')
+            print(line)
+    missing = len([entry for entry in report if entry[2] is None])
+    logger.info('{} of {} specs installed.'.format(len(report) - missing, len(report)))
+    print('{} of {} specs installed.'.format(len(report) - missing, len(report)))
+    return report
@@ -0,0 +1,100 @@
+"""
+Test backend.py
+"""
+
+import unittest
+from src.core import backend
+from src.core.backend import (BackendException, run_shell, set_backend,
+                              spack_command, spack_environ, user_scope,
+                              user_config_dir)
+from os import getpid
+from os.path import join, isdir, expanduser
+import tempfile
+from shutil import rmtree
+
+
+class FailingWorker:
+    """
+    Stands in for a started spack worker whose commands raise.
+    """
+    class process:
+        @staticmethod
+        def poll():
+            return None
+
+    def __init__(self):
+        self.pid = getpid()
+        self.calls = []
+
+    def run(self, args, env=None):
+        self.calls.append(args)
+        raise BackendException('spack {} raised in the worker.'.format(' '.join(args)))
+
+
+class test_Backend(unittest.TestCase):
+    """
+    Test running commands from src.core.backend
+    """
+    def setUp(self):
+        self.backend = backend.settings['backend']
+
+    def tearDown(self):
+        backend.settings['backend'] = self.backend
+        backend.local.workers = {}
+
+    def test_run_shell(self):
+        returncode, output = run_shell('echo one; echo two', echo=False)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(output, 'one\ntwo\n')
+
+    def test_run_shell_keep(self):
+        returncode, output = run_shell('echo keep me; echo drop me; exit 3',
+                                       echo=False,
+                                       keep=lambda line: 'keep' in line)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(output, 'keep me\n')
+
+    def test_set_backend(self):
+        set_backend('shell')
+        self.assertEqual(backend.settings['backend'], 'shell')
+        with self.assertRaises(BackendException):
+            set_backend('ssh')
+        self.assertEqual(backend.settings['backend'], 'shell')
+
+    def test_spack_command_shell(self):
+        set_backend('shell')
+        returncode, output = spack_command(['--version', ''], echo=False)
+        self.assertIsInstance(returncode, int)
+        self.assertIsInstance(output, str)
+
+    def test_worker_failure_falls_back_to_shell(self):
+        set_backend('worker')
+        worker = FailingWorker()
+        backend.local.workers = {None: worker}
+        returncode, output = spack_command(['--version'], echo=False)
+        self.assertEqual(worker.calls, [['--version']])
+        self.assertIsInstance(returncode, int)
+
+    def test_install_streams_through_shell(self):
+        set_backend('worker')
+        worker = FailingWorker()
+        backend.local.workers = {None: worker}
+        spack_command(['install', '--help'], echo=False)
+        self.assertEqual(worker.calls, [])
+
+    def test_private_user_scope(self):
+        envdir = tempfile.mkdtemp()
+        try:
+            environment = spack_environ(envdir)
+            self.assertEqual(user_scope(envdir), join(envdir, '.spack-user'))
+            self.assertEqual(environment['SPACK_USER_CONFIG_PATH'],
+                             join(envdir, '.spack-user', 'config'))
+            self.assertEqual(environment['SPACK_USER_CACHE_PATH'],
+                             join(envdir, '.spack-user', 'cache'))
+            self.assertTrue(user_config_dir(envdir).startswith(user_scope(envdir)))
+            run_scope = user_scope()
+            self.assertTrue(isdir(run_scope))
+            self.assertNotEqual(run_scope, expanduser('~'))
+            self.assertEqual(run_scope, user_scope())
+        finally:
+            rmtree(envdir)
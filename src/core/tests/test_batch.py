@@ -0,0 +1,114 @@
+"""
+Test batch.py
+"""
+
+import unittest
+import tempfile
+import time
+from os.path import join, expanduser, abspath
+from src.core.batch import (read_batch, batch_entry, spack_processes,
+                            ready_entries, run_batch, BatchException)
+
+
+def fake_install(entry, options, build_jobs, log):
+    """
+    Stand-in for install_entry, failing the entries of project 'broken'.
+
+    """
+    time.sleep(0.05)
+    with open(log, 'w') as f:
+        f.write('{} {}\n'.format(entry['name'], build_jobs))
+    if entry['project'] == 'broken':
+        return {'status': 'failed', 'seconds': 0.05}
+    return {'status': 'installed', 'seconds': 0.05}
+
+
+class test_Batch(unittest.TestCase):
+    """
+    Test batch file parsing and scheduling from src.core.batch
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, contents):
+        file = join(self.tmpdir.name, 'batch.yaml')
+        with open(file, 'w') as f:
+            f.write(contents)
+        return file
+
+    def test_read_list(self):
+        entries = read_batch(self.write('- project: sems\n'
+                                        '  machine: blake\n'
+                                        '  root: ~/\n'
+                                        '- project: pyomo\n'
+                                        '  machine: blake\n'
+                                        '  explicit_install_path: /opt/pyomo\n'
+                                        '  explicit_modulefile_path: /opt/pyomo-modules\n'
+                                        '  attempts: [3, tpl=5]\n'))
+        self.assertEqual([entry['name'] for entry in entries], ['sems/blake', 'pyomo/blake'])
+        self.assertEqual(entries[0]['root'], abspath(expanduser('~/')))
+        self.assertEqual(entries[0]['stage'], 'all')
+        self.assertEqual(entries[0]['attempts'], {})
+        self.assertEqual(entries[1]['attempts']['tpl'], 5)
+        self.assertEqual(entries[1]['attempts']['base'], 3)
+
+    def test_read_defaults(self):
+        entries = read_batch(self.write('defaults:\n'
+                                        '  root: ~/\n'
+                                        '  install_single_stacks: true\n'
+                                        '  stack_workers: 4\n'
+                                        'installs:\n'
+                                        '  - project: sems\n'
+                                        '    machine: blake\n'
+                                        '  - project: sems\n'
+                                        '    machine: weaver\n'
+                                        '    stack_workers: 2\n'))
+        self.assertEqual([entry['stack_workers'] for entry in entries], [4, 2])
+        self.assertTrue(all(entry['install_single_stacks'] for entry in entries))
+        self.assertEqual(spack_processes(entries[0]), 4)
+        # The stacks run next to the other concurrent stages.
+        self.assertEqual(spack_processes(dict(entries[0], concurrent_stages=3)), 6)
+        self.assertEqual(spack_processes(dict(entries[0], concurrent_stages=3,
+                                              install_single_stacks=False)), 3)
+
+    def test_invalid_entries(self):
+        with self.assertRaises(BatchException):
+            read_batch(self.write('installs: []\n'))
+        with self.assertRaises(BatchException):
+            batch_entry({'machine': 'blake', 'root': '~/'})
+        with self.assertRaises(BatchException):
+            batch_entry({'project': 'sems', 'machine': 'blake'})
+        with self.assertRaises(BatchException):
+            batch_entry({'project': 'sems', 'root': '~/', 'typo': True})
+        with self.assertRaises(BatchException):
+            batch_entry({'project': 'sems', 'root': '~/', 'attempts': 'typo=2'})
+
+    def test_ready_entries(self):
+        entries = [batch_entry({'project': project, 'machine': 'blake', 'root': '~/',
+                                'concurrent_stages': stages})
+                   for project, stages in [('a', 2), ('a', 1), ('b', 2), ('c', 1)]]
+        # The second entry of project a waits for the first, and b does not
+        # fit next to it: c fills the budget instead.
+        self.assertEqual(ready_entries(entries, [0, 1, 2, 3], [], 3), [0, 3])
+        self.assertEqual(ready_entries(entries, [1, 2], [3], 3), [1])
+        self.assertEqual(ready_entries(entries, [2], [3], 3), [2])
+        # An entry larger than the budget still runs on its own.
+        self.assertEqual(ready_entries(entries, [0], [], 1), [0])
+
+    def test_run_batch(self):
+        entries = [batch_entry({'project': project, 'machine': 'blake', 'root': '~/'})
+                   for project in ['sems', 'broken', 'pyomo']]
+        results = run_batch(entries, 2, 8, {}, self.tmpdir.name,
+                            runner=fake_install, skip={2: 'No manifest.'})
+        self.assertEqual([result['status'] for result in results],
+                         ['installed', 'failed', 'failed'])
+        self.assertEqual(results[2]['error'], 'No manifest.')
+        with open(results[0]['log'], 'r') as f:
+            self.assertEqual(f.read(), 'sems/blake 8\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
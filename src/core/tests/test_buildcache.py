@@ -0,0 +1,81 @@
+"""
+Test buildcache.py
+"""
+
+import unittest
+import fcntl
+import json
+import tempfile
+from os import environ, makedirs, utime
+from os.path import join, exists
+from shutil import rmtree
+from src.core.buildcache import (set_build_cache, cache_entries, evict,
+                                 installed_hashes, install_args, locked_cache,
+                                 push, LOCK_FILE)
+
+
+class test_BuildCache(unittest.TestCase):
+    """
+    Test build cache methods from src.core.buildcache
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        set_build_cache(self.root, 'machine')
+        self.build_cache = join(self.root, 'machine', 'build_cache')
+        makedirs(join(self.build_cache, 'linux-gcc-10.1.0'))
+
+    def tearDown(self):
+        del environ['SPACK_CM_BUILD_CACHE']
+        del environ['SPACK_CM_BUILD_CACHE_SIZE']
+        rmtree(self.root)
+
+    def add_entry(self, name, key, size, mtime):
+        files = [join(self.build_cache, 'linux-{}-{}.spec.yaml'.format(name, key)),
+                 join(self.build_cache, 'linux-gcc-10.1.0',
+                      'linux-{}-{}.spack'.format(name, key))]
+        for filename in files:
+            with open(filename, 'w') as f:
+                f.write(size * 'x')
+            utime(filename, (mtime, mtime))
+        return files
+
+    def test_cache_entries(self):
+        self.add_entry('zlib', 32 * 'a', 10, 100)
+        entries = cache_entries()
+        self.assertEqual(list(entries), [32 * 'a'])
+        self.assertEqual(len(entries[32 * 'a']), 2)
+        self.assertEqual(install_args(), ['--no-check-signature'])
+
+    def test_evict_least_recently_used(self):
+        old = self.add_entry('zlib', 32 * 'a', 10, 100)
+        new = self.add_entry('hdf5', 32 * 'b', 10, 200)
+        self.assertEqual(evict(40), [])
+        self.assertEqual(evict(30), [32 * 'a'])
+        self.assertFalse(any(exists(filename) for filename in old))
+        self.assertTrue(all(exists(filename) for filename in new))
+
+    def test_installed_hashes(self):
+        install_path = join(self.root, 'tpl')
+        makedirs(join(install_path, '.spack-db'))
+        installs = {'old': {'installed': True, 'installation_time': 10},
+                    'new': {'installed': True, 'installation_time': 20},
+                    'gone': {'installed': False, 'installation_time': 30}}
+        with open(join(install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': installs}}, f)
+        self.assertEqual(sorted(installed_hashes(install_path)), ['new', 'old'])
+        self.assertEqual(installed_hashes(install_path, 15), ['new'])
+
+    def test_locked_cache_excludes_other_processes(self):
+        with locked_cache():
+            # Another process opens the lock file on its own.
+            with open(join(self.root, 'machine', LOCK_FILE), 'a') as f:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.assertEqual(cache_entries(), {})
+
+    def test_push_without_cache(self):
+        del environ['SPACK_CM_BUILD_CACHE']
+        try:
+            push(self.root, ['abc'])
+        finally:
+            environ['SPACK_CM_BUILD_CACHE'] = join(self.root, 'machine')
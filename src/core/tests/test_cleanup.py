@@ -4,11 +4,16 @@ Test the Spack cleanup routines.
 
 import unittest
 from src.core.cleanup import (spack_cleanup, spack_compiler_find,
-                              spack_external_find, spack_license_cleanup)
+                              spack_external_find, spack_license_cleanup,
+                              failed_stage_pattern, stage_lock,
+                              cleanup_locks, share_cleanup_lock)
+from src.core import cleanup as cleanup_module
+from src.core.backend import user_config_dir
 import os
 from os.path import dirname
 import shutil
 import subprocess
+import threading
 from sys import path as syspath
 
 class test_SpackCleanup(unittest.TestCase):
@@ -20,19 +25,24 @@ class test_SpackCleanup(unittest.TestCase):
         syspath.insert(0, spack_lib_path)
         spack_external_libs = os.path.join(spack_lib_path, "external")
         syspath.insert(0, spack_external_libs)
-        if not os.path.isdir(os.path.expanduser('~/.spack')):
-            os.mkdir(os.path.expanduser('~/.spack'))
+        cls.envdir = os.path.expanduser('~/bogus/not/here')
+        os.makedirs(cls.envdir, exist_ok=True)
+        with open(os.path.join(cls.envdir, 'spack.yaml'), 'w') as file:
+            file.write('spack:\n  specs: []\n')
 
     @classmethod
     def tearDownClass(cls):
-        if os.path.isdir(os.path.expanduser('~/.spack')):
-            shutil.rmtree(os.path.expanduser('~/.spack'))
         if os.path.isdir(os.path.expanduser('~/bogus/not/here/')):
             shutil.rmtree(os.path.expanduser('~/bogus/not/here/'))
 
     def test_spack_cleanup(self):
-        spack_cleanup('~/bogus/not/here')
-        self.assertFalse(os.path.isdir(os.path.expanduser('~/.spack')))
+        config = user_config_dir(self.envdir)
+        os.makedirs(os.path.join(config, 'cache'), exist_ok=True)
+        with open(os.path.join(config, 'compilers.yaml'), 'w') as file:
+            file.write('compilers: []')
+        spack_cleanup(self.envdir)
+        self.assertFalse(os.path.exists(os.path.join(config, 'compilers.yaml')))
+        self.assertTrue(os.path.isdir(os.path.join(config, 'cache')))
         os.makedirs(os.path.expanduser('~/bogus/not/here/.spack-env'))
         with open(os.path.expanduser('~/bogus/not/here/spack.lock'), 'w') as file:
             file.write('This is not a file you want.')
@@ -43,12 +53,13 @@ class test_SpackCleanup(unittest.TestCase):
             os.path.expanduser('~/bogus/not/here/spack.lock')))
 
     def test_compiler_find(self):
-        spack_compiler_find()
-        self.assertTrue(os.path.isdir(os.path.expanduser('~/.spack')))
+        spack_compiler_find(self.envdir)
+        self.assertTrue(os.path.isdir(user_config_dir(self.envdir)))
 
     def test_external_find(self):
-        spack_external_find()
-        self.assertTrue(os.path.exists(os.path.expanduser('~/.spack/packages.yaml')))
+        spack_external_find(self.envdir)
+        self.assertTrue(os.path.exists(os.path.join(user_config_dir(self.envdir),
+                                                    'packages.yaml')))
 
     def test_license_cleanup(self):
         if not os.path.isdir(os.path.join(
@@ -59,3 +70,73 @@ class test_SpackCleanup(unittest.TestCase):
         self.assertFalse(os.path.isdir(
             os.path.join(os.environ['SPACK_ROOT'], 'etc/spack/licenses/intel')))
 
+
+class test_FailedStages(unittest.TestCase):
+    def test_failed_stage_pattern(self):
+        pattern = failed_stage_pattern([('cmake', '3.18.4', None),
+                                        ('zlib', '1.2.11', 'ldu43taplg2nbkxtem346zq4ibhad64i')])
+        self.assertTrue(pattern.match('spack-stage-cmake-3.18.4-2nuomeez46onprdjqmqstnhnekgzpqwa'))
+        self.assertTrue(pattern.match('spack-stage-zlib-1.2.11-ldu43taplg2nbkxtem346zq4ibhad64i'))
+        self.assertFalse(pattern.match('spack-stage-zlib-1.2.11-aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa'))
+        self.assertFalse(pattern.match('spack-stage-cmake-3.17.4-gvoevne5aaaaaaaaaaaaaaaaaaaaaaaa'))
+        self.assertFalse(pattern.match('spack-stage-py-cmake-3.18.4-2nuomeez46onprdjqmqstnhnekgzpqwa'))
+
+
+class test_StageLock(unittest.TestCase):
+    def test_cleanup_waits_for_installs(self):
+        cleaned = threading.Event()
+
+        def clean():
+            with stage_lock(exclusive=True):
+                cleaned.set()
+
+        with stage_lock():
+            # Other installs share the lock.
+            with stage_lock():
+                pass
+            thread = threading.Thread(target=clean)
+            thread.start()
+            self.assertFalse(cleaned.wait(0.2))
+        thread.join(5)
+        self.assertTrue(cleaned.is_set())
+
+    def test_cleanup_lock_free_while_waiting(self):
+        cleaned = threading.Event()
+
+        def clean():
+            with cleanup_locks('stage'):
+                cleaned.set()
+
+        with stage_lock():
+            thread = threading.Thread(target=clean)
+            thread.start()
+            self.assertFalse(cleaned.wait(0.2))
+            # The other stages still clean up while this one waits.
+            self.assertTrue(cleanup_module.cleanup_lock.acquire(timeout=1))
+            cleanup_module.cleanup_lock.release()
+        thread.join(5)
+        self.assertTrue(cleaned.is_set())
+
+    def test_failed_policy_does_not_wait(self):
+        cleaned = threading.Event()
+
+        def clean():
+            with cleanup_locks('failed', [('cmake', '3.18.4', None)]):
+                cleaned.set()
+
+        with stage_lock():
+            thread = threading.Thread(target=clean)
+            thread.start()
+            # Only the stages of the failed specs go, installs keep running.
+            self.assertTrue(cleaned.wait(5))
+        thread.join(5)
+
+    def test_share_cleanup_lock(self):
+        thread_lock = cleanup_module.cleanup_lock
+        try:
+            lock = share_cleanup_lock()
+            self.assertIs(cleanup_module.cleanup_lock, lock)
+            self.assertIs(share_cleanup_lock(), lock)
+            self.assertIsNot(lock, thread_lock)
+        finally:
+            cleanup_module.cleanup_lock = thread_lock
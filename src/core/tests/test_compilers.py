@@ -0,0 +1,82 @@
+"""
+Test compilers.py
+"""
+
+import unittest
+import json
+import tempfile
+import yaml
+from os import environ, makedirs, chmod, utime
+from os.path import join
+from shutil import rmtree
+from src.core import compilers
+from src.core.compilers import (path_fingerprint, detect_compilers,
+                                installed_compiler_prefixes, CompilersException)
+
+
+class test_Compilers(unittest.TestCase):
+    """
+    Test compiler detection caching from src.core.compilers
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bin = join(self.root, 'bin')
+        makedirs(self.bin)
+        self.gcc = self.add_executable('gcc-10')
+        self.add_executable('make')
+        self.envdir = join(self.root, 'env')
+        makedirs(self.envdir)
+        self.cachedir = join(self.root, 'cache')
+        self.path = environ['PATH']
+        self.cache_dir = compilers.compiler_cache_dir
+        compilers.compiler_cache_dir = lambda machine: self.cachedir
+        makedirs(self.cachedir)
+
+    def tearDown(self):
+        environ['PATH'] = self.path
+        compilers.compiler_cache_dir = self.cache_dir
+        rmtree(self.root)
+
+    def add_executable(self, name):
+        filename = join(self.bin, name)
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\n')
+        chmod(filename, 0o755)
+        return filename
+
+    def test_path_fingerprint(self):
+        before = path_fingerprint(self.bin)
+        self.assertEqual(before, path_fingerprint(self.bin))
+        self.add_executable('make-4')
+        self.assertEqual(before, path_fingerprint(self.bin))
+        utime(self.gcc, (1, 1))
+        self.assertNotEqual(before, path_fingerprint(self.bin))
+        self.assertNotEqual(path_fingerprint(self.bin),
+                            path_fingerprint(self.bin + ':/nowhere'))
+
+    def test_cache_hit(self):
+        environ['PATH'] = self.bin
+        cached = {'compilers': [{'compiler': {'spec': 'gcc@10.1.0'}}]}
+        with open(join(self.cachedir, 'compilers-{}.yaml'.format(path_fingerprint())), 'w') as f:
+            yaml.safe_dump(cached, f)
+        self.assertEqual(detect_compilers(self.envdir, 'machine'), cached)
+        config = compilers.user_config_dir(self.envdir)
+        with open(join(config, 'compilers.yaml'), 'r') as f:
+            self.assertEqual(yaml.safe_load(f), cached)
+
+    def test_installed_compiler_prefixes(self):
+        install_path = join(self.root, 'compiler')
+        makedirs(join(install_path, '.spack-db'))
+        installs = {'old': {'path': '/old/gcc', 'installation_time': 1,
+                            'spec': {'gcc': {'version': '10.1.0'}}},
+                    'new': {'path': '/new/gcc', 'installation_time': 2,
+                            'spec': {'gcc': {'version': '10.1.0'}}},
+                    'intel': {'path': '/intel', 'installation_time': 1,
+                              'spec': {'name': 'intel', 'version': '19.1.2.254'}}}
+        with open(join(install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': installs}}, f)
+        self.assertEqual(installed_compiler_prefixes(install_path,
+                                                     ['gcc@10.1.0', 'intel@19.1.2']),
+                         {'gcc@10.1.0': '/new/gcc', 'intel@19.1.2': '/intel'})
+        with self.assertRaises(CompilersException):
+            installed_compiler_prefixes(install_path, ['gcc@7.3.0'])
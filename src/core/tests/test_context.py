@@ -0,0 +1,100 @@
+"""
+Test context.py
+"""
+
+import unittest
+import yaml
+from os import environ, remove
+from os.path import split, abspath, dirname, join, exists
+from shutil import copyfile
+from src.core.context import (ContextException, ProjectContext, current_context,
+                              load_context, parse_manifest)
+from src.core.generate import spack_tpl_yaml
+
+
+class test_Context(unittest.TestCase):
+    """
+    Test the project context from src.core.context
+    """
+    @classmethod
+    def setUpClass(cls):
+        filedir, file = split(abspath(__file__))
+        cls.project = 'tests'
+        cls.projectdir = join(dirname(dirname(filedir)), 'project', cls.project)
+        copyfile(join(cls.projectdir, 'tests-compilers-manifest.yaml'),
+                 join(cls.projectdir, 'tests-manifest.yaml'))
+        cls.root = join(filedir, 'install_path')
+
+    @classmethod
+    def tearDownClass(cls):
+        remove(join(cls.projectdir, 'tests-manifest.yaml'))
+
+    def test_parse_manifest(self):
+        manifest = dict(parse_manifest({'SPACK_CM_UTILITY_COMPILER': [''],
+                                        'SPACK_CM_COMPILERS': [''],
+                                        'SPACK_CM_EXTERNAL_COMPILERS': [''],
+                                        'SPACK_CM_TPLS': ['hdf5', 'zlib'],
+                                        'SPACK_CM_CUDAS': None}, 'gcc@8.3.1'))
+        self.assertEqual(manifest['SPACK_CM_UTILITY_COMPILER'], ('gcc@8.3.1',))
+        self.assertEqual(manifest['SPACK_CM_EXTERNAL_COMPILERS'], ('gcc@8.3.1',))
+        self.assertEqual(manifest['SPACK_CM_TPLS'], ('hdf5', 'zlib'))
+        self.assertEqual(manifest['SPACK_CM_CUDAS'], ('',))
+
+    def test_load_context(self):
+        context = load_context(self.project, 'tests', self.root, True, None, None,
+                               system_compiler='gcc@8.3.1')
+        self.assertIs(load_context(self.project, 'tests', self.root, True, None, None,
+                                   system_compiler='gcc@8.3.1'), context)
+        self.assertEqual(context.install_path, join(self.root, 'install/tests/tests/'))
+        self.assertEqual(context.tpl_install_path, join(self.root, 'install/tests/tests/tpl'))
+        self.assertEqual(context.values('SPACK_CM_COMPILERS'), ['gcc@7.3.0', 'gcc@10.1.0'])
+        self.assertEqual(context.value('SPACK_CM_COMPILERS'), 'gcc@7.3.0, gcc@10.1.0')
+        self.assertEqual(context.values('SPACK_CM_EXTERNALS_MODE', ['']), [''])
+        with self.assertRaises(ContextException):
+            context.values('SPACK_CM_EXTERNALS_MODE')
+        with self.assertRaises(Exception):
+            context.project = 'other'
+        other = load_context(self.project, 'other', self.root, True, None, None,
+                             system_compiler='gcc@8.3.1')
+        self.assertNotEqual(other.install_path, context.install_path)
+
+    def test_environment(self):
+        context = load_context(self.project, 'tests', self.root, False, None, None,
+                               system_compiler='gcc@8.3.1')
+        environment = context.environment()
+        self.assertEqual(environment['SPACK_CM_TPL_INSTALL_PATH'], context.tpl_install_path)
+        self.assertEqual(environment['SYSTEM_COMPILER'], 'gcc@8.3.1')
+        saved = dict(environ)
+        try:
+            context.export()
+            exported = current_context()
+            self.assertEqual(exported.tpl_install_path, context.tpl_install_path)
+            for key, values in context.manifest:
+                self.assertEqual(exported.values(key), list(values))
+            self.assertIs(current_context(context), context)
+        finally:
+            environ.clear()
+            environ.update(saved)
+
+    def test_generate_without_environ(self):
+        first = load_context(self.project, 'tests', self.root, False, None, None,
+                             system_compiler='gcc@8.3.1')
+        second = ProjectContext(**dict(first.__dict__, install_path='/other',
+                                       tpl_install_path='/other/tpl'))
+        saved = dict(environ)
+        try:
+            for name in list(environ):
+                if name.startswith('SPACK_CM_'):
+                    del environ[name]
+            for context in [first, second]:
+                spack_tpl_yaml(self.project, True, context=context)
+                with open(join(self.projectdir, 'tpl-spack.yaml'), 'r') as f:
+                    contents = yaml.safe_load(f)
+                self.assertEqual(contents['spack']['config']['install_tree']['root'],
+                                 context.tpl_install_path)
+            self.assertFalse(any(name.startswith('SPACK_CM_') for name in environ))
+        finally:
+            environ.clear()
+            environ.update(saved)
+            if exists(join(self.projectdir, 'tpl-spack.yaml')):
+                remove(join(self.projectdir, 'tpl-spack.yaml'))
@@ -0,0 +1,57 @@
+"""
+Test emitter.py
+"""
+
+import unittest
+import tempfile
+import yaml
+from os import stat
+from os.path import join
+from shutil import rmtree
+from src.core.emitter import dumps, scalar, write_yaml
+
+
+class test_Emitter(unittest.TestCase):
+    """
+    Test the spack YAML emitter from src.core.emitter
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_scalar(self):
+        self.assertEqual(scalar('gcc@10.1.0'), 'gcc@10.1.0')
+        self.assertEqual(scalar('%gcc@10.1.0 ^openmpi@1.10.7'), '"%gcc@10.1.0 ^openmpi@1.10.7"')
+        self.assertEqual(scalar('{name}/{version}'), '"{name}/{version}"')
+        self.assertEqual(scalar(''), "''")
+        self.assertEqual(scalar('10'), '"10"')
+        self.assertEqual(scalar('true'), '"true"')
+        self.assertEqual(scalar(False), 'false')
+        self.assertEqual(scalar(None), 'null')
+
+    def test_dumps(self):
+        contents = {'spack': {'include': ['/install/packages.yaml'],
+                              'definitions': [{'core_compiler': [None]},
+                                              {'packages': ['hdf5', "it's"]}],
+                              'specs': [{'matrix': [['$packages'], ['$%core_compiler']],
+                                         'exclude': ['%gcc@10.1.0']}],
+                              'view': False,
+                              'modules': {'prefix_inspections': {'': ['CMAKE_PREFIX_PATH']},
+                                          'lmod': {'all': {'conflict': ['{name}']},
+                                                   'whitelist': []}}}}
+        data = dumps(contents)
+        self.assertEqual(yaml.safe_load(data), contents)
+        self.assertIn('  - [$packages]\n', data)
+        self.assertIn('"it\'s"', data)
+
+    def test_write_yaml(self):
+        filename = join(self.directory, 'spack.yaml')
+        self.assertTrue(write_yaml(filename, {'spack': {'specs': ['zlib']}}))
+        mtime = stat(filename).st_mtime_ns
+        self.assertFalse(write_yaml(filename, {'spack': {'specs': ['zlib']}}))
+        self.assertEqual(stat(filename).st_mtime_ns, mtime)
+        self.assertTrue(write_yaml(filename, {'spack': {'specs': ['hdf5']}}))
+        with open(filename) as f:
+            self.assertEqual(yaml.safe_load(f), {'spack': {'specs': ['hdf5']}})
@@ -0,0 +1,53 @@
+"""
+Test externals.py
+"""
+
+import unittest
+import tempfile
+import yaml
+from os import environ, makedirs
+from os.path import join
+from shutil import rmtree
+from src.core import externals
+from src.core.externals import detect_externals, externals_fingerprint
+
+
+class test_Externals(unittest.TestCase):
+    """
+    Test external package detection caching from src.core.externals
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bin = join(self.root, 'bin')
+        makedirs(self.bin)
+        self.envdir = join(self.root, 'env')
+        makedirs(self.envdir)
+        self.cachedir = join(self.root, 'cache')
+        makedirs(self.cachedir)
+        self.path = environ['PATH']
+        environ['PATH'] = self.bin
+        self.cache_dir = externals.compiler_cache_dir
+        externals.compiler_cache_dir = lambda machine: self.cachedir
+
+    def tearDown(self):
+        environ['PATH'] = self.path
+        externals.compiler_cache_dir = self.cache_dir
+        externals.fingerprints.clear()
+        rmtree(self.root)
+
+    def test_fingerprint_once_per_run(self):
+        before = externals_fingerprint()
+        with open(join(self.bin, 'cmake'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        self.assertEqual(before, externals_fingerprint())
+        externals.fingerprints.clear()
+        self.assertNotEqual(before, externals_fingerprint())
+
+    def test_cache_hit(self):
+        cached = {'packages': {'cmake': {'externals': [{'spec': 'cmake@3.20.0',
+                                                         'prefix': '/usr'}]}}}
+        with open(join(self.cachedir, 'packages-{}.yaml'.format(externals_fingerprint())), 'w') as f:
+            yaml.safe_dump(cached, f)
+        self.assertEqual(detect_externals(self.envdir, 'machine'), cached)
+        with open(join(externals.user_config_dir(self.envdir), 'packages.yaml'), 'r') as f:
+            self.assertEqual(yaml.safe_load(f), cached)
@@ -2,8 +2,10 @@
 Test generate.py
 """
 
+import os
 import unittest
 from src.core.generate import *
+from src.core.matrix import expand_matrix
 from os.path import split, abspath, dirname, join, exists
 from os import environ, remove
 import yaml
@@ -162,3 +164,73 @@ class test_GenerateYAMLs(unittest.TestCase):
                       contents)
         with open(join(self.projectdir, 'tpl-spack.yaml'), 'r') as f:
             contents = yaml.full_load(f)
+
+    def test_tpls_expand_matrix(self):
+        environ['SPACK_CM_EXCLUDE_COMBOS'] = 'valgrind%gcc@10.1.0'
+        matrices = tpl_matrices()
+        spack_tpl_yaml(self.project, True, expand_matrix=True)
+        with open(join(self.projectdir, 'tpl-spack.yaml'), 'r') as f:
+            contents = yaml.full_load(f)
+        specs = contents['spack']['specs']
+        self.assertTrue(all(isinstance(spec, str) for spec in specs))
+        self.assertNotIn('valgrind@3.15.0 %gcc@10.1.0 ^openmpi@4.0.5', specs)
+        self.assertIn('valgrind@3.15.0 %gcc@7.3.0 ^openmpi@4.0.5', specs)
+        total = sum(len(expand_matrix(rows)) for rows in matrices)
+        self.assertEqual(stack_sizes()[0], ('tpl', len(specs), total - len(specs)))
+        environ['SPACK_CM_EXCLUDE_COMBOS'] = ''
+        remove(join(self.projectdir, 'tpl-spack.yaml'))
+
+    def test_single_stacks_without_cuda(self):
+        environ['SPACK_CM_CUDAS'] = ''
+        stacks = single_stacks()
+        self.assertEqual(stacks, [('gcc@7.3.0', 'openmpi@4.0.5', None),
+                                  ('gcc@10.1.0', 'openmpi@4.0.5', None)])
+        spack_all_stacks_yaml(self.project, True)
+        for compiler, mpi, cuda in stacks:
+            filename = join(self.projectdir,
+                            single_stack_filename(self.project, compiler, mpi, cuda))
+            self.assertTrue(exists(filename))
+            remove(filename)
+        self.assertEqual(single_stack_filename('tests', 'gcc@7.3.0', None, 'cuda@11'),
+                         'tests-gcc@7.3.0-cuda@11-spack.yaml')
+        remove(join(self.projectdir, STACKS_INDEX))
+
+    def test_single_stack_without_empty_packages(self):
+        manifest = stack_manifest()
+        manifest['packages'] = ['hdf5', '', 'cmake']
+        contents = single_stack_contents(self.project, manifest, 'gcc@7.3.0', 'openmpi@4.0.5')
+        self.assertEqual(contents['spack']['definitions'][1],
+                         {'packages': ['hdf5', 'cmake', 'openmpi@4.0.5']})
+        self.assertEqual(contents['spack']['modules']['lmod']['whitelist'],
+                         ['hdf5', 'cmake', 'openmpi@4.0.5'])
+
+    def test_single_stack_includes_built_compilers(self):
+        manifest = stack_manifest()
+        manifest['compilers'] = ['gcc@7.3.0']
+        include = '{}/compilers.yaml'.format(manifest['compiler_install_path'])
+        contents = single_stack_contents(self.project, manifest, 'gcc@7.3.0', 'openmpi@4.0.5')
+        self.assertEqual(contents['spack']['include'][2], include)
+        manifest['compilers'] = ['']
+        contents = single_stack_contents(self.project, manifest, 'gcc@7.3.0', 'openmpi@4.0.5')
+        self.assertNotIn(include, contents['spack']['include'])
+
+    def test_stacks_index(self):
+        environ['SPACK_CM_CUDAS'] = 'cuda@11'
+        stacks = spack_all_stacks_yaml(self.project, True, workers=2)
+        index = read_stacks_index(self.projectdir)
+        self.assertEqual(index, stacks)
+        self.assertEqual(sorted(index), ['gcc@10.1.0-openmpi@4.0.5-cuda@11',
+                                         'gcc@7.3.0-openmpi@4.0.5-cuda@11'])
+        self.assertEqual(index['gcc@7.3.0-openmpi@4.0.5-cuda@11']['cuda'], 'cuda@11')
+        filename = join(self.projectdir, 'tests-gcc@7.3.0-openmpi@4.0.5-cuda@11-spack.yaml')
+        mtime = os.stat(filename).st_mtime_ns
+        self.assertEqual(spack_all_stacks_yaml(self.project, True), stacks)
+        self.assertEqual(os.stat(filename).st_mtime_ns, mtime)
+        environ['SPACK_CM_CUDAS'] = ''
+        stacks = spack_all_stacks_yaml(self.project, True)
+        self.assertFalse(exists(filename))
+        self.assertEqual(sorted(read_stacks_index(self.projectdir)), sorted(stacks))
+        for entry in stacks.values():
+            self.assertIsNone(entry['cuda'])
+            remove(join(self.projectdir, entry['file']))
+        remove(join(self.projectdir, STACKS_INDEX))
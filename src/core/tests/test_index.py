@@ -0,0 +1,71 @@
+"""
+Test index.py
+"""
+
+import unittest
+import json
+import tempfile
+from os import environ, makedirs
+from os.path import join
+from shutil import rmtree
+from src.core.index import update_index, search
+
+
+def record(name, version, path, dependencies=None, compiler='10.1.0'):
+    spec = {'version': version,
+            'compiler': {'name': 'gcc', 'version': compiler}}
+    if dependencies:
+        spec['dependencies'] = {dep: {'hash': dep + 'hash', 'type': ['link']}
+                                for dep in dependencies}
+    return {'path': path, 'installed': True, 'explicit': True,
+            'installation_time': 100.0, 'spec': {name: spec}}
+
+
+class test_Index(unittest.TestCase):
+    """
+    Test the install index from src.core.index
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        environ['SPACK_CM_INSTALL_PATH'] = self.root
+        self.install_path = join(self.root, 'tpl')
+        makedirs(join(self.install_path, '.spack-db'))
+        self.installs = {
+            'zlibhash': record('zlib', '1.2.11', '/tpl/zlib'),
+            'openmpihash': record('openmpi', '4.0.5', '/tpl/openmpi'),
+            'cudahash': record('cuda', '11.2.0', '/tpl/cuda'),
+            'hdf5hash': record('hdf5', '1.12.0', '/tpl/hdf5', ['zlib', 'openmpi', 'cuda']),
+            'hdf5oldhash': record('hdf5', '1.10.7', '/tpl/hdf5-old', ['zlib'], '7.3.0')}
+        self.write_index()
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def write_index(self):
+        with open(join(self.install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'version': '5', 'installs': self.installs}}, f)
+
+    def test_update_index(self):
+        self.assertEqual(update_index('tpl', self.install_path), (5, 0))
+        self.assertEqual(update_index('tpl', self.install_path), (0, 0))
+        del self.installs['hdf5oldhash']
+        self.installs['metishash'] = record('metis', '5.1.0', '/tpl/metis')
+        self.write_index()
+        self.assertEqual(update_index('tpl', self.install_path), (1, 1))
+        self.assertEqual([install['name'] for install in search()],
+                         ['cuda', 'hdf5', 'metis', 'openmpi', 'zlib'])
+
+    def test_search(self):
+        update_index('tpl', self.install_path)
+        hdf5 = search('hdf5')
+        self.assertEqual(len(hdf5), 2)
+        hdf5 = search('hdf5%gcc@10^openmpi@4')
+        self.assertEqual(len(hdf5), 1)
+        self.assertEqual(hdf5[0]['mpi'], 'openmpi@4.0.5')
+        self.assertEqual(hdf5[0]['cuda'], 'cuda@11.2.0')
+        self.assertEqual(hdf5[0]['prefix'], '/tpl/hdf5')
+        self.assertEqual(search('hdf5@1.10')[0]['compiler'], 'gcc@7.3.0')
+        self.assertEqual(search('hdf5@1.1'), [])
+        self.assertEqual(search('hdf5 ^cuda@11'), hdf5)
+        self.assertEqual(len(search('%gcc@10.1.0', stage='tpl')), 4)
+        self.assertEqual(search('zlib', stage='base'), [])
@@ -1,3 +1,178 @@
 """
 Test installer.py
 """
+
+import unittest
+from src.core.installer import (stage_dependencies, run_stage, run_stages,
+                                stage_durations, stack_durations,
+                                longest_first, print_schedule,
+                                InstallException)
+from src.core.context import ProjectContext, parse_manifest
+from src.core.journal import load_journal
+from src.core.backend import settings as backend_settings, set_backend
+from src.core import compilers, timings
+from os import environ, makedirs, chmod, remove
+from os.path import abspath, dirname, isfile, join
+from shutil import rmtree
+from contextlib import redirect_stdout
+import io
+import json
+import tempfile
+import time
+
+PROJECT_DIR = join(dirname(dirname(dirname(abspath(__file__)))), 'project', 'tests')
+
+
+class test_StageDependencies(unittest.TestCase):
+    """
+    Test stage scheduling helpers from src.core.installer
+    """
+    @classmethod
+    def setUpClass(cls):
+        environ['SPACK_CM_COMPILERS'] = 'gcc@7.3.0, gcc@10.1.0'
+
+    def test_utility_built_with_new_compiler(self):
+        environ['SPACK_CM_UTILITY_COMPILER'] = 'gcc@7.3.0'
+        dependencies = stage_dependencies()
+        self.assertIn('compiler', dependencies['utility'])
+        self.assertEqual(dependencies['lmod'], ['base'])
+        self.assertIn('utility', dependencies['tpl'])
+
+    def test_utility_built_with_system_compiler(self):
+        # The utilities still include the compilers.yaml of the compilers.
+        environ['SPACK_CM_UTILITY_COMPILER'] = 'gcc@4.8.5'
+        dependencies = stage_dependencies()
+        self.assertIn('compiler', dependencies['utility'])
+
+    def test_no_compilers_built(self):
+        environ['SPACK_CM_UTILITY_COMPILER'] = 'gcc@4.8.5'
+        environ['SPACK_CM_COMPILERS'] = ''
+        try:
+            dependencies = stage_dependencies()
+        finally:
+            environ['SPACK_CM_COMPILERS'] = 'gcc@7.3.0, gcc@10.1.0'
+        self.assertNotIn('compiler', dependencies['utility'])
+
+    def test_unknown_stage(self):
+        with self.assertRaises(InstallException):
+            run_stages('tests', 'tests', 'typo', False, False, '')
+
+
+class test_StageDurations(unittest.TestCase):
+    """
+    Test the install time estimates used to schedule stages and stacks
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        manifest = parse_manifest({'SPACK_CM_BASE_COMPILER': ['gcc@4.8.5'],
+                                   'SPACK_CM_BASE_PACKAGES': ['zlib'],
+                                   'SPACK_CM_COMPILERS': ['gcc@10.1.0'],
+                                   'SPACK_CM_UTILITY_COMPILER': ['gcc@10.1.0'],
+                                   'SPACK_CM_UTILITIES': ['cmake'],
+                                   'SPACK_CM_TPLS': ['boost', 'zlib'],
+                                   'SPACK_CM_MPIS': ['openmpi@4.0.5', 'mpich@3.4.2'],
+                                   'SPACK_CM_EXTERNAL_COMPILERS': [''],
+                                   'SPACK_CM_EXTERNAL_MPIS': [''],
+                                   'SPACK_CM_CUDAS': [''],
+                                   'SPACK_CM_EXTERNAL_CUDAS': ['']},
+                                  'gcc@4.8.5')
+        self.context = ProjectContext(project='tests', machine='tests',
+                                      install_path=self.root, module_path=self.root,
+                                      manifest=manifest)
+        timings.start_run('tests', 'tests', 'all', self.context)
+        timings.record_stage_time('base', time.time() - 30, 'installed')
+        timings.record_attempt('tpl:gcc@10.1.0-mpich@3.4.2', 1, time.time() - 500, 0)
+        for name, seconds in [('cmake', 12.0), ('boost', 300.0), ('openmpi', 60.0)]:
+            timings.execute('INSERT INTO specs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (timings.current['run'], 'tpl', name, name, '1.0',
+                             'gcc@10.1.0', seconds, 'database'))
+
+    def tearDown(self):
+        timings.current.update(run=None, state=None)
+        rmtree(self.root)
+
+    def test_stage_durations(self):
+        durations = stage_durations(['base', 'utility', 'lmod'], self.context)
+        self.assertEqual(durations['base'][1], 'history')
+        self.assertAlmostEqual(durations['base'][0], 30, delta=5)
+        self.assertEqual(durations['utility'], (12.0, 'specs'))
+        self.assertEqual(durations['lmod'], (0, 'unknown'))
+
+    def test_stack_durations(self):
+        durations = stack_durations([('gcc@10.1.0', 'openmpi@4.0.5', None),
+                                     ('gcc@10.1.0', 'mpich@3.4.2', None)], self.context)
+        self.assertEqual(durations['gcc@10.1.0-openmpi@4.0.5'], (372.0, 'specs'))
+        self.assertEqual(durations['gcc@10.1.0-mpich@3.4.2'][1], 'history')
+
+    def test_single_stack_schedule(self):
+        stacks = [('gcc@10.1.0', 'openmpi@4.0.5', None), ('gcc@10.1.0', 'mpich@3.4.2', None),
+                  ('gcc@7.3.0', 'openmpi@4.0.5', None)]
+        durations = {'gcc@10.1.0-openmpi@4.0.5': (10.0, 'history'),
+                     'gcc@10.1.0-mpich@3.4.2': (10.0, 'history'),
+                     'gcc@7.3.0-openmpi@4.0.5': (100.0, 'history')}
+        stacks, durations = longest_first(stacks, durations)
+        self.assertEqual(stacks[0], ('gcc@7.3.0', 'openmpi@4.0.5', None))
+        output = io.StringIO()
+        with redirect_stdout(output):
+            print_schedule('Single stacks', durations, {}, 2)
+        # The two short stacks run next to the long one.
+        self.assertIn('predicted makespan 1m40s with 2 worker(s)', output.getvalue())
+
+
+class test_ContextInstall(unittest.TestCase):
+    """
+    Test that a stage installs from its context alone, with nothing of the
+    project exported to os.environ
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.environ = dict(environ)
+        self.backend = backend_settings['backend']
+        self.cache_dir = compilers.compiler_cache_dir
+        bin = join(self.root, 'bin')
+        makedirs(bin)
+        # Stand-in spack recording its commands.
+        self.log = join(self.root, 'spack.log')
+        with open(join(bin, 'spack'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> {}\n'.format(self.log))
+        chmod(join(bin, 'spack'), 0o755)
+        for key in list(environ):
+            if key.startswith('SPACK_CM_') or key == 'SYSTEM_COMPILER':
+                del environ[key]
+        environ['PATH'] = bin + ':' + environ['PATH']
+        set_backend('shell')
+        compilers.compiler_cache_dir = lambda machine: self.root
+        manifest = parse_manifest({'SPACK_CM_BASE_COMPILER': ['gcc@4.8.5'],
+                                   'SPACK_CM_BASE_PACKAGES': ['zlib']},
+                                  'gcc@4.8.5')
+        self.context = ProjectContext(project='tests', machine='tests',
+                                      install_path=join(self.root, 'install'),
+                                      module_path=join(self.root, 'modules'),
+                                      manifest=manifest, build_jobs=4)
+        makedirs(join(self.context.base_packages_install_path, '.spack-db'))
+        with open(join(self.context.base_packages_install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': {}}}, f)
+        self.yaml = join(PROJECT_DIR, 'base-packages-spack.yaml')
+        with open(self.yaml, 'w') as f:
+            f.write('spack:\n  specs: [zlib]\n')
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        set_backend(self.backend)
+        compilers.compiler_cache_dir = self.cache_dir
+        remove(self.yaml)
+        rmtree(self.root)
+
+    def test_run_stage_without_environ(self):
+        run_stage('base', 'tests', 'tests', False, False, '', context=self.context)
+        self.assertNotIn('SPACK_CM_INSTALL_PATH', environ)
+        self.assertIn('base', load_journal(self.context))
+        state = join(self.context.install_path, '.spack-cm')
+        self.assertTrue(isfile(join(state, 'journal.json')))
+        self.assertTrue(isfile(join(state, 'index.db')))
+        with open(self.log, 'r') as f:
+            commands = f.read().splitlines()
+        # A single attempt, with the build jobs of the context.
+        self.assertEqual([command for command in commands if command.startswith('install')],
+                         ['install -j 4'])
@@ -0,0 +1,102 @@
+"""
+Test journal.py
+"""
+
+import unittest
+import json
+import tempfile
+from os import environ, makedirs
+from os.path import join
+from shutil import rmtree, copy
+from src.core.journal import yaml_fingerprint, stage_is_current, record_stage
+from src.core.tests.test_lockfile import INSTALL_PATH, DAG_HASHES, lockfile
+
+
+class test_Journal(unittest.TestCase):
+    """
+    Test stage journal methods from src.core.journal
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        environ['SPACK_CM_INSTALL_PATH'] = self.root
+        self.install_path = join(self.root, 'tpl')
+        makedirs(join(self.install_path, '.spack-db'))
+        with open(join(INSTALL_PATH, '.spack-db', 'index.json'), 'r') as f:
+            installs = json.load(f)['database']['installs']
+        # The installs of the cmake root of a spack 0.16 lockfile.
+        self.installs = {}
+        for name, key in DAG_HASHES.items():
+            self.installs[key] = dict(installs[key], path=join(self.install_path, name, key))
+            makedirs(self.installs[key]['path'])
+        self.write_index(self.installs)
+        self.envdir = join(self.root, 'env')
+        makedirs(self.envdir)
+        self.write_lock()
+        self.projectdir = join(self.root, 'project', 'tests')
+        makedirs(self.projectdir)
+        with open(join(self.projectdir, 'packages.yaml'), 'w') as f:
+            f.write('packages: {}\n')
+        self.spack_yaml = join(self.projectdir, 'tpl-spack.yaml')
+        self.write_yaml('zlib')
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def write_index(self, installs):
+        with open(join(self.install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': installs}}, f)
+
+    def write_lock(self, root='cmake'):
+        # Only keep the specs of the root, like the lock of a stage installing it.
+        with open(lockfile(2), 'r') as f:
+            lock = json.load(f)
+        lock['roots'] = [entry for entry in lock['roots']
+                         if entry['spec'].startswith(root + '@')]
+        with open(join(self.envdir, 'spack.lock'), 'w') as f:
+            json.dump(lock, f)
+
+    def write_yaml(self, spec):
+        with open(self.spack_yaml, 'w') as f:
+            f.write('spack:\n  include:\n  - packages.yaml\n  specs:\n  - {}\n'.format(spec))
+
+    def test_yaml_fingerprint_follows_includes(self):
+        before = yaml_fingerprint(self.spack_yaml)
+        self.assertEqual(before, yaml_fingerprint(self.spack_yaml))
+        with open(join(self.projectdir, 'packages.yaml'), 'w') as f:
+            f.write('packages:\n  zlib:\n    buildable: false\n')
+        self.assertNotEqual(before, yaml_fingerprint(self.spack_yaml))
+
+    def test_stage_skipped_when_unchanged(self):
+        inputs = yaml_fingerprint(self.spack_yaml)
+        self.assertFalse(stage_is_current('tpl', inputs, self.install_path))
+        record_stage('tpl', inputs, self.install_path, self.envdir)
+        self.assertTrue(stage_is_current('tpl', inputs, self.install_path))
+        self.write_yaml('hdf5')
+        self.assertFalse(stage_is_current('tpl', yaml_fingerprint(self.spack_yaml),
+                                          self.install_path))
+
+    def test_other_installs_do_not_make_stage_stale(self):
+        inputs = yaml_fingerprint(self.spack_yaml)
+        record_stage('tpl', inputs, self.install_path, self.envdir)
+        other = join(self.install_path, 'other')
+        makedirs(other)
+        self.write_index(dict(self.installs, otherhash={
+            'spec': {'other': {'version': '1.0'}}, 'path': other,
+            'installed': True, 'explicit': True}))
+        self.assertTrue(stage_is_current('tpl', inputs, self.install_path))
+
+    def test_stage_rerun_when_installs_change(self):
+        inputs = yaml_fingerprint(self.spack_yaml)
+        record_stage('tpl', inputs, self.install_path, self.envdir)
+        rmtree(self.installs[DAG_HASHES['zlib']]['path'])
+        self.assertFalse(stage_is_current('tpl', inputs, self.install_path))
+        self.write_index({key: record for key, record in self.installs.items()
+                          if key != DAG_HASHES['openssl']})
+        self.assertFalse(stage_is_current('tpl', inputs, self.install_path))
+
+    def test_stage_not_recorded_current_when_lock_not_installed(self):
+        # hdf5 is in the lock but was never installed.
+        copy(lockfile(2), join(self.envdir, 'spack.lock'))
+        inputs = yaml_fingerprint(self.spack_yaml)
+        record_stage('tpl', inputs, self.install_path, self.envdir)
+        self.assertFalse(stage_is_current('tpl', inputs, self.install_path))
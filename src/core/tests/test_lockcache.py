@@ -0,0 +1,70 @@
+"""
+Test lockcache.py
+"""
+
+import unittest
+import tempfile
+from os import environ, listdir, makedirs, remove
+from os.path import join, isfile
+from shutil import rmtree
+from src.core import lockcache
+from src.core.lockcache import (restore_lock, save_lock, discard_lock,
+                                lock_cache_dir, lock_key)
+from src.core.backend import user_config_dir
+
+
+class test_LockCache(unittest.TestCase):
+    """
+    Test concretization cache methods from src.core.lockcache
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        environ['SPACK_CM_INSTALL_PATH'] = self.root
+        self.envdir = join(self.root, 'env')
+        makedirs(self.envdir)
+        lockcache.stats.update(hits=0, misses=0)
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def test_restore_saved_lock(self):
+        self.assertFalse(restore_lock('abc', self.envdir))
+        with open(join(self.envdir, 'spack.lock'), 'w') as f:
+            f.write('{"roots": []}')
+        save_lock('abc', self.envdir)
+        remove(join(self.envdir, 'spack.lock'))
+        self.assertTrue(restore_lock('abc', self.envdir))
+        with open(join(self.envdir, 'spack.lock'), 'r') as f:
+            self.assertEqual(f.read(), '{"roots": []}')
+        self.assertEqual(lockcache.stats, {'hits': 1, 'misses': 1})
+        discard_lock('abc', self.envdir)
+        self.assertFalse(isfile(join(lock_cache_dir(), lock_key('abc', self.envdir) + '.lock')))
+
+    def test_save_without_lock(self):
+        save_lock('abc', self.envdir)
+        self.assertEqual(listdir(lock_cache_dir()), [])
+
+    def test_detected_configuration_in_key(self):
+        with open(join(self.envdir, 'spack.lock'), 'w') as f:
+            f.write('{}')
+        save_lock('abc', self.envdir)
+        config = user_config_dir(self.envdir)
+        makedirs(config, exist_ok=True)
+        for name in ['compilers.yaml', 'packages.yaml']:
+            key = lock_key('abc', self.envdir)
+            with open(join(config, name), 'w') as f:
+                f.write('{}: []'.format(name.split('.')[0]))
+            # Other compilers or externals are concretized again.
+            self.assertNotEqual(lock_key('abc', self.envdir), key)
+            self.assertFalse(restore_lock('abc', self.envdir))
+
+    def test_oldest_locks_dropped(self):
+        lockcache.MAX_LOCKS = 2
+        try:
+            with open(join(self.envdir, 'spack.lock'), 'w') as f:
+                f.write('{}')
+            for inputs in ['a', 'b', 'c']:
+                save_lock(inputs, self.envdir)
+            self.assertEqual(len(listdir(lock_cache_dir())), 2)
+        finally:
+            lockcache.MAX_LOCKS = 100
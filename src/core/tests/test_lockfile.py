@@ -0,0 +1,70 @@
+"""
+Test lockfile.py
+"""
+
+import unittest
+from os.path import abspath, dirname, join
+from src.core.lockfile import (read_lock, lock_nodes, database_nodes,
+                               resolve_dag_hashes, lock_dag_hashes, root_closure)
+
+TESTS = dirname(abspath(__file__))
+INSTALL_PATH = join(TESTS, 'install_path', 'utility')
+DAG_HASHES = {'pkgconf': 'tcqpnsihvzedfiv6dcvbpzrjfexfsu3o',
+              'zlib': 'ldu43taplg2nbkxtem346zq4ibhad64i',
+              'openssl': 'drtfyprs3xdvvvhwxhvbryxwlenvsnvk',
+              'ncurses': '2r2fnykulsvzxflm2hwjy7autoextm53',
+              'cmake': '2nuomeez46onprdjqmqstnhnekgzpqwa'}
+
+
+def lockfile(version):
+    return join(TESTS, 'lockfiles', 'spack-v{}.lock'.format(version))
+
+
+class test_Lockfile(unittest.TestCase):
+    """
+    Test lockfile methods from src.core.lockfile
+    """
+    def names(self, version):
+        nodes = lock_nodes(read_lock(lockfile(version)))
+        hashes = lock_dag_hashes(lockfile(version), INSTALL_PATH)
+        return nodes, {nodes[key]['name']: hashes[key] for key in nodes}
+
+    def test_lock_nodes(self):
+        for version in (2, 3, 4):
+            nodes = lock_nodes(read_lock(lockfile(version)))
+            cmake = [node for node in nodes.values() if node['name'] == 'cmake'][0]
+            self.assertEqual((cmake['version'], cmake['compiler']), ('3.18.4', 'gcc@7.3.0'))
+            self.assertEqual(sorted(nodes[key]['name'] for key in cmake['dependencies']),
+                             ['ncurses', 'openssl'])
+            ncurses = [node for node in nodes.values() if node['name'] == 'ncurses'][0]
+            self.assertEqual([nodes[key]['name'] for key in ncurses['dependencies']], ['pkgconf'])
+            self.assertEqual(ncurses['link_dependencies'], [])
+        self.assertEqual([node['dag_hash'] for node in lock_nodes(read_lock(lockfile(2))).values()],
+                         6*[None])
+
+    def test_dag_hashes_of_build_hash_keyed_lockfile(self):
+        nodes, hashes = self.names(2)
+        self.assertEqual(hashes, dict(DAG_HASHES, hdf5=None))
+        self.assertFalse(set(nodes) & set(DAG_HASHES.values()))
+
+    def test_dag_hashes_read_from_lockfile(self):
+        for version in (3, 4):
+            nodes, hashes = self.names(version)
+            self.assertEqual({name: key for name, key in hashes.items() if name != 'hdf5'},
+                             DAG_HASHES)
+            self.assertIsNotNone(hashes['hdf5'])
+
+    def test_dependencies_must_match(self):
+        nodes = lock_nodes(read_lock(lockfile(2)))
+        installs = database_nodes(INSTALL_PATH)
+        openssl = [key for key in nodes if nodes[key]['name'] == 'openssl'][0]
+        installs[DAG_HASHES['zlib']]['parameters'] = {'shared': False}
+        hashes = resolve_dag_hashes(nodes, installs)
+        self.assertIsNone(hashes[openssl])
+
+    def test_root_closure(self):
+        lock = read_lock(lockfile(2))
+        lock['roots'] = lock['roots'][:1]
+        nodes = lock_nodes(lock)
+        self.assertEqual(sorted(nodes[key]['name'] for key in root_closure(lock, nodes)),
+                         ['cmake', 'ncurses', 'openssl', 'zlib'])
@@ -18,6 +18,37 @@ class test_MainDriver(unittest.TestCase):
         self.assertEqual(setup.althostname, None)
         self.assertEqual(setup.project, 'tests')
 
+    def test_plan_parser(self):
+        plan = self.parser.parse_args(['plan', '-p', 'tests', '-s', 'tpl'])
+        self.assertEqual(plan.command, 'plan')
+        self.assertEqual(plan.stage, 'tpl')
+        self.assertFalse(plan.external)
+        self.assertTrue(plan.projmod)
+        self.assertEqual(plan.spack_backend, 'worker')
+
+    def test_query_parser(self):
+        query = self.parser.parse_args(['query', 'hdf5%gcc@10', '-p', 'tests',
+                                        '-r', '~/', '--prefix'])
+        self.assertEqual(query.command, 'query')
+        self.assertEqual(query.spec, 'hdf5%gcc@10')
+        self.assertEqual(query.stage, None)
+        self.assertTrue(query.show_prefix)
+        with self.assertRaises(MainException):
+            main(self.parser.parse_args(['query', '-p', 'tests']))
+
+    def test_batch_parser(self):
+        batch = self.parser.parse_args(['batch', 'installs.yaml',
+                                        '--max-spack-processes', '4',
+                                        '--cores', '64', '--dry-run'])
+        self.assertEqual(batch.command, 'batch')
+        self.assertEqual(batch.file, 'installs.yaml')
+        self.assertEqual(batch.max_spack, 4)
+        self.assertEqual(batch.cores, 64)
+        self.assertEqual(batch.fake, '--fake')
+        self.assertEqual(batch.spack_backend, 'worker')
+        with self.assertRaises(SystemExit):
+            self.parser.parse_args(['batch'])
+
     def test_install_parser(self):
         install = self.parser.parse_args(['install', '-p', 'tests',
                                           '-r', '~/'])
@@ -69,3 +100,12 @@ class test_MainDriver(unittest.TestCase):
         with self.assertRaises(MainException):
             arguments = self.parser.parse_args(['install', '-p', 'tests'])
             main(arguments)
+
+    def test_install_attempts(self):
+        install = self.parser.parse_args(['install', '--attempts', '4',
+                                          '--attempts', 'tpl=6',
+                                          '--retry-jobs', '2'])
+        self.assertEqual(install.attempts, [('all', 4), ('tpl', 6)])
+        self.assertEqual(install.retry_jobs, 2)
+        with self.assertRaises(SystemExit):
+            self.parser.parse_args(['install', '--attempts', 'typo=2'])
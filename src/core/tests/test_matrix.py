@@ -0,0 +1,82 @@
+"""
+Test matrix.py
+"""
+
+import unittest
+from src.core.matrix import (MatrixException, parse_spec, versions_overlap,
+                             satisfies, expand_matrix, expand_specs)
+
+
+class test_Matrix(unittest.TestCase):
+    """
+    Test matrix expansion and exclude rules from src.core.matrix
+    """
+    def test_parse_spec(self):
+        spec = parse_spec('hdf5@1.10.6+mpi~cxx build_type=Release %gcc@10.1.0 ^openmpi@4.0.5 +cuda')
+        self.assertEqual(spec['name'], 'hdf5')
+        self.assertEqual(spec['version'], '1.10.6')
+        self.assertEqual(spec['variants'], {'mpi': True, 'cxx': False,
+                                            'build_type': 'Release'})
+        self.assertEqual(spec['compiler']['name'], 'gcc')
+        self.assertEqual(spec['compiler']['version'], '10.1.0')
+        self.assertEqual(spec['dependencies']['openmpi']['version'], '4.0.5')
+        self.assertEqual(spec['dependencies']['openmpi']['variants'], {'cuda': True})
+        anonymous = parse_spec('%gcc@10.1.0 ^openmpi@1.10.7')
+        self.assertIsNone(anonymous['name'])
+        with self.assertRaises(MatrixException):
+            parse_spec('hdf5 zlib')
+        with self.assertRaises(MatrixException):
+            parse_spec('hdf5 ^@1.2')
+
+    def test_versions_overlap(self):
+        self.assertTrue(versions_overlap('10.1.0', '10'))
+        self.assertTrue(versions_overlap('10', '10.1'))
+        self.assertFalse(versions_overlap('10.1.0', '10.2'))
+        self.assertTrue(versions_overlap('1.10.6', '1.8:'))
+        self.assertFalse(versions_overlap('1.10.6', ':1.8'))
+        self.assertTrue(versions_overlap('1.10.6', '1.2,1.10'))
+        self.assertTrue(versions_overlap(None, '1.2'))
+
+    def test_satisfies(self):
+        rule = parse_spec('%gcc@10.1.0 ^openmpi@1.10.7')
+        self.assertTrue(satisfies(parse_spec('hdf5 %gcc@10.1.0 ^openmpi@1.10.7'), rule))
+        self.assertFalse(satisfies(parse_spec('hdf5 %gcc@10.1.0 ^openmpi@4.0.5'), rule))
+        self.assertFalse(satisfies(parse_spec('hdf5 %gcc@7.3.0 ^openmpi@1.10.7'), rule))
+        # Like spack, a spec which does not set the MPI could still match.
+        self.assertTrue(satisfies(parse_spec('openmpi@1.10.7 %gcc@10.1.0'), rule))
+        # A rule naming one MPI leaves the specs built with another alone.
+        rule = parse_spec('%intel@19 ^mpich@3.3')
+        self.assertFalse(satisfies(parse_spec('hdf5 %intel@19 ^openmpi@4.0.5'), rule))
+        self.assertFalse(satisfies(parse_spec('openmpi@4.0.5 %intel@19'), rule))
+        self.assertTrue(satisfies(parse_spec('hdf5 %intel@19 ^mpich@3.3'), rule))
+        self.assertTrue(satisfies(parse_spec('mpich@3.3 %intel@19'), rule))
+        self.assertTrue(satisfies(parse_spec('zlib %intel@19'), rule))
+        rule = parse_spec('valgrind%gcc@4.8.5')
+        self.assertTrue(satisfies(parse_spec('valgrind@3.15.0 %gcc@4.8.5'), rule))
+        self.assertFalse(satisfies(parse_spec('zlib %gcc@4.8.5'), rule))
+        rule = parse_spec('^mpi')
+        self.assertTrue(satisfies(parse_spec('hdf5 ^mpich@3'), rule))
+        rule = parse_spec('hdf5~mpi')
+        self.assertFalse(satisfies(parse_spec('hdf5+mpi %gcc'), rule))
+        self.assertTrue(satisfies(parse_spec('hdf5 %gcc'), rule))
+
+    def test_expand_specs(self):
+        self.assertEqual(expand_matrix([['hdf5', 'zlib'], ['%gcc@10.1.0']]),
+                         ['hdf5 %gcc@10.1.0', 'zlib %gcc@10.1.0'])
+        matrices = [[['openmpi@1.10.7', 'openmpi@4.0.5'], ['%gcc@7.3.0', '%gcc@10.1.0']],
+                    [['hdf5', 'valgrind@3.15.0'], ['%gcc@7.3.0', '%gcc@10.1.0'],
+                     ['^openmpi@1.10.7', '^openmpi@4.0.5']]]
+        specs, excluded = expand_specs(matrices, ['%gcc@10.1.0 ^openmpi@1.10.7',
+                                                  'valgrind%gcc@7.3.0', ''])
+        # The MPIs built with gcc@10.1.0 have no MPI dependency to tell
+        # them apart, so the first rule excludes them too, as spack does.
+        self.assertEqual(excluded, 6)
+        self.assertEqual(specs, ['openmpi@1.10.7 %gcc@7.3.0', 'openmpi@4.0.5 %gcc@7.3.0',
+                                 'hdf5 %gcc@7.3.0 ^openmpi@1.10.7',
+                                 'hdf5 %gcc@7.3.0 ^openmpi@4.0.5',
+                                 'hdf5 %gcc@10.1.0 ^openmpi@4.0.5',
+                                 'valgrind@3.15.0 %gcc@10.1.0 ^openmpi@4.0.5'])
+        self.assertNotIn('hdf5 %gcc@10.1.0 ^openmpi@1.10.7', specs)
+        self.assertIn('hdf5 %gcc@10.1.0 ^openmpi@4.0.5', specs)
+        self.assertNotIn('valgrind@3.15.0 %gcc@7.3.0 ^openmpi@4.0.5', specs)
+        self.assertEqual(expand_specs(matrices, [''])[1], 0)
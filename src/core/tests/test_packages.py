@@ -3,8 +3,15 @@ Test packages.py
 """
 
 import unittest
+import json
+import shutil
+import tempfile
 import yaml
-from src.core.packages import generate_packages_yaml
+from src.core import packages
+from src.core.packages import (generate_packages_yaml, iter_installs, install_node,
+                               package_external, compact_externals,
+                               externals_options, PackagesException,
+                               PACKAGES_STATE)
 import os
 
 class test_Packages(unittest.TestCase):
@@ -15,14 +22,15 @@ class test_Packages(unittest.TestCase):
         filedir, filename = os.path.split(os.path.abspath(__file__))
         cls.install_path = os.path.join(filedir, 'install_path', 'utility')
 
-        if os.path.exists(os.path.join(cls.install_path, 'packages.yaml')):
-            os.remove(os.path.join(cls.install_path, 'packages.yaml'))
+        for name in ['packages.yaml', PACKAGES_STATE]:
+            if os.path.exists(os.path.join(cls.install_path, name)):
+                os.remove(os.path.join(cls.install_path, name))
 
     @classmethod
     def tearDownClass(cls):
-        if os.path.exists(os.path.join(cls.install_path, 'packages.yaml')):
-            os.remove(os.path.join(cls.install_path, 'packages.yaml'))
-            pass
+        for name in ['packages.yaml', PACKAGES_STATE]:
+            if os.path.exists(os.path.join(cls.install_path, name)):
+                os.remove(os.path.join(cls.install_path, name))
 
     def test_install_path_exists(self):
         self.assertTrue(os.path.isdir(self.install_path))
@@ -42,3 +50,105 @@ class test_Packages(unittest.TestCase):
             self.assertIn('prefix', file_contents['packages']['texlive']['externals'][0])
             self.assertIn('/projects/sems/install/rhel7-x86_64/sems-beta/utility/texlive',
                           file_contents['packages']['texlive']['externals'][0]['prefix'])
+
+    def test_iter_installs(self):
+        index = os.path.join(self.install_path, '.spack-db', 'index.json')
+        with open(index) as f:
+            installs = json.load(f)['database']['installs']
+        chunk_size = packages.CHUNK_SIZE
+        packages.CHUNK_SIZE = 100
+        try:
+            self.assertEqual(dict(iter_installs(index)), installs)
+        finally:
+            packages.CHUNK_SIZE = chunk_size
+
+    def test_packages_yaml_incremental(self):
+        path = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(path, '.spack-db'))
+            index = os.path.join(path, '.spack-db', 'index.json')
+            with open(os.path.join(self.install_path, '.spack-db', 'index.json')) as f:
+                contents = json.load(f)
+            installs = contents['database']['installs']
+            removed = list(installs)[0]
+            with open(index, 'w') as f:
+                json.dump(contents, f)
+            generate_packages_yaml(path)
+            with open(os.path.join(path, 'packages.yaml')) as f:
+                full = yaml.safe_load(f)
+            del installs[removed]
+            with open(index, 'w') as f:
+                json.dump(contents, f, indent=1)
+            generate_packages_yaml(path)
+            with open(os.path.join(path, 'packages.yaml')) as f:
+                updated = yaml.safe_load(f)
+            count = lambda packages: sum(len(entry['externals']) for entry in packages['packages'].values())
+            self.assertEqual(count(updated), count(full) - 1)
+            with open(os.path.join(path, PACKAGES_STATE)) as f:
+                self.assertNotIn(removed, json.load(f)['externals'])
+            mtime = os.stat(os.path.join(path, 'packages.yaml')).st_mtime_ns
+            generate_packages_yaml(path)
+            self.assertEqual(os.stat(os.path.join(path, 'packages.yaml')).st_mtime_ns, mtime)
+        finally:
+            shutil.rmtree(path)
+
+    def test_package_external_provenance(self):
+        def node(name, version, dependencies=()):
+            return install_node({'spec': {name: {
+                'version': version,
+                'compiler': {'name': 'gcc', 'version': '10.1.0'},
+                'dependencies': {dep: {'hash': dep} for dep in dependencies}}}})
+        nodes = {'cuda': node('cuda', '11.2.0'),
+                 'openmpi': node('openmpi', '4.0.5', ['cuda']),
+                 'hdf5': node('hdf5', '1.12.0', ['openmpi']),
+                 'petsc': node('petsc', '3.14.1', ['hdf5']),
+                 'zlib': node('zlib', '1.2.11')}
+        memo = {}
+        self.assertEqual(package_external('petsc', nodes, '/base/petsc', memo),
+                         ['petsc', 'petsc@3.14.1%gcc@10.1.0^openmpi@4.0.5^cuda@11.2.0',
+                          '/base/petsc', '3.14.1', True])
+        self.assertEqual(package_external('openmpi', nodes, '/base/openmpi', memo)[1],
+                         'openmpi@4.0.5%gcc@10.1.0^cuda@11.2.0')
+        self.assertEqual(package_external('zlib', nodes, '/base/zlib', memo, False)[1],
+                         'zlib@1.2.11')
+        self.assertIn('hdf5', memo)
+
+    def test_compact_externals(self):
+        externals = [['hdf5', 'hdf5@1.10.6%gcc@10.1.0', '/a', '1.10.6', True],
+                     ['hdf5', 'hdf5@1.12.0%gcc@10.1.0', '/b', '1.12.0', True],
+                     ['hdf5', 'hdf5@1.8.22%gcc@7.3.0', '/c', '1.8.22', True],
+                     ['zlib', 'zlib@1.2.11%gcc@10.1.0', '/d', '1.2.11', False],
+                     None]
+        options = {'latest': False, 'explicit': False, 'split': False,
+                   'versions': [], 'non_buildable': []}
+        packages = compact_externals(externals, options)['packages']
+        self.assertEqual(len(packages['hdf5']['externals']), 3)
+        self.assertTrue(packages['zlib']['buildable'])
+        options.update(latest=True, explicit=True, non_buildable=['hdf5'])
+        packages = compact_externals(externals, options)['packages']
+        self.assertEqual([external['prefix'] for external in packages['hdf5']['externals']],
+                         ['/b', '/c'])
+        self.assertFalse(packages['hdf5']['buildable'])
+        self.assertNotIn('zlib', packages)
+        options.update(versions=['hdf5@1.10'])
+        packages = compact_externals(externals, options)['packages']
+        self.assertEqual([external['prefix'] for external in packages['hdf5']['externals']],
+                         ['/a'])
+
+    def test_externals_options(self):
+        environ = os.environ.copy()
+        try:
+            os.environ['SPACK_CM_EXTERNALS_MODE'] = 'latest, split'
+            os.environ['SPACK_CM_NON_BUILDABLE'] = 'hdf5'
+            os.environ.pop('SPACK_CM_EXTERNALS_VERSIONS', None)
+            options = externals_options()
+            self.assertTrue(options['latest'] and options['split'])
+            self.assertFalse(options['explicit'])
+            self.assertEqual(options['non_buildable'], ['hdf5'])
+            self.assertEqual(options['versions'], [])
+            os.environ['SPACK_CM_EXTERNALS_MODE'] = 'newest'
+            with self.assertRaises(PackagesException):
+                externals_options()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
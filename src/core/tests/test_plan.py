@@ -0,0 +1,75 @@
+"""
+Test plan.py
+"""
+
+import unittest
+import json
+import tempfile
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from src.core.context import ProjectContext
+from src.core.plan import lock_specs, stage_plan
+from src.core.tests.test_lockfile import INSTALL_PATH, DAG_HASHES, lockfile
+
+
+class test_Plan(unittest.TestCase):
+    """
+    Test build plan methods from src.core.plan
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.context = ProjectContext(project='tests', machine='tests',
+                                      install_path=self.root, module_path=self.root)
+        self.install_path = self.context.tpl_install_path
+        makedirs(join(self.install_path, '.spack-db'))
+        with open(join(INSTALL_PATH, '.spack-db', 'index.json'), 'r') as f:
+            installs = json.load(f)['database']['installs']
+        installs = {DAG_HASHES[name]: installs[DAG_HASHES[name]]
+                    for name in ('pkgconf', 'zlib', 'openssl', 'ncurses')}
+        installs[DAG_HASHES['openssl']] = dict(installs[DAG_HASHES['openssl']],
+                                               installed=False)
+        with open(join(self.install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': installs}}, f)
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def write_lock(self, version):
+        # Real lockfile of the given version, with an external perl added.
+        with open(lockfile(version), 'r') as f:
+            lock = json.load(f)
+        perl = {'version': '5.16.3', 'compiler': {'name': 'gcc', 'version': '7.3.0'},
+                'external': {'path': '/usr', 'module': None}}
+        if version >= 4:
+            lock['concrete_specs']['perlhash'] = dict(perl, name='perl', hash='perlhash')
+        else:
+            lock['concrete_specs']['perlhash'] = {'perl': perl}
+        filename = join(self.root, 'spack-v{}.lock'.format(version))
+        with open(filename, 'w') as f:
+            json.dump(lock, f)
+        return filename
+
+    def test_lock_specs(self):
+        specs = {spec['name']: spec for spec in lock_specs(self.write_lock(2), self.install_path)}
+        zlib = dict(specs['zlib'])
+        self.assertNotEqual(zlib.pop('key'), DAG_HASHES['zlib'])
+        self.assertEqual(zlib, {'hash': DAG_HASHES['zlib'], 'name': 'zlib',
+                                'version': '1.2.11',
+                                'compiler': 'gcc@7.3.0',
+                                'external': False})
+        self.assertIsNone(specs['cmake']['hash'])
+        self.assertTrue(specs['perl']['external'])
+
+    def test_stage_plan(self):
+        estimates = {('hdf5', '1.10.7', 'gcc@7.3.0'): 120.0}
+        for version in (2, 3, 4):
+            plan = stage_plan('tpl', self.write_lock(version), estimates,
+                              context=self.context)
+            self.assertEqual([spec['name'] for spec in plan['build']],
+                             ['cmake', 'hdf5', 'openssl'])
+            self.assertEqual([spec['name'] for spec in plan['reuse']],
+                             ['ncurses', 'pkgconf', 'zlib'])
+            self.assertEqual([spec['name'] for spec in plan['external']], ['perl'])
+            self.assertEqual(plan['seconds'], 120.0)
+            self.assertEqual(plan['unknown'], 2)
@@ -0,0 +1,65 @@
+"""
+Test retry.py
+"""
+
+import unittest
+import json
+import tempfile
+from os.path import join
+from shutil import rmtree, copy
+from src.core.retry import failed_packages, failed_roots, failed_specs
+from src.core.tests.test_lockfile import DAG_HASHES, lockfile
+
+
+class test_Retry(unittest.TestCase):
+    """
+    Test failed spec detection from src.core.retry
+    """
+    def setUp(self):
+        self.envdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.envdir)
+
+    def write_lock(self, lock):
+        with open(join(self.envdir, 'spack.lock'), 'w') as f:
+            json.dump(lock, f)
+
+    def test_failed_packages(self):
+        lines = ['==> Error: Failed to install hdf5 due to ChildError: ProcessError',
+                 '==> Error: Failed to install superlu-dist-5.4.0-abcdefghijklmnopqrstuvwxyz012345: ProcessError',
+                 '==> Warning: Skipping build of parmetis since metis failed']
+        self.assertEqual(failed_packages(lines), {'hdf5', 'superlu-dist'})
+
+    def test_failed_roots_dictionary_nodes(self):
+        self.write_lock({'roots': [{'hash': 'a', 'spec': 'parmetis%gcc@7.3.0'},
+                                   {'hash': 'b', 'spec': 'zlib%gcc@7.3.0'}],
+                         'concrete_specs': {
+                             'a': {'parmetis': {'dependencies': {'metis': {'hash': 'c', 'type': ['link']}}}},
+                             'b': {'zlib': {}},
+                             'c': {'metis': {}}}})
+        self.assertEqual(failed_roots(self.envdir, {'metis'}), ['parmetis%gcc@7.3.0'])
+        self.assertEqual(failed_roots(self.envdir, {'zlib'}), ['zlib%gcc@7.3.0'])
+        self.assertEqual(failed_roots(self.envdir, set()), [])
+
+    def test_failed_roots_list_nodes(self):
+        self.write_lock({'roots': [{'hash': 'a', 'spec': 'hdf5'}],
+                         'concrete_specs': {
+                             'a': {'name': 'hdf5', 'dependencies': [{'name': 'zlib', 'hash': 'b'}]},
+                             'b': {'name': 'zlib'}}})
+        self.assertEqual(failed_roots(self.envdir, {'zlib'}), ['hdf5'])
+
+    def test_failed_roots_without_lock(self):
+        self.assertEqual(failed_roots(self.envdir, {'zlib'}), [])
+
+    def test_failed_specs_of_build_hash_keyed_lockfile(self):
+        copy(lockfile(2), join(self.envdir, 'spack.lock'))
+        self.assertEqual(sorted(failed_specs(self.envdir, {'cmake', 'zlib'})),
+                         [('cmake', '3.18.4', None), ('zlib', '1.2.11', None)])
+        self.assertEqual(failed_specs(self.envdir, set()), [])
+
+    def test_failed_specs_with_dag_hashes(self):
+        for version in (3, 4):
+            copy(lockfile(version), join(self.envdir, 'spack.lock'))
+            self.assertEqual(failed_specs(self.envdir, {'zlib'}),
+                             [('zlib', '1.2.11', DAG_HASHES['zlib'])])
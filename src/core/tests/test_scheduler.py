@@ -0,0 +1,92 @@
+"""
+Test scheduler.py
+"""
+
+import unittest
+import threading
+import time
+from src.core.scheduler import (run_graph, check_graph, critical_paths,
+                                simulate, SchedulerException)
+
+
+class test_Scheduler(unittest.TestCase):
+    """
+    Test run_graph method from src.core.scheduler
+    """
+    def setUp(self):
+        self.order = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def task(self, name, fail=False):
+        def run():
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(0.05)
+            with self.lock:
+                self.running -= 1
+                self.order.append(name)
+            if fail:
+                raise RuntimeError('{} broke'.format(name))
+            return name
+        return run
+
+    def test_dependencies_respected(self):
+        tasks = {name: self.task(name) for name in ['a', 'b', 'c', 'd']}
+        dependencies = {'b': ['a'], 'c': ['a'], 'd': ['b', 'c']}
+        results = run_graph(tasks, dependencies, max_workers=4)
+        self.assertEqual(results, {name: name for name in tasks})
+        self.assertEqual(self.order[0], 'a')
+        self.assertEqual(self.order[-1], 'd')
+        self.assertEqual(self.peak, 2)
+
+    def test_max_workers(self):
+        tasks = {name: self.task(name) for name in ['a', 'b', 'c', 'd']}
+        run_graph(tasks, {}, max_workers=1)
+        self.assertEqual(self.peak, 1)
+        self.assertEqual(self.order, ['a', 'b', 'c', 'd'])
+
+    def test_priorities(self):
+        tasks = {name: self.task(name) for name in ['a', 'b', 'c']}
+        run_graph(tasks, {}, max_workers=1, priorities={'c': 3, 'a': 1})
+        self.assertEqual(self.order, ['c', 'a', 'b'])
+
+    def test_critical_paths(self):
+        durations = {'base': 10, 'compiler': 60, 'utility': 20, 'lmod': 5, 'tpl': 100}
+        dependencies = {'compiler': ['base'], 'utility': ['base'], 'lmod': ['base'],
+                        'tpl': ['base', 'compiler', 'utility']}
+        paths = critical_paths(durations, dependencies)
+        self.assertEqual(paths, {'base': 170, 'compiler': 160, 'utility': 120,
+                                 'lmod': 5, 'tpl': 100})
+        # Two workers: lmod is started after the compilers it would delay.
+        schedule = simulate({'base': 10, 'lmod': 5, 'utility': 20, 'compiler': 60, 'tpl': 100},
+                            dependencies, 2, paths)
+        self.assertEqual(schedule, [('base', 0, 10), ('compiler', 10, 70),
+                                    ('utility', 10, 30), ('lmod', 30, 35),
+                                    ('tpl', 70, 170)])
+
+    def test_simulate_longest_first(self):
+        durations = {'a': 1, 'b': 1, 'c': 1, 'd': 3}
+        self.assertEqual(max(end for name, start, end in simulate(durations, {}, 2)), 4)
+        self.assertEqual(max(end for name, start, end in simulate(durations, {}, 2, durations)), 3)
+
+    def test_unselected_dependencies_ignored(self):
+        tasks = {'tpl': self.task('tpl')}
+        run_graph(tasks, {'tpl': ['base', 'compiler']})
+        self.assertEqual(self.order, ['tpl'])
+
+    def test_failure_skips_dependents(self):
+        tasks = {'a': self.task('a', fail=True),
+                 'b': self.task('b'),
+                 'c': self.task('c')}
+        with self.assertRaises(SchedulerException) as e:
+            run_graph(tasks, {'b': ['a']}, max_workers=2)
+        self.assertIn('Skipped: b', str(e.exception))
+        self.assertNotIn('b', self.order)
+        self.assertIn('c', self.order)
+
+    def test_cycle(self):
+        with self.assertRaises(SchedulerException):
+            check_graph(['a', 'b'], {'a': ['b'], 'b': ['a']})
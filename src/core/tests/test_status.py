@@ -0,0 +1,112 @@
+"""
+Test status.py
+"""
+
+import unittest
+import json
+import tempfile
+from os import makedirs, remove
+from os.path import split, abspath, dirname, join
+from shutil import copyfile, rmtree
+from src.core.context import ProjectContext, parse_manifest
+from src.core.status import (read_installs, spec_installed, stage_status,
+                             status, StatusException)
+
+
+def record(name, version, dependencies=None, compiler='10.1.0', parameters=None):
+    spec = {'version': version,
+            'compiler': {'name': 'gcc', 'version': compiler},
+            'parameters': parameters or {}}
+    if dependencies:
+        spec['dependencies'] = {dep: {'hash': dep + 'hash', 'type': ['link']}
+                                for dep in dependencies}
+    return {'path': '/tpl/' + name, 'installed': True, 'explicit': True,
+            'spec': {name: spec}}
+
+
+class test_Status(unittest.TestCase):
+    """
+    Test the manifest status from src.core.status
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        manifest = parse_manifest({'SPACK_CM_BASE_COMPILER': [''],
+                                   'SPACK_CM_BASE_PACKAGES': ['zlib'],
+                                   'SPACK_CM_COMPILERS': ['gcc@10.1.0'],
+                                   'SPACK_CM_UTILITY_COMPILER': ['gcc@10.1.0'],
+                                   'SPACK_CM_UTILITIES': ['cmake'],
+                                   'SPACK_CM_MPIS': ['openmpi@4.0.5'],
+                                   'SPACK_CM_EXTERNAL_MPIS': [''],
+                                   'SPACK_CM_EXTERNAL_COMPILERS': ['gcc@7.3.0'],
+                                   'SPACK_CM_CUDAS': [''],
+                                   'SPACK_CM_EXTERNAL_CUDAS': [''],
+                                   'SPACK_CM_TPLS': ['hdf5@1.10 +mpi', 'metis'],
+                                   'SPACK_CM_EXCLUDE_COMBOS': ['%gcc@7.3.0']},
+                                  'gcc@4.8.5')
+        self.context = ProjectContext(project='tests', machine='blake',
+                                      install_path=self.root,
+                                      module_path=join(self.root, 'modules'),
+                                      system_compiler='gcc@4.8.5',
+                                      manifest=manifest)
+        self.write_index('tpl', {
+            'zlibhash': record('zlib', '1.2.11'),
+            'openmpihash': record('openmpi', '4.0.5', ['zlib']),
+            'hdf5hash': record('hdf5', '1.10.7', ['zlib', 'openmpi'],
+                               parameters={'mpi': True, 'api': 'default'}),
+            'metishash': record('metis', '5.1.0', compiler='7.3.0')})
+        self.write_index('utility', {'cmakehash': record('cmake', '3.20.2')})
+
+    def tearDown(self):
+        rmtree(self.root)
+
+    def write_index(self, stage, installs):
+        database = join(self.root, stage, '.spack-db')
+        makedirs(database)
+        with open(join(database, 'index.json'), 'w') as f:
+            json.dump({'database': {'version': '5', 'installs': installs}}, f)
+
+    def test_spec_installed(self):
+        installs = read_installs(self.context.tpl_install_path)
+        self.assertEqual(spec_installed(installs, 'hdf5@1.10 +mpi %gcc@10.1.0 ^openmpi@4.0.5')['prefix'],
+                         '/tpl/hdf5')
+        self.assertEqual(spec_installed(installs, 'hdf5 ^mpi ^zlib@1.2')['name'], 'hdf5')
+        self.assertIsNone(spec_installed(installs, 'hdf5 ~mpi'))
+        self.assertIsNone(spec_installed(installs, 'hdf5 +shared'))
+        self.assertIsNone(spec_installed(installs, 'hdf5 %gcc@7.3.0'))
+        self.assertIsNone(spec_installed(installs, 'hdf5 ^mpich'))
+        self.assertIsNone(spec_installed(installs, 'metis ^openmpi@4.0.5'))
+        self.assertIsNone(spec_installed(installs, 'parmetis'))
+
+    def test_stage_status(self):
+        report = {(stage, spec): install is not None
+                  for stage, spec, install in stage_status(self.context)}
+        self.assertEqual(report, {('base', 'zlib %gcc@4.8.5'): False,
+                                  ('lmod', 'lmod'): False,
+                                  ('compiler', 'gcc@10.1.0 %gcc@4.8.5'): False,
+                                  ('utility', 'cmake %gcc@10.1.0'): True,
+                                  ('tpl', 'openmpi@4.0.5 %gcc@10.1.0'): True,
+                                  ('tpl', 'hdf5@1.10 +mpi %gcc@10.1.0 ^openmpi@4.0.5'): True,
+                                  ('tpl', 'metis %gcc@10.1.0 ^openmpi@4.0.5'): False})
+        self.assertEqual([stage for stage, spec, install in stage_status(self.context, 'utility')],
+                         ['utility'])
+        with self.assertRaises(StatusException):
+            stage_status(self.context, 'typo')
+
+    def test_status(self):
+        filedir, file = split(abspath(__file__))
+        projectdir = join(dirname(dirname(filedir)), 'project', 'tests')
+        copyfile(join(projectdir, 'tests-compilers-manifest.yaml'),
+                 join(projectdir, 'tests-manifest.yaml'))
+        try:
+            report = status('tests', 'blake', None, explicit_install_path=self.root)
+            self.assertTrue(report)
+            self.assertTrue(all(stage in ['base', 'lmod', 'compiler', 'utility', 'tpl']
+                                for stage, spec, install in report))
+            with self.assertRaises(StatusException):
+                status('tests', 'blake', None, explicit_install_path=join(self.root, 'typo'))
+        finally:
+            remove(join(projectdir, 'tests-manifest.yaml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Test timings.py
+"""
+
+import unittest
+import json
+import tempfile
+from os import environ, makedirs
+from os.path import join
+from shutil import rmtree
+from src.core import timings
+from src.core.timings import (spec_times, start_run, finish_run,
+                              record_attempt, record_stage_time,
+                              record_specs, report, format_seconds,
+                              stage_estimates)
+import time
+
+
+class test_Timings(unittest.TestCase):
+    """
+    Test build timing methods from src.core.timings
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        environ['SPACK_CM_INSTALL_PATH'] = self.root
+        self.install_path = join(self.root, 'tpl')
+        makedirs(join(self.install_path, '.spack-db'))
+        self.zlib = join(self.install_path, 'zlib')
+        self.hdf5 = join(self.install_path, 'hdf5')
+        makedirs(join(self.zlib, '.spack'))
+        makedirs(self.hdf5)
+        installs = {
+            'zlibhash': {'path': self.zlib, 'installed': True,
+                         'installation_time': 110.0,
+                         'spec': {'zlib': {'version': '1.2.11',
+                                           'compiler': {'name': 'gcc',
+                                                        'version': '10.1.0'}}}},
+            'hdf5hash': {'path': self.hdf5, 'installed': True,
+                         'installation_time': 150.0,
+                         'spec': {'hdf5': {'version': '1.10.7',
+                                           'compiler': {'name': 'gcc',
+                                                        'version': '10.1.0'},
+                                           'dependencies': {'zlib': {'hash': 'zlibhash'}}}}},
+            'oldhash': {'path': self.hdf5, 'installed': True,
+                        'installation_time': 10.0,
+                        'spec': {'cmake': {'version': '3.20.0'}}}}
+        with open(join(self.install_path, '.spack-db', 'index.json'), 'w') as f:
+            json.dump({'database': {'installs': installs}}, f)
+        with open(join(self.zlib, '.spack', 'install_times.json'), 'w') as f:
+            json.dump({'total': {'seconds': 4.5}}, f)
+
+    def tearDown(self):
+        timings.current.update(run=None, state=None)
+        rmtree(self.root)
+
+    def test_spec_times(self):
+        times = {spec[1]: spec for spec in spec_times(self.install_path, 100.0)}
+        self.assertEqual(sorted(times), ['hdf5', 'zlib'])
+        self.assertEqual(times['zlib'][4:], (4.5, 'install_times.json'))
+        # hdf5 could only start once zlib was installed.
+        self.assertEqual(times['hdf5'][4:], (40.0, 'database'))
+        self.assertEqual(times['hdf5'][3], 'gcc@10.1.0')
+
+    def test_nothing_recorded_without_run(self):
+        record_stage_time('tpl', 0.0, 'installed')
+        self.assertEqual(report(), [])
+
+    def test_report(self):
+        start_run('tests', 'machine', 'tpl')
+        record_attempt('tpl', 1, 100.0, 1)
+        record_attempt('tpl', 2, 120.0, 0)
+        record_stage_time('tpl', 100.0, 'installed')
+        record_specs('tpl', self.install_path, 100.0)
+        finish_run('installed')
+        lines = report()
+        self.assertEqual(lines[0], 'Time per stage:')
+        self.assertIn('2 attempt(s)', lines[1])
+        self.assertNotIn('previous', lines[1])
+        self.assertEqual(lines[2], 'Slowest specs:')
+        self.assertIn('hdf5@1.10.7 %gcc@10.1.0 (tpl)', lines[3])
+        start_run('tests', 'machine', 'tpl')
+        record_stage_time('tpl', 100.0, 'installed')
+        self.assertIn('previous', report()[1])
+
+    def test_stage_estimates(self):
+        self.assertEqual(stage_estimates(), {})
+        now = time.time()
+        start_run('tests', 'machine', 'tpl')
+        record_stage_time('base', now - 30, 'installed')
+        record_stage_time('utility', now - 30, 'failed')
+        # Both attempts of a stack count, failed stacks do not.
+        record_attempt('tpl:gcc-10.1.0', 1, now - 100, 1)
+        record_attempt('tpl:gcc-10.1.0', 2, now - 50, 0)
+        record_attempt('tpl:gcc-7.3.0', 1, now - 20, 1)
+        estimates = stage_estimates()
+        self.assertEqual(sorted(estimates), ['base', 'tpl:gcc-10.1.0'])
+        self.assertAlmostEqual(estimates['base'], 30, delta=5)
+        self.assertAlmostEqual(estimates['tpl:gcc-10.1.0'], 150, delta=5)
+
+    def test_format_seconds(self):
+        self.assertEqual(format_seconds(3), '3s')
+        self.assertEqual(format_seconds(123), '2m03s')
+        self.assertEqual(format_seconds(3723), '1h02m03s')
@@ -60,6 +60,19 @@ class test_Utilities(unittest.TestCase):
         with self.assertRaises(argparse.ArgumentTypeError) as e:
             dir_path(bad_path)
 
+    def test_cache_size(self):
+        self.assertEqual(cache_size('512'), 512)
+        self.assertEqual(cache_size('2K'), 2048)
+        self.assertEqual(cache_size('1.5g'), int(1.5 * 1024**3))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            cache_size('lots')
+
+    def test_stage_cleanup_policy(self):
+        self.assertEqual(stage_cleanup_policy('full'), ('all', 'full'))
+        self.assertEqual(stage_cleanup_policy('tpl=none'), ('tpl', 'none'))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            stage_cleanup_policy('everything')
+
 
     def test_get_hostname(self):
         message = 'OS does not match hostname.'
@@ -104,17 +117,6 @@ class test_Utilities(unittest.TestCase):
             env_var_list('not_in_the_env')
 
 
-    def test_generate_file(self):
-        message = 'Generate file failed'
-        filename = join(self.projectdir, 'tests_generate.yaml')
-        contents = 'These are definitely contents.'
-        generate_file(filename, contents)
-        with open(filename, 'r') as f:
-            data = f.read()
-        self.assertEqual(data, contents + '\n...\n', message)
-        remove(filename)
-
-
     def test_check_project_yaml_files(self):
         message = 'Project yaml check Failed'
         export_env_vars(self.project, self.machine, self.projectdir, False,
@@ -131,21 +133,6 @@ class test_Utilities(unittest.TestCase):
             rmtree(path)
         rmtree(environ['SPACK_CM_INSTALL_PATH'])
 
-    def test_replace_single_quotes(self):
-        message = 'Replacing single quotes failed'
-        text_with_single_quotes = '\'this\' is the \"sort\" of \'quoted\' text we \"need to\" \'fix\'?'
-        text_without_quotes = 'this is the \"sort\" of quoted text we \"need to\" fix\'\''
-
-        filename = join(self.projectdir, 'test_quotes.yaml')
-        with open(filename, 'w') as f:
-            f.write(text_with_single_quotes)
-        replace_single_quotes(filename)
-        with open(filename, 'r') as f:
-            data = f.read()
-        self.assertEqual(data, text_without_quotes, message)
-        remove(filename)
-
-
     def test_export_env_vars(self):
         message = 'Export environment variables failed'
         export_env_vars(self.project, self.machine, self.projectdir, False,
@@ -0,0 +1,434 @@
+"""
+Record how long stages, install attempts and specs take, and report on it
+"""
+
+from src.core.utilities import state_dir, pcolors
+from os.path import isfile, join
+from contextlib import closing
+import json
+import sqlite3
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+timings_lock = threading.Lock()
+
+# Run being recorded, and the state directory it is recorded in. Nothing is
+# recorded while the run is None.
+current = {'run': None, 'state': None}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, project TEXT,
+    machine TEXT, stage TEXT, start REAL, end REAL, status TEXT);
+CREATE TABLE IF NOT EXISTS stages (run INTEGER, stage TEXT, start REAL,
+    end REAL, status TEXT);
+CREATE TABLE IF NOT EXISTS attempts (run INTEGER, stage TEXT,
+    attempt INTEGER, start REAL, end REAL, returncode INTEGER);
+CREATE TABLE IF NOT EXISTS specs (run INTEGER, stage TEXT, hash TEXT,
+    name TEXT, version TEXT, compiler TEXT, seconds REAL, source TEXT);
+"""
+
+# Number of previous runs the trend is computed against.
+TREND_RUNS = 5
+
+
+def timings_file(context=None):
+    """
+    Path of the timing database for the current project/machine: that of
+    the given context, else the one the current run is recorded in.
+
+    """
+    if context is None and current['state'] is not None:
+        return join(current['state'], 'timings.db')
+    return join(state_dir(context), 'timings.db')
+
+
+def connect(context=None):
+    """
+    Open the timing database, creating its tables if needed.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    connection : sqlite3.Connection
+        Connection to the database.
+
+    """
+    connection = sqlite3.connect(timings_file(context), timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def execute(statement, parameters=()):
+    """
+    Run a single write statement against the timing database. Failures are
+    only logged, timings must never break an install.
+
+    Returns
+    -------
+    rowid : Integer
+        Row id of the last inserted row, or None on failure.
+
+    """
+    try:
+        with timings_lock, closing(connect()) as connection:
+            with connection:
+                return connection.execute(statement, parameters).lastrowid
+    except sqlite3.Error as e:
+        warn = 'WARNING: Unable to record timings in {}: {}'.format(timings_file(), e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        return None
+
+
+def start_run(project, machine, stage, context=None):
+    """
+    Start recording a spack-cm install run.
+
+    Parameters
+    ----------
+    project : String
+        The project being installed.
+    machine : String
+        The machine being installed on.
+    stage : String
+        The stage selection of the run.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    """
+    current['state'] = state_dir(context)
+    current['run'] = execute('INSERT INTO runs (project, machine, stage, start, status) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (project, machine, stage, time.time(), 'running'))
+    logger.info('Recording timings of run {} in {}.'.format(current['run'], timings_file()))
+
+
+def finish_run(status):
+    """
+    Stop recording the current run.
+
+    Parameters
+    ----------
+    status : String
+        Outcome of the run (e.g., installed, failed).
+
+    """
+    if current['run'] is None:
+        return
+    execute('UPDATE runs SET end = ?, status = ? WHERE id = ?',
+            (time.time(), status, current['run']))
+
+
+def record_attempt(stage, attempt, start, returncode):
+    """
+    Record one spack install attempt of the current run.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage (or single stack) being installed.
+    attempt : Integer
+        Number of the attempt, starting at 1.
+    start : Float
+        Time the attempt started.
+    returncode : Integer
+        Return code of spack install.
+
+    """
+    if current['run'] is None:
+        return
+    execute('INSERT INTO attempts VALUES (?, ?, ?, ?, ?, ?)',
+            (current['run'], stage, attempt, start, time.time(), returncode))
+
+
+def record_stage_time(stage, start, status):
+    """
+    Record the wall time of a stage of the current run.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage.
+    start : Float
+        Time the stage started.
+    status : String
+        Outcome of the stage (installed, skipped or failed).
+
+    """
+    if current['run'] is None:
+        return
+    execute('INSERT INTO stages VALUES (?, ?, ?, ?, ?)',
+            (current['run'], stage, start, time.time(), status))
+
+
+def _index_nodes(installs):
+    """
+    Map each hash of a spack database to its name, version, compiler and
+    dependency hashes, for both the dictionary and list node formats.
+
+    """
+    nodes = {}
+    for key, record in installs.items():
+        spec = record.get('spec', {})
+        if 'name' in spec:
+            node = spec
+            dependencies = [dep['hash'] for dep in spec.get('dependencies', [])]
+        elif spec:
+            node = list(spec.values())[0]
+            node = dict(node, name=list(spec.keys())[0])
+            dependencies = [dep['hash'] for dep in
+                            node.get('dependencies', {}).values()]
+        else:
+            node = {'name': key}
+            dependencies = []
+        compiler = node.get('compiler', {})
+        compiler = '{}@{}'.format(compiler.get('name'), compiler.get('version')) if compiler else ''
+        nodes[key] = (node['name'], str(node.get('version', '')), compiler,
+                      dependencies)
+    return nodes
+
+
+def spec_times(install_path, since):
+    """
+    Estimate how long each spec installed into a tree since a given time
+    took to install.
+
+    Spack's own install_times.json is used when the install prefix has
+    one. Otherwise the time is measured from the moment the spec could
+    start: the latest of since and the install times of its dependencies.
+
+    Parameters
+    ----------
+    install_path : String
+        Root of the install tree.
+    since : Float
+        Only specs installed after this time are considered.
+
+    Returns
+    -------
+    times : List
+        (hash, name, version, compiler, seconds, source) of each spec.
+
+    """
+    index = join(install_path, '.spack-db', 'index.json')
+    if not isfile(index):
+        return []
+    with open(index, 'r') as f:
+        installs = json.load(f)['database']['installs']
+    nodes = _index_nodes(installs)
+    times = []
+    for key, record in installs.items():
+        installed = record.get('installation_time')
+        if installed is None or installed < since or not record.get('installed', True):
+            continue
+        name, version, compiler, dependencies = nodes[key]
+        seconds = None
+        source = 'install_times.json'
+        timing_file = join(record.get('path') or '', '.spack', 'install_times.json')
+        if record.get('path') and isfile(timing_file):
+            try:
+                with open(timing_file, 'r') as f:
+                    seconds = json.load(f)['total']['seconds']
+            except (ValueError, KeyError, TypeError):
+                seconds = None
+        if seconds is None:
+            ready = [since] + [installs[dep].get('installation_time', since)
+                               for dep in dependencies if dep in installs]
+            ready = [value for value in ready if value <= installed]
+            seconds = installed - max(ready)
+            source = 'database'
+        times.append((key, name, version, compiler, seconds, source))
+    return times
+
+
+def record_specs(stage, install_path, since):
+    """
+    Record the install times of the specs a stage installed.
+
+    Parameters
+    ----------
+    stage : String
+        Name of the stage.
+    install_path : String
+        Root of the stage's install tree.
+    since : Float
+        Time the stage started.
+
+    """
+    if current['run'] is None:
+        return
+    try:
+        times = spec_times(install_path, since)
+    except Exception as e:
+        warn = 'WARNING: Unable to read spec install times from {}: {}'.format(install_path, e)
+        logger.warning(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
+        return
+    for spec in times:
+        execute('INSERT INTO specs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (current['run'], stage) + spec)
+
+
+def spec_estimates(context=None):
+    """
+    Average recorded install time of each spec.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    estimates : Dictionary
+        (name, version, compiler) and name mapped to the average number of
+        seconds their installs took.
+
+    """
+    if not isfile(timings_file(context)):
+        return {}
+    estimates = {}
+    with timings_lock, closing(connect(context)) as connection:
+        for name, version, compiler, seconds in connection.execute(
+                'SELECT name, version, compiler, AVG(seconds) FROM specs '
+                'GROUP BY name, version, compiler'):
+            estimates[(name, version, compiler)] = seconds
+        for name, seconds in connection.execute(
+                'SELECT name, AVG(seconds) FROM specs GROUP BY name'):
+            estimates[name] = seconds
+    return estimates
+
+
+def stage_estimates(context=None):
+    """
+    Average recorded wall time of each stage and single stack. Stacks are
+    timed by the attempts of the runs which installed them.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    estimates : Dictionary
+        Stage name (or tpl:<stack>) mapped to the average number of seconds
+        its installs took.
+
+    """
+    if not isfile(timings_file(context)):
+        return {}
+    with timings_lock, closing(connect(context)) as connection:
+        estimates = dict(connection.execute(
+            'SELECT stage, AVG(end - start) FROM stages WHERE status = ? '
+            'GROUP BY stage', ('installed',)).fetchall())
+        estimates.update(connection.execute(
+            'SELECT stage, AVG(seconds) FROM '
+            '(SELECT stage, SUM(end - start) AS seconds FROM attempts '
+            'WHERE stage LIKE ? GROUP BY run, stage HAVING MIN(returncode) = 0) '
+            'GROUP BY stage', ('tpl:%',)).fetchall())
+    return estimates
+
+
+def format_seconds(seconds):
+    """
+    Format a duration as 1h02m03s, 2m03s or 3s.
+
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+def stage_history(connection, run, stage):
+    """
+    Average wall time of a stage over the previous installed runs of the
+    same project and machine.
+
+    Returns
+    -------
+    average : Float
+        Average duration, or None if there is no history.
+
+    """
+    rows = connection.execute(
+        'SELECT s.end - s.start FROM stages s JOIN runs r ON s.run = r.id '
+        'WHERE s.stage = ? AND s.status = ? AND r.id < ? AND '
+        'r.project = (SELECT project FROM runs WHERE id = ?) AND '
+        'r.machine = (SELECT machine FROM runs WHERE id = ?) '
+        'ORDER BY r.id DESC LIMIT ?',
+        (stage, 'installed', run, run, run, TREND_RUNS)).fetchall()
+    if not rows:
+        return None
+    return sum(row[0] for row in rows) / len(rows)
+
+
+def report(run=None, slowest=10):
+    """
+    Build the end-of-run report: slowest specs, time per stage and trend
+    against previous runs.
+
+    Parameters
+    ----------
+    run : Integer, optional
+        Run to report on. The default is the current run.
+    slowest : Integer, optional
+        Number of specs listed. The default is 10.
+
+    Returns
+    -------
+    lines : List
+        Lines of the report.
+
+    """
+    run = current['run'] if run is None else run
+    if run is None or not isfile(timings_file()):
+        return []
+    with timings_lock, closing(connect()) as connection:
+        stages = connection.execute('SELECT stage, end - start, status FROM stages '
+                                    'WHERE run = ? ORDER BY start', (run,)).fetchall()
+        attempts = dict(connection.execute('SELECT stage, COUNT(*) FROM attempts '
+                                           'WHERE run = ? GROUP BY stage', (run,)).fetchall())
+        specs = connection.execute('SELECT name, version, compiler, stage, seconds FROM specs '
+                                   'WHERE run = ? ORDER BY seconds DESC LIMIT ?',
+                                   (run, slowest)).fetchall()
+        lines = ['Time per stage:']
+        for stage, seconds, status in stages:
+            line = '  {:<10} {:>10}  {:<9} {} attempt(s)'.format(
+                stage, format_seconds(seconds), status, attempts.get(stage, 0))
+            average = stage_history(connection, run, stage) if status == 'installed' else None
+            if average:
+                line += '  (previous {}: {}, {:+.0f}%)'.format(
+                    TREND_RUNS, format_seconds(average), 100 * (seconds - average) / average)
+            lines.append(line)
+    if specs:
+        lines.append('Slowest specs:')
+        for name, version, compiler, stage, seconds in specs:
+            lines.append('  {:>10}  {}@{}{} ({})'.format(
+                format_seconds(seconds), name, version,
+                ' %' + compiler if compiler else '', stage))
+    return lines
+
+
+def print_report(run=None):
+    """
+    Print the end-of-run report.
+
+    """
+    lines = report(run)
+    if not lines:
+        return
+    print('\n' + 50*'*')
+    print(f'{pcolors.OKBLUE}Build times (stored in {timings_file()}):{pcolors.ENDC}')
+    for line in lines:
+        print(line)
+        logger.info(line)
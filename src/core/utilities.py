@@ -3,11 +3,9 @@ Miscellaneous utilities for use by spack-cm
 '''
 
 import logging
-import subprocess
-import yaml
 import argparse
-from os.path import split, abspath, dirname, isdir, isfile, join, expanduser
-from os import environ, listdir, mkdir, makedirs, walk
+from os.path import split, abspath, dirname, isdir, isfile, join
+from os import environ, mkdir, makedirs, walk
 from shutil import copyfile
 logger = logging.getLogger(__name__)
 
@@ -54,6 +52,126 @@ def dir_path(path):
         raise argparse.ArgumentTypeError(f"{pcolors.FAIL}ERROR: Path is not valid. Please make sure path exists.{pcolors.ENDC}")
 
 
+def stage_setting(value):
+    """
+    Split a per-stage command line setting of the form STAGE=VALUE. A bare
+    VALUE applies to every stage.
+
+    Parameters
+    ----------
+    value : String
+        Setting given on the command line.
+
+    Returns
+    -------
+    setting : Tuple
+        (stage, value), where stage is 'all' for a bare value.
+
+    """
+    stages = ['all', 'base', 'lmod', 'compiler', 'utility', 'tpl']
+    if '=' in value:
+        stage, value = value.split('=', 1)
+    else:
+        stage = 'all'
+    if stage not in stages:
+        raise argparse.ArgumentTypeError(f"{pcolors.FAIL}ERROR: Unknown stage {stage}. Available choices: {', '.join(stages)}.{pcolors.ENDC}")
+    return stage, value
+
+
+def stage_attempts(value):
+    """
+    Parse a per-stage number of install attempts (e.g., tpl=5 or 3).
+
+    Parameters
+    ----------
+    value : String
+        Setting given on the command line.
+
+    Raises
+    ------
+    argparse
+        Error if the number of attempts is not a positive integer.
+
+    """
+    stage, attempts = stage_setting(value)
+    if not attempts.isdigit() or int(attempts) < 1:
+        raise argparse.ArgumentTypeError(f"{pcolors.FAIL}ERROR: Attempts must be a positive integer.{pcolors.ENDC}")
+    return stage, int(attempts)
+
+
+def stage_cleanup_policy(value):
+    """
+    Parse a per-stage cleanup policy (e.g., tpl=full or stage).
+
+    Parameters
+    ----------
+    value : String
+        Setting given on the command line.
+
+    Raises
+    ------
+    argparse
+        Error if the policy is unknown.
+
+    """
+    from src.core.cleanup import CLEANUP_POLICIES
+    stage, policy = stage_setting(value)
+    if policy not in CLEANUP_POLICIES:
+        raise argparse.ArgumentTypeError(f"{pcolors.FAIL}ERROR: Unknown cleanup policy {policy}. Available choices: {', '.join(CLEANUP_POLICIES)}.{pcolors.ENDC}")
+    return stage, policy
+
+
+def cache_size(value):
+    """
+    Parse a cache size given in bytes or with a K, M, G or T suffix
+    (e.g., 50G).
+
+    Parameters
+    ----------
+    value : String
+        Size given on the command line.
+
+    Raises
+    ------
+    argparse
+        Error if the size is not a positive number of bytes.
+
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    number = value.strip().upper().rstrip('B')
+    factor = 1
+    if number[-1:] in units:
+        factor = units[number[-1]]
+        number = number[:-1]
+    try:
+        size = int(float(number) * factor)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"{pcolors.FAIL}ERROR: Cache size must be a positive size (e.g., 500M, 50G).{pcolors.ENDC}")
+    return size
+
+
+def expand_stage_settings(settings, stages):
+    """
+    Turn a list of (stage, value) settings into a dictionary, applying
+    'all' settings to every stage. Later settings win.
+
+    Parameters
+    ----------
+    settings : List
+        (stage, value) tuples.
+    stages : List
+        Names of all stages.
+
+    """
+    expanded = {}
+    for stage, value in settings or []:
+        for name in (stages if stage == 'all' else [stage]):
+            expanded[name] = value
+    return expanded
+
+
 def get_hostname():
     """
     Get or assign hostname of machine.
@@ -77,44 +195,42 @@ def spack_dependencies():
     (patch, curl, bzip2)
 
     """
+    from src.core.backend import spack_command
     packages = ['bzip2', 'curl', 'patch']
     try:
         for package in packages:
             logger.info('Attempting to load {}.'.format(package))
             print('Attempting to load {}...'.format(package))
-            load = subprocess.run('spack find -p -d {}'.format(package),
-                                  shell=True, stdout=subprocess.PIPE,
-                                  universal_newlines=True)
-            if load.returncode != 0:
+            returncode, output = spack_command(['find', '-p', '-d', package],
+                                               echo=False)
+            if returncode != 0:
                 warn = 'WARNING: Unable to load spack module {}.\n Attempting installation.'.format(package)
                 logger.warning(warn)
                 print(f"{pcolors.WARN}" + warn + f"{pcolors.ENDC}")
                 logger.info('Installing package ({}) in spack root.'.format(package))
                 print('Installing and loading {}...'.format(package))
-                install = subprocess.run('spack install -y {}'.format(package),
-                                         shell=True)
-                if install.returncode != 0:
+                returncode, output = spack_command(['install', '-y', package])
+                if returncode != 0:
                     error = 'ERROR: Package installation failed.\n \
                                     See spack logs for more details.'
                     logger.critical(error)
                     raise UtilityException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
-                load = subprocess.run('spack find -p -d {}'.format(package),
-                                      shell=True, stdout=subprocess.PIPE,
-                                      universal_newlines=True)
-                if load.returncode != 0:
+                returncode, output = spack_command(['find', '-p', '-d', package],
+                                                   echo=False)
+                if returncode != 0:
                     error = 'ERROR: Package load failed.\n \
                                     See spack logs for more details.'
                     logger.critical(error)
                     raise UtilityException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
                 else:
-                    pathlist = [item for item in load.stdout.split() if item.startswith('/') and item != '/']
+                    pathlist = [item for item in output.split() if item.startswith('/') and item != '/']
                     pathlist.reverse()
                     for path in pathlist:
                         environ['PATH'] = path + '/bin:' + environ['PATH']
                 logger.info('Successfully installed and loaded {}.'.format(package))
                 print('{} successfully installed and loaded.'.format(package))
             else:
-                pathlist = [item for item in load.stdout.split() if item.startswith('/') and item != '/']
+                pathlist = [item for item in output.split() if item.startswith('/') and item != '/']
                 pathlist.reverse()
                 for path in pathlist:
                     environ['PATH'] = path + '/bin:' + environ['PATH']
@@ -148,35 +264,23 @@ def env_var_list(name):
         raise UtilityException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
 
 
-def generate_file(file, contents):
+def check_project_yaml_files(context=None):
     """
-    Generate a YAML file.
+    Check if the install path has the default yaml files and generate missing ones.
 
     Parameters
     ----------
-    file : String
-        Path and name of output file.
-    contents : String
-        Contents to add to file.
-
-    """
-    class NoAliasDumper(yaml.SafeDumper):
-        def ignore_aliases(self, data):
-            return True
-    with open(file, 'w') as f:
-        yaml.dump(contents, f, sort_keys=False, Dumper=NoAliasDumper)
-
-
-def check_project_yaml_files():
-    """
-    Check if the install path has the default yaml files and generate missing ones.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
+    from src.core.context import current_context
+    install_path = current_context(context).install_path
     dir_yaml_path = [('compiler/', 'compilers.yaml'),
                      ('utility/', 'packages.yaml'),
                      ('base-packages/', 'packages.yaml')]
     for dir_path, yaml_file in dir_yaml_path:
-        path = join(environ['SPACK_CM_INSTALL_PATH'], dir_path)
+        path = join(install_path, dir_path)
         if not isdir(path):
             try:
                 makedirs(path)
@@ -194,35 +298,17 @@ def check_project_yaml_files():
                 raise UtilityException(f"{pcolors.FAIL}" + error + f"{pcolors.ENDC}")
 
 
-def replace_single_quotes(filename):
+def install_paths(project, machine, root_path, machine_path,
+                  explicit_install_path, explicit_modulefiles_path):
     """
-    Replace unnecessary single quotes in YAML files.
-
-    Parameters
-    ----------
-    filename : String
-        Path and name of file to be modified.
-
-    """
-    with open(filename, 'r') as f:
-        data = f.read()
-    new_data = data.replace("'", '')
-    new_data = new_data.replace('?', "''")
-    with open(filename, 'w') as f:
-        f.write(new_data)
-
-
-def export_env_vars(project, machine, root_path, machine_path,
-                    explicit_install_path, explicit_modulefiles_path):
-    """
-    Export environment variables from project manifest file.
+    Get the install and modulefile roots of a project/machine combination.
 
     Parameters
     ----------
     project : String
-        Project for which environment is to be generated.
+        Project being installed.
     machine : String
-        Platform for which environment is to be generated.
+        Platform being installed on.
     root_path : String
         Install/modulefile root path.
     machine_path: Boolean
@@ -231,8 +317,13 @@ def export_env_vars(project, machine, root_path, machine_path,
         Use exactly this path for the package installations
     explicit_modulefiles_path: String
         Use exactly this path for modulefile installations
-    """
 
+    Returns
+    -------
+    paths : Tuple
+        (install path, modulefile path).
+
+    """
     if explicit_install_path:
         install_path = explicit_install_path
     elif machine_path:
@@ -246,42 +337,41 @@ def export_env_vars(project, machine, root_path, machine_path,
         module_path = join(root_path, 'modulefiles/{}/{}/'.format(machine, project))
     else:
         module_path = join(root_path, 'modulefiles/{}/'.format(project))
+    return install_path, module_path
+
 
+def export_env_vars(project, machine, root_path, machine_path,
+                    explicit_install_path, explicit_modulefiles_path):
+    """
+    Export environment variables from project manifest file.
+
+    Parameters
+    ----------
+    project : String
+        Project for which environment is to be generated.
+    machine : String
+        Platform for which environment is to be generated.
+    root_path : String
+        Install/modulefile root path.
+    machine_path: Boolean
+        Add the machine name to the install path.
+    explicit_install_path: String
+        Use exactly this path for the package installations
+    explicit_modulefiles_path: String
+        Use exactly this path for modulefile installations
+
+    Returns
+    -------
+    context : ProjectContext
+        Context of the project/machine, see context.load_context.
+
+    """
+    from src.core.context import load_context
+    context = load_context(project, machine, root_path, machine_path,
+                           explicit_install_path, explicit_modulefiles_path)
+    context.export()
     filedir, file = split(abspath(__file__))
-    projectdir = join(dirname(filedir), 'project/{}'.format(project))
     machinedir = join(dirname(filedir), 'platform/{}'.format(machine))
-    projectrepo = join(projectdir, '/repos.yaml')
-    environ['SPACK_CM_PROJECT_REPO'] = projectrepo
-    environ['SPACK_CM_PROJECT_NAME'] = project
-    environ['SPACK_CM_MACHINE_NAME'] = machine
-    environ['SPACK_CM_INSTALL_PATH'] = install_path
-    environ['SPACK_CM_MODULEFILES_PATH'] = module_path
-    environ['SPACK_CM_COMPILER_INSTALL_PATH'] = join(install_path, 'compiler')
-    environ['SPACK_CM_UTILITY_INSTALL_PATH'] = join(install_path, 'utility')
-    environ['SPACK_CM_TPL_INSTALL_PATH'] = join(install_path, 'tpl')
-    environ['SPACK_CM_BASE_PACKAGES_INSTALL_PATH'] = join(install_path, 'base-packages')
-    environ['SPACK_CM_LMOD_INSTALL_PATH'] = join(install_path, 'lmod')
-    projectmanifest = join(projectdir, '{}-manifest.yaml'.format(project))
-    subprocess.run('rm -rf ~/.spack && spack compiler find', shell=True)
-    with open(join(expanduser('~/.spack'),
-                   [subdir for subdir in listdir(expanduser('~/.spack')) if subdir != 'cache'][0]) + '/compilers.yaml', 'r') as f:
-        comp = yaml.full_load(f)
-        spec = comp['compilers'][0]['compiler']['spec']
-        environ['SYSTEM_COMPILER'] = spec
-    with open(projectmanifest, 'r') as f:
-        contents = yaml.full_load(f)
-    for key in contents:
-        if key == 'SPACK_CM_UTILITY_COMPILER' and contents[key][0] == '':
-            environ[key] = environ['SYSTEM_COMPILER']
-            continue
-        if key == 'SPACK_CM_BASE_COMPILER' and contents[key][0] == '':
-            environ[key] = environ['SYSTEM_COMPILER']
-            continue
-        if contents[key] == '' or contents[key] == None:
-            environ[key] = ''
-            continue
-        st = ', '
-        environ[key] = st.join(contents[key])
     if 'intel' in environ['SPACK_CM_COMPILERS']:
         licensefile = join(machinedir, 'licenses/license.lic')
         spacklicense = join(environ['SPACK_ROOT'], 'etc/spack/licenses/intel')
@@ -290,17 +380,70 @@ def export_env_vars(project, machine, root_path, machine_path,
         copyfile(licensefile, join(spacklicense, 'license.lic'))
         logger.info('Copying license file {} to spack license area {}.'.format(licensefile, spacklicense))
         print('Copying license file {} to spack license area {}.'.format(licensefile, spacklicense))
-    if environ['SPACK_CM_COMPILERS'] == '' and environ['SPACK_CM_EXTERNAL_COMPILERS'] == '':
-        environ['SPACK_CM_EXTERNAL_COMPILERS'] = environ['SYSTEM_COMPILER']
     print('\n' + 50*'*')
     for key in environ:
         if 'SEMS' in key:
             logger.info('Environment path modified: {} is set to "{}".'.format(key, environ[key]))
             print('Environment path modified: {} is set to "{}".'.format(key, environ[key]))
     print('\n')
+    return context
+
+
+def state_dir(context=None):
+    """
+    Get (and create) the directory holding spack-cm's persistent state for
+    the current project/machine install path.
+
+    Parameters
+    ----------
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
+
+    Returns
+    -------
+    path : String
+        Path to the state directory.
+
+    """
+    from src.core.context import current_context
+    path = join(current_context(context).install_path, '.spack-cm')
+    if not isdir(path):
+        makedirs(path)
+    return path
+
 
+def stage_env_dir(project, machine, name):
+    """
+    Get (and create) the spack environment directory used to install a
+    single stage, so that stages can be installed side by side.
+
+    The directory sits two levels below the source root, like the project
+    directory, so the relative includes of the generated YAML files still
+    resolve.
 
-def copy_spack_yaml(project, filename):
+    Parameters
+    ----------
+    project : String
+        Project being installed.
+    machine : String
+        Platform being installed.
+    name : String
+        Name of the stage.
+
+    Returns
+    -------
+    envdir : String
+        Path to the environment directory.
+
+    """
+    filedir, file = split(abspath(__file__))
+    envdir = join(dirname(filedir), 'envs', '{}-{}-{}'.format(project, machine, name))
+    if not isdir(envdir):
+        makedirs(envdir)
+    return envdir
+
+
+def copy_spack_yaml(project, filename, envdir=None):
     """
     Copy a generated YAML file into spack.yaml in the project directory.
 
@@ -310,36 +453,52 @@ def copy_spack_yaml(project, filename):
         Project for which YAML is to be copied.
     file : String
         File name.
+    envdir : String, optional
+        Environment directory to copy into. The default is the project
+        directory.
 
     """
     filedir, file = split(abspath(__file__))
     projectdir = join(dirname(filedir), 'project/{}'.format(project))
-    copyfile(join(projectdir, filename), join(projectdir, 'spack.yaml'))
+    if envdir is None:
+        envdir = projectdir
+    copyfile(join(projectdir, filename), join(envdir, 'spack.yaml'))
 
 
-def generate_compiler_yaml(project):
+def generate_compiler_yaml(project, envdir=None, context=None):
     """
-    Generate and copy a compilers.yaml into the compilers directory.
+    Register the built compilers and write them to the compilers.yaml of
+    the compilers directory.
 
     Parameters
     ----------
     project : String
         Project for which YAML is to be generated.
+    envdir : String, optional
+        Environment directory the compilers were installed from. The
+        default is the project directory.
+    context : ProjectContext, optional
+        Settings of the project. The default is read from os.environ.
 
     """
+    from src.core.compilers import installed_compiler_prefixes, register_compilers
+    from src.core.context import current_context
+    from src.core.emitter import write_yaml
     filedir, file = split(abspath(__file__))
     projectdir = dirname(filedir) + '/project/{}'.format(project)
-    compilers = env_var_list('SPACK_CM_COMPILERS')
-    for compiler in compilers:
-        logger.info('Attempting to load and gather info on compiler {}.'.format(compiler))
-        load_compiler = subprocess.run('spack env activate {} && spack load {} && spack compiler find && spack unload {} && spack env deactivate'.format(projectdir, compiler, compiler), shell=True)
-        if load_compiler.returncode != 0:
-            logger.critical('ERROR: Was unable to load installed compiler {}.'.format(compiler))
-            raise UtilityException('ERROR: Was unable to load installed compiler {}.'.format(compiler))
-    compilers_file = join(environ['SPACK_CM_COMPILER_INSTALL_PATH'], 'compilers.yaml')
-    with open(join(projectdir, 'spack.yaml'), 'r') as f:
-        contents = yaml.full_load(f)
-    contents = {'compilers': contents['spack']['compilers']}
+    if envdir is None:
+        envdir = projectdir
+    context = current_context(context)
+    compilers = context.values('SPACK_CM_COMPILERS')
+    logger.info('Registering installed compilers {}.'.format(', '.join(compilers)))
+    try:
+        prefixes = installed_compiler_prefixes(context.compiler_install_path,
+                                               compilers)
+        contents = {'compilers': register_compilers(envdir, prefixes.values())}
+    except Exception as e:
+        logger.critical('ERROR: Was unable to load installed compilers: {}'.format(e))
+        raise UtilityException('ERROR: Was unable to load installed compilers: {}'.format(e))
+    compilers_file = join(context.compiler_install_path, 'compilers.yaml')
     # Intel 19+ spack discovery nets the full version number (A.B.C.XYZ).
     # Rather than expect users to know the full number, which is not
     # available through Spack's interface, we will replace intel versions
@@ -350,7 +509,7 @@ def generate_compiler_yaml(project):
             intel = compiler['compiler']['spec']
             contents['compilers'][i]['compiler']['spec'] = '.'.join(intel.split('.')[0:3])
         i += 1
-    generate_file(compilers_file, contents)
+    write_yaml(compilers_file, contents)
     logger.info('Compilers successfully loaded.')
     print('Compilers successfully loaded.')
 